@@ -3,7 +3,9 @@
 import os
 from os import path as p
 import pandas as pd
-from subprocess import run
+from hit_store import export_excel
+# performance records
+from instrumentation import measure, run_command, set_metrics_file
 ########################################################################################
 # utilities
 def ifnotmkdir(dir):
@@ -19,11 +21,12 @@ def to_fasta(sequence, identifier):
 def inputs():
     excelDir='/home/esp/dataset_generation/flavin_dataset/00_Excel_and_Fasta/03_post_BLAST'
     clusterDir='/home/esp/dataset_generation/flavin_dataset/03_post_blast_Clustering'
-    data=pd.read_csv(p.join(excelDir,'Nr_dataset_inputs_included.csv'))
+    data=pd.read_parquet(p.join(excelDir,'Nr_dataset_inputs_included.parquet'))
 
     return excelDir, clusterDir, data
 ########################################################################################
-# runs cdhit from a given list of fasta sequences, returns a list of centriod sequences 
+# runs cdhit on a fasta file, returns the fasta file of representatives and the path of the
+# .clstr file. -d 0 keeps full IDs in the .clstr file (the default cuts them at 20 characters)
 def run_clustering(fastaFile,tolerance,clusterDir):
     # select correct wordlength
     if 0.4 <= tolerance <= 0.5:
@@ -40,25 +43,71 @@ def run_clustering(fastaFile,tolerance,clusterDir):
     outputFile=p.join(clusterDir,f'output_data_{tolPercent}.fasta')
 
     # Run CD-HIT
-    run(["cd-hit", "-i", fastaFile, "-o", outputFile, "-c", str(tolerance), "-n", wordSize])
+    run_command(["cd-hit", "-i", fastaFile, "-o", outputFile, "-c", str(tolerance), "-n", wordSize, "-d", "0"],check=True)
 
-    # Read the filtered sequences and return a list of fasta sequences
-    centroidFastas = []
-    with open(outputFile, "r") as f:
-        thisFasta=''
+    return outputFile, outputFile+".clstr"
+
+########################################################################################
+# parses a cd-hit .clstr file into a dict of member ID -> representative ID
+#   >Cluster 0
+#   0	2799aa, >P12345... *
+#   1	2214aa, >Q67890... at 79.16%
+def parse_clstr(clstrFile):
+    memberToRep={}
+    members=[]
+    representative=None
+    with open(clstrFile,"r") as f:
         for line in f:
-            if line.startswith(">"):
-                thisFasta=line
-            else:
-                thisFasta+=line
-                centroidFastas.append(thisFasta)
-    return centroidFastas
+            if line.startswith(">Cluster"):
+                for member in members:
+                    memberToRep[member]=representative
+                members=[]
+                representative=None
+                continue
+            memberId=line[line.index(">")+1:line.index("...")]
+            members.append(memberId)
+            if line.rstrip().endswith("*"):
+                representative=memberId
+    for member in members:
+        memberToRep[member]=representative
+    return memberToRep
+
+# first word of the header line of a FASTA string, the ID cd-hit reports
+def fasta_ids(fastaColumn):
+    return fastaColumn.str.split("\n",n=1).str[0].str[1:].str.split(n=1).str[0]
 
 ########################################################################################
-def main():
-    # get input directories and dataframe of proteins
-    excelDir, clusterDir, dataDf = inputs()
-    print(dataDf["FASTA"])
+# clusters at every tolerance and returns an ID-keyed membership table, one
+# representative_<percent> column per tolerance
+#   cascade=True:  clusters at the highest tolerance first and feeds only its representatives
+#                  into the next one down, members are traced back through every level
+#   cascade=False: every tolerance clusters the full input
+def cluster_thresholds(inputFastaFile,ids,tolerances,clusterDir,cascade=True):
+    membershipDf=pd.DataFrame(index=pd.Index(ids,name="ID"))
+    fastaFile=inputFastaFile
+    previousColumn=None
+    for tol in sorted(tolerances,reverse=True):
+        with measure("unit","cdhit_level",tolerance=tol) as metrics:
+            representativeFasta,clstrFile=run_clustering(fastaFile=fastaFile, tolerance=tol,
+                                                         clusterDir=clusterDir)
+            memberToRep=parse_clstr(clstrFile)
+            metrics["records"]=len(memberToRep)
+            metrics["clusters"]=len(set(memberToRep.values()))
+        column=f"representative_{int(tol*100)}"
+        if cascade and previousColumn is not None:
+            # representative of my representative at the previous (higher) tolerance
+            membershipDf[column]=membershipDf[previousColumn].map(memberToRep)
+        else:
+            membershipDf[column]=membershipDf.index.map(memberToRep)
+        if cascade:
+            fastaFile=representativeFasta
+            previousColumn=column
+    return membershipDf
+
+########################################################################################
+# clusters a dataframe of proteins (FASTA column) at every tolerance, writes the membership
+# table to clusterDir and the representatives at each tolerance to outDir
+def recluster(dataDf,outDir,clusterDir,tolerances=(0.5,0.6,0.7,0.8,0.9),exportExcel=False,cascade=True):
     # write a fasta file from teh FASTA column in dataframe
     inputFastaFile=p.join(clusterDir,f'input_data.fasta')
     fastaSequences=dataDf["FASTA"].to_list()
@@ -67,20 +116,32 @@ def main():
         for fasta in fastaSequences:
             outFile.write(fasta+'\n')
 
-    # loop through sequence similarity tolerances
-    for tol in [0.5,0.6,0.7,0.8,0.9]:
-        # extract FASTA from dataframe to a list
-        fastaSequences=dataDf["FASTA"].to_list()
-        # run clustering
-        centroidFastas=run_clustering(fastaFile=inputFastaFile, tolerance=tol,
-                                         clusterDir=clusterDir)
-        # filter original dataframe using result of clustering
-        mask=dataDf["FASTA"].isin(centroidFastas)
-        centroidDf=dataDf[mask]
-        # write to excel file
+    # cluster at every sequence similarity tolerance, keyed on the IDs in the FASTA column
+    dataIds=fasta_ids(dataDf["FASTA"])
+    membershipDf=cluster_thresholds(inputFastaFile,dataIds.to_list(),tolerances,clusterDir,cascade)
+    membershipDf.to_parquet(p.join(clusterDir,"cluster_membership.parquet"))
+
+    for tol in tolerances:
         tolPercent=str(int(tol*100))
-        outputExcel=p.join(excelDir,f'data_{tolPercent}%_seq_similarity.xlsx')
-        centroidDf.to_excel(outputExcel)
+        # filter original dataframe to the representatives at this tolerance
+        representatives=membershipDf[f"representative_{tolPercent}"]
+        centroidIds=representatives.index[representatives.index==representatives.to_numpy()]
+        mask=dataIds.isin(centroidIds)
+        centroidDf=dataDf[mask.to_numpy()]
+        # write to parquet, excel copy only on request
+        centroidDf.to_parquet(p.join(outDir,f'data_{tolPercent}%_seq_similarity.parquet'))
+        if exportExcel:
+            outputExcel=p.join(outDir,f'data_{tolPercent}%_seq_similarity.xlsx')
+            export_excel(centroidDf,outputExcel)
+    return membershipDf
+
+def main(exportExcel=False,cascade=True):
+    # get input directories and dataframe of proteins
+    excelDir, clusterDir, dataDf = inputs()
+    print(dataDf["FASTA"])
+    set_metrics_file(p.join(clusterDir,"metrics.jsonl"))
+    with measure("stage","recluster",records=len(dataDf)):
+        recluster(dataDf,excelDir,clusterDir,exportExcel=exportExcel,cascade=cascade)
 
 ########################################################################################
 # run main (if statement prevents running if this script is imported)
@@ -4,12 +4,19 @@
 import os
 from os import path as p
 import pandas as pd
-from subprocess import run
-import numpy as np  
-from Bio.Blast.Applications import NcbiblastpCommandline
+import subprocess
 from io import StringIO
 from Bio.Blast import NCBIXML
 import multiprocessing
+import tempfile
+import shutil
+from itertools import groupby
+from smith_waterman import sw_scores
+from kmer_sketch import sketch_matrix, candidate_pairs
+from fasta_index import iter_fasta
+import similarity_store
+# performance records
+from instrumentation import measure, run_command, set_metrics_file
 ########################################################################################
 # utilities
 def ifnotmkdir(dir):
@@ -19,94 +26,176 @@ def ifnotmkdir(dir):
 
 #################
 def fasta2df(fastaFile):
-    fastaList = []
-    entry = []
-
-    for line in open(fastaFile,"r"):
-        line = line.strip()
-
-        if line.startswith(">"):
-            if entry:
-                fastaList.append(entry)
-                entry = []
-            entry.append(line[1:])
-        else:
-            entry.append(line)
+    df = pd.DataFrame(list(iter_fasta(fastaFile)), columns=["ID", "Sequence"])
+    return df
 
-    if entry:
-        fastaList.append(entry)
+########################################################################################
+# yields chunks of (i,j) index pairs from the upper triangle, without building the full list
+def pair_chunks(numSeqs,chunkSize):
+    chunk=[]
+    for i in range(0,numSeqs):
+        for j in range(i+1,numSeqs):
+            chunk.append((i,j))
+            if len(chunk)==chunkSize:
+                yield chunk
+                chunk=[]
+    if chunk:
+        yield chunk
+
+# yields chunks of candidate (i,j) pairs from the sketch prefilter
+def candidate_chunks(rows,cols,chunkSize):
+    for start in range(0,len(rows),chunkSize):
+        yield list(zip(rows[start:start+chunkSize].tolist(),cols[start:start+chunkSize].tolist()))
 
-    df = pd.DataFrame(fastaList, columns=["ID", "Sequence"])
-    return df
+########################################################################################
+# worker state - filled once per worker process by init_worker so that
+# the sequence table is not re-pickled for every pair
+workerIds=None
+workerSeqs=None
+workerTmpDir=None
+workerBackend=None
+workerMatrix=None
+
+def init_worker(ids,sequences,tmpRoot,backend,matrixName=None):
+    global workerIds, workerSeqs, workerTmpDir, workerBackend, workerMatrix
+    workerIds=ids
+    workerSeqs=sequences
+    workerBackend=backend
+    # condensed on-disk matrix that this worker writes its scores into
+    if matrixName is not None:
+        workerMatrix=similarity_store.open_for_writing(matrixName)
+    # each worker gets its own scratch dir so query/subject files never collide
+    workerTmpDir=tempfile.mkdtemp(prefix=f"worker_{os.getpid()}_",dir=tmpRoot)
+
+# scores a chunk of pairs inside a worker, returns a list of (i,j,score)
+def score_pair_chunk(pairChunk):
+    with measure("unit","pair_chunk",backend=workerBackend,records=len(pairChunk)):
+        if workerBackend=="smith-waterman":
+            return score_pair_chunk_sw(pairChunk)
+        results=[]
+        for i,j in pairChunk:
+            score=calculate_similarity(workerIds[i],workerSeqs[i],
+                                       workerIds[j],workerSeqs[j],
+                                       workerTmpDir)
+            results.append((i,j,score))
+        return results
+
+# scores a chunk and writes it straight into the on-disk matrix, returns the number of pairs
+def score_and_store_chunk(pairChunk):
+    results=score_pair_chunk(pairChunk)
+    rows,cols,scores=zip(*results)
+    similarity_store.write_pairs(workerMatrix,len(workerSeqs),rows,cols,scores)
+    return len(results)
+
+# in-process backend: pairs sharing a query are scored in one vectorised call
+def score_pair_chunk_sw(pairChunk):
+    results=[]
+    for i,pairs in groupby(pairChunk,key=lambda pair:pair[0]):
+        subjectIdxs=[j for _,j in pairs]
+        scores=sw_scores(workerSeqs[i],[workerSeqs[j] for j in subjectIdxs])
+        results.extend((i,j,float(score)) for j,score in zip(subjectIdxs,scores))
+    return results
 
 ########################################################################################
-def gen_similarity_matrix(fastaFile,outputName):
+# backend is either "blastp" (one blastp run per pair) or "smith-waterman" (in-process)
+# with a sketchCutoff only pairs whose k-mer sketch similarity clears it are aligned,
+# and the result is written as a sparse edge list instead of the full matrix
+# the full matrix is written as {outDir}/similarity_matrix_{outputName}.npy/.json, see similarity_store.py
+# returns the number of pairs scored
+def gen_similarity_matrix(fastaFile,outputName,num_cpus=None,chunkSize=500,backend="blastp",
+                          sketchCutoff=None,kmerSize=4,outDir="."):
     # Parse the .clstr file and extract cluster representatives and members
     fastaDf =   fasta2df(fastaFile)
     numclusters=fastaDf.shape[0]
-    # Calculate pairwise similarities between cluster representatives
-    similarity_matrix = np.zeros((numclusters, numclusters))  
-    pairList=[]
-    for i in range(0,numclusters):
-        for j in range(0,numclusters):
-            if j > i:
-                pairList.append([i,j])
-
-    # Create a pool of 15 worker processes
-    num_cpus = 15
-    pool = multiprocessing.Pool(processes=num_cpus)
-    # run blast search for all ssequence pairs
-    for pair in pairList:
-        print(f"Calculating similarity for proteins {pair[0]} and {pair[1]}")
-        similarity=pool.apply_async(calculate_similarity,(pair,fastaDf)).get()
-        similarity_matrix[pair[0]][pair[1]] = similarity
-        similarity_matrix[pair[1]][pair[0]] = similarity
-
-    # Close the pool and wait for all processes to complete
-    pool.close()
-    pool.join()
-
-
-    # write similarity matrix to file
-    similarityDf=pd.DataFrame(similarity_matrix)
-    similarityDf.to_csv(f"similarity_matrix_{outputName}.csv")
+    ids=fastaDf["ID"].to_list()
+    sequences=fastaDf["Sequence"].to_list()
+    numPairs=numclusters*(numclusters-1)//2
+
+    if backend not in ["blastp","smith-waterman"]:
+        raise ValueError(f"Unknown similarity backend: {backend}")
+    # pick which pairs get aligned
+    if sketchCutoff is None:
+        # Calculate pairwise similarities between cluster representatives, into a condensed
+        # float32 matrix on disk that the workers fill in
+        matrixName=p.join(outDir,f"similarity_matrix_{outputName}")
+        similarity_store.create_matrix(matrixName,ids,backend,{"chunkSize":chunkSize})
+        numTasks=numPairs
+        tasks=pair_chunks(numclusters,chunkSize)
+    else:
+        sketches=sketch_matrix(sequences,kmerSize)
+        rows,cols,sketchSims=candidate_pairs(sketches,sketchCutoff)
+        numTasks=len(rows)
+        print(f"Sketch prefilter (k={kmerSize}, cutoff={sketchCutoff}) kept {numTasks}/{numPairs} pairs, pruned {numPairs-numTasks}")
+        tasks=candidate_chunks(rows,cols,chunkSize)
+        matrixName=None
+        edges=[]
+
+    # Create a pool with one worker per core, each worker gets the sequences once
+    if num_cpus is None:
+        num_cpus = os.cpu_count()
+    tmpRoot=tempfile.mkdtemp(prefix="similarity_")
+    try:
+        with multiprocessing.Pool(processes=num_cpus,
+                                  initializer=init_worker,
+                                  initargs=(ids,sequences,tmpRoot,backend,matrixName)) as pool:
+            # score all sequence pairs, count / collect chunks as they finish
+            pairsDone=0
+            if sketchCutoff is None:
+                for numScored in pool.imap_unordered(score_and_store_chunk,tasks):
+                    pairsDone+=numScored
+                    print(f"Calculated similarity for {pairsDone}/{numTasks} pairs")
+            else:
+                for results in pool.imap_unordered(score_pair_chunk,tasks):
+                    edges.extend(results)
+                    pairsDone+=len(results)
+                    print(f"Calculated similarity for {pairsDone}/{numTasks} pairs")
+    finally:
+        shutil.rmtree(tmpRoot,ignore_errors=True)
+
+    if sketchCutoff is not None:
+        # write sparse similarities as an edge list, in the same (i,j) order as the candidates
+        edgeDf=pd.DataFrame(edges,columns=["i","j","score"]).sort_values(["i","j"],ignore_index=True)
+        edgeDf.insert(2,"ID_i",[ids[i] for i in edgeDf["i"]])
+        edgeDf.insert(3,"ID_j",[ids[j] for j in edgeDf["j"]])
+        edgeDf.insert(4,"sketch_similarity",sketchSims)
+        edgeDf.to_csv(p.join(outDir,f"similarity_edges_{outputName}.csv"),index=False)
+    return pairsDone
 
 ########################################################################################
 
-def calculate_similarity(sequencePair,fastaDf) :
-    #extract IDs and sequences from fastaDf for pair
-    ID_i=fastaDf.iloc[sequencePair[0]]["ID"]
-    ID_j=fastaDf.iloc[sequencePair[1]]["ID"]
-    seq_i=fastaDf.iloc[sequencePair[0]]["Sequence"]
-    seq_j=fastaDf.iloc[sequencePair[1]]["Sequence"]
-
-    # Create temporary files for input and output
-    queryFile = 'query.fasta'
-    subjectFile='subject.fasta'
-    
+# blastp scoring the smith-waterman backend reproduces: BLOSUM62, gaps 11 + k and no composition
+# based statistics. The pipeline's blastp backend keeps blastp's default composition based score
+# adjustment (compBasedStats=None), so on real data its scores differ from smith-waterman's;
+# compBasedStats=0 gives the raw scores the two backends agree on
+def calculate_similarity(ID_i,seq_i,ID_j,seq_j,tmpDir,compBasedStats=None):
+    # query/subject files live in this worker's private scratch dir
+    queryFile = p.join(tmpDir,'query.fasta')
+    subjectFile=p.join(tmpDir,'subject.fasta')
+
     # Write sequences to the input file in FASTA format
     with open(queryFile, 'w') as q, open(subjectFile,'w') as s:
         q.write(f'>{ID_i}\n{seq_i}\n')
         s.write(f'>{ID_j}\n{seq_j}\n')
-    
+
     # Set up the BLAST command
-    blastOutput = NcbiblastpCommandline(cmd='blastp', query=queryFile, subject=subjectFile, outfmt=5)()[0]
+    # one run per pair, far too many to log each - the chunk's record covers them
+    blastCommand=['blastp','-query',queryFile,'-subject',subjectFile,'-outfmt','5']
+    if compBasedStats is not None:
+        blastCommand+=['-matrix','BLOSUM62','-gapopen','11','-gapextend','1','-comp_based_stats',str(compBasedStats)]
+    blastOutput = run_command(blastCommand,check=True,
+                              log=False,stdout=subprocess.PIPE,stderr=subprocess.PIPE,text=True).stdout
     blastRead=NCBIXML.read(StringIO(blastOutput))
-    # Retrieve the score for the overall alignment
-    score = None
+    # Retrieve the score of the first HSP, nan if blast found no alignment
+    score = float("nan")
     for alignment in blastRead.alignments:
-        for hsp in alignment.hsps:
-            score = float(hsp.score)  # Retrieve the score
-            return score
-            break  # Exit the loop after retrieving the first alignment score
-        if score is not None:
-            return float("nan")
-            break  # Exit the loop if a score is retrieved
+        if alignment.hsps:
+            score = float(alignment.hsps[0].score)
+            break
 
     # clean up
     os.remove(queryFile)
     os.remove(subjectFile)
-    
+    return score
 
 ########################################################################################
 def main():
@@ -114,8 +203,10 @@ def main():
     clusterDir="/home/esp/dataset_generation/flavin_dataset/021_post_blast_CD-Hit_results"
     fastaFile=p.join(clusterDir,"output_data_50.fasta")
     os.chdir(clusterDir)
+    set_metrics_file(p.join(clusterDir,"metrics.jsonl"))
     # run functions
-    gen_similarity_matrix(fastaFile=fastaFile,outputName="50percent")
+    with measure("stage","similarity") as metrics:
+        metrics["records"]=gen_similarity_matrix(fastaFile=fastaFile,outputName="50percent")
 ########################################################################################
 # run main (if statement prevents running if this script is imported)
 if __name__ == '__main__':
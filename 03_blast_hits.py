@@ -5,7 +5,15 @@ from os import path as p
 import pandas as pd
 # xml handling
 import xml.etree.ElementTree as ET
-import csv
+import time
+import multiprocessing
+from functools import partial
+# columnar hit store
+import hit_store
+import hit_filters
+import blast_tabular
+# performance records
+from instrumentation import measure, set_metrics_file, open_peak, close_peak, rss_mb
 ################################################################################################################
 # # utilities
 def ifnotmkdir(dir):
@@ -13,76 +21,206 @@ def ifnotmkdir(dir):
         os.mkdir(dir)
     return dir
 
-def makeFasta(enzymeId,sequence):
-    fasta=f'>{enzymeId}\n{sequence}'
-    return fasta
-
 ################################################################################################################
-def xml2csv(xmlFile,outDir):
+# streams the hits of one BLAST xml file as rows in hit_filters.PARSE_SCHEMA order, elements are
+# cleared as soon as they are read so memory stays flat however large the file is
+def iter_blast_xml(xmlFile):
+    iterations=None
+    query_accession=None
+    query_length=None
+    for event, elem in ET.iterparse(xmlFile, events=("start","end")):
+        if event=="start":
+            # keep hold of the parent of all Iterations so finished ones can be dropped
+            if elem.tag=="BlastOutput_iterations":
+                iterations=elem
+            continue
+        if elem.tag=="Iteration_query-def":
+            query_accession = elem.text.split()[0]
+        elif elem.tag=="Iteration_query-len":
+            query_length = elem.text
+        # for each hit, get accession and sequence
+        elif elem.tag=="Hit":
+            alignment_accession = elem.findtext("Hit_accession")
+            alignment_info = elem.findtext("Hit_def").split()[0]
+            # get alignment scores
+            for hsp in elem.iter("Hsp"):
+                hsp_evalue = hsp.findtext("Hsp_evalue")
+                hsp_bitscore = hsp.findtext("Hsp_bit-score")
+                hsp_identity = hsp.findtext("Hsp_identity")
+                alignment_sequence=hsp.findtext("Hsp_hseq")
+                # alignment length and query coordinates, for the identity and coverage filters
+                hsp_align_len = hsp.findtext("Hsp_align-len")
+                hsp_query_from = hsp.findtext("Hsp_query-from")
+                hsp_query_to = hsp.findtext("Hsp_query-to")
+                yield (query_accession, alignment_accession, alignment_info,alignment_sequence, hsp_evalue, hsp_bitscore, hsp_identity,
+                       hsp_align_len, hsp_query_from, hsp_query_to, query_length)
+            elem.clear()
+        elif elem.tag=="Iteration":
+            elem.clear()
+            if iterations is not None:
+                iterations.clear()
+
+# block number of a BLAST_Block_{N}.xml / .tsv file
+def block_number(blastFile):
+    return p.splitext(p.basename(blastFile))[0].split("_")[-1]
+
+# the BLAST file a block was converted from, as recorded in the block's metadata
+def source_info(blastFile):
+    stat=os.stat(blastFile)
+    return {"file":p.abspath(blastFile),"size":stat.st_size,"mtimeNs":stat.st_mtime_ns}
+
+# a block is only reused if it was written from the same, unchanged BLAST file with the same
+# filters (and records its filter counts), otherwise it is rewritten
+def block_is_current(outFile,filters,source):
+    if not p.isfile(outFile):
+        return False
+    metadata=hit_store.block_metadata(outFile)
+    return (metadata is not None and metadata.get("filters")==filters and metadata.get("source")==source
+            and metadata.get("filterCounts") is not None)
+
+# memory of one conversion: peakToken / baselineRss are the open_peak and rss_mb taken as it
+# started. A forked worker inherits the parent's ru_maxrss and keeps its pages resident, so the
+# file's own share is the VmHWM since the start less the RSS it started with
+def parse_stats(blastFile,numRows,counts,startTime,peakToken,baselineRss):
+    runTime=time.time()-startTime
+    peakRss=close_peak(peakToken)
+    return {"file":p.basename(blastFile),"rows":numRows,"seconds":runTime,
+            "rowsPerSec":numRows/runTime if runTime>0 else float("nan"),"peakRssMb":peakRss,
+            "baselineRssMb":baselineRss if baselineRss is not None else 0.0,"filterCounts":counts}
+
+# converts one BLAST xml file into a block of the hit store, keeping only hits that pass the filters
+# Returns rows written, time, peak RSS and the hits in / out of each filter, which are also kept
+# in the block's metadata
+def xml2parquet(xmlFile,storeDir,filters=None):
+    filters=hit_filters.resolve_filters(filters)
+    blockNum=block_number(xmlFile)
+    outFile=hit_store.block_file(storeDir,blockNum)
+    source=source_info(xmlFile)
+    if block_is_current(outFile,filters,source):
+        return None
+    print(f"-->\t Writing {outFile}")
+    startTime=time.time()
+    baselineRss=rss_mb()
+    peakToken=open_peak()
+    countLists=[]
+    metadata={"filters":filters,"source":source,"filterCounts":None}
+    # filtered a batch at a time, so the rejected rows are never held or written. The counts are
+    # complete once the last batch is out, before the block's metadata is written
+    def filtered_tables():
+        for table in hit_store.batch_tables(iter_blast_xml(xmlFile),hit_filters.PARSE_SCHEMA):
+            hitTable,counts=hit_filters.filter_table(table,filters)
+            countLists.append(counts)
+            yield hitTable
+        metadata["filterCounts"]=hit_filters.merge_counts(countLists)
+    numRows=hit_store.write_tables(filtered_tables(),storeDir,blockNum,metadata)
+    return parse_stats(xmlFile,numRows,metadata["filterCounts"],startTime,peakToken,baselineRss)
 
-    # Parse the XML file
-    tree = ET.parse(xmlFile)
-    root = tree.getroot()   
-    blockNum=p.splitext(p.basename(xmlFile))[0].split("_")[-1]
-    outFile=p.join(outDir,f"blast_result_{blockNum}.csv")
-    if p.isfile(outFile):
-        return
+# converts one tabular (outfmt 7) BLAST file into a block of the hit store, same filters and stats as xml2parquet
+def tabular2parquet(tabFile,storeDir,filters=None):
+    filters=hit_filters.resolve_filters(filters)
+    blockNum=block_number(tabFile)
+    outFile=hit_store.block_file(storeDir,blockNum)
+    source=source_info(tabFile)
+    if block_is_current(outFile,filters,source):
+        return None
     print(f"-->\t Writing {outFile}")
-    # Open the CSV file for writing
-    with open(outFile, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile)    
-        # Write the header row
-        writer.writerow(["Query Accession", "Alignment Accession", "Alignment Info","Alignment Sequence", "HSP E-value", "HSP Bit Score", "HSP Identity"])   
-        # Iterate over the XML data and extract the required information
-        for query in root.findall(".//Iteration"):
-            query_accession = query.find("Iteration_query-def").text.split()[0] 
-            # for each hit, get accession and sequence
-            for hit in query.findall(".//Hit"):
-                alignment_accession = hit.find("Hit_accession").text
-                alignment_info = hit.find("Hit_def").text.split()[0]    
-                # get alignment scores
-                for hsp in hit.findall(".//Hsp"):
-                    hsp_evalue = hsp.find("Hsp_evalue").text
-                    hsp_bitscore = hsp.find("Hsp_bit-score").text
-                    hsp_identity = hsp.find("Hsp_identity").text    
-                    alignment_sequence=hsp.find("Hsp_hseq").text
+    startTime=time.time()
+    baselineRss=rss_mb()
+    peakToken=open_peak()
+    hitTable,counts=hit_filters.filter_table(blast_tabular.to_parse_table(blast_tabular.read_tabular(tabFile)),filters)
+    numRows=hit_store.write_table_block(hitTable,storeDir,blockNum,{"filters":filters,"source":source,"filterCounts":counts})
+    return parse_stats(tabFile,numRows,counts,startTime,peakToken,baselineRss)
 
+# picks the converter from the file extension, so xml and tabular blocks can be mixed (each
+# block number in one format only, see blast_files)
+def blast2parquet(blastFile,storeDir,filters=None):
+    with measure("unit","blast_to_parquet",file=p.basename(blastFile)) as metrics:
+        if p.splitext(blastFile)[1]==".xml":
+            stats=xml2parquet(blastFile,storeDir,filters)
+        else:
+            stats=tabular2parquet(blastFile,storeDir,filters)
+        # None when the block was already in the store
+        metrics["skipped"]=stats is None
+        metrics["records"]=0 if stats is None else stats["rows"]
+        if stats is not None:
+            metrics["filterCounts"]=stats["filterCounts"]
+    return stats
+
+# the xml / tabular files of blastResultsDir. Both formats of one block would be written to the
+# same hits_block_{N}.parquet, so a block number found in both is refused
+def blast_files(blastResultsDir):
+    blastFiles=sorted(p.join(blastResultsDir,file) for file in os.listdir(blastResultsDir)
+                      if p.splitext(file)[1] in [".xml",".tsv"])
+    byBlock={}
+    for blastFile in blastFiles:
+        byBlock.setdefault(block_number(blastFile),[]).append(p.basename(blastFile))
+    clashes=[files for files in byBlock.values() if len(files)>1]
+    if clashes:
+        raise ValueError(f"{blastResultsDir} holds blocks in both formats, remove one of each: {clashes[:5]}")
+    return blastFiles
 
-                    # Write the row to the CSV file
-                    writer.writerow([query_accession, alignment_accession, alignment_info,alignment_sequence, hsp_evalue, hsp_bitscore, hsp_identity])
 ################################################################################################################
 ## main function
-def main():
-    blastResultsDir="/home/esp/dataset_generation/flavin_dataset/02_BLAST/blast_results"
-    csvDir=ifnotmkdir("/home/esp/dataset_generation/flavin_dataset/02_BLAST/blast_csv_files")
-    excelDir="/home/esp/dataset_generation/flavin_dataset/00_Excel_and_Fasta/03_post_BLAST"
-    inputFasta="/home/esp/dataset_generation/flavin_dataset/01_initial_CD-Hit_results/data50fasta.fasta"
+# converts every blast output file in blastResultsDir into the parquet hit store, keeping only the hits
+# that pass filters (see hit_filters.DEFAULT_FILTERS), then writes the non-redundant hits (with a
+# FASTA column) to nonRedundantFile. Returns the non-redundant hits and the hits in / out of each step
+def build_hit_store(blastResultsDir,hitStoreDir,nonRedundantFile,exportExcel=False,filters=None):
+    filters=hit_filters.resolve_filters(filters)
+    hitStoreDir=ifnotmkdir(hitStoreDir)
+    outDir=p.dirname(nonRedundantFile)
+    #convert xml / tabular output to parquet blocks, one file per worker - maxtasksperchild=1 gives each file a fresh
+    # process, so memory one file leaves behind doesn't add to the next file's peak RSS
+    blastFiles=blast_files(blastResultsDir)
+    # blocks whose BLAST file is gone (an earlier, larger run) would still be read with the rest
+    blockNums={block_number(blastFile) for blastFile in blastFiles}
+    for blockNum,blockFile in hit_store.store_blocks(hitStoreDir).items():
+        if blockNum not in blockNums:
+            print(f"-->\t Removing {blockFile}, no BLAST file for it")
+            os.remove(blockFile)
+    num_cpus=os.cpu_count()
+    with multiprocessing.Pool(processes=num_cpus,maxtasksperchild=1) as pool:
+        for stats in pool.imap_unordered(partial(blast2parquet,storeDir=hitStoreDir,filters=filters),blastFiles):
+            if stats is None:
+                continue
+            print(f"-->\t {stats['file']}: {stats['rows']} rows in {stats['seconds']:.1f} s "
+                  f"({stats['rowsPerSec']:.0f} rows/s), peak RSS {stats['peakRssMb']-stats['baselineRssMb']:.0f} MB over the "
+                  f"{stats['baselineRssMb']:.0f} MB the worker started with")
+    # counts of every block, converted in this run or reused, from the blocks' metadata
+    filterCounts=hit_filters.merge_counts(hit_store.block_metadata(blockFile)["filterCounts"]
+                                          for blockFile in hit_store.store_blocks(hitStoreDir).values())
+    hit_filters.print_counts(filterCounts)
 
-    #convert xml to csv
-    for file in os.listdir(blastResultsDir):
-        if not p.splitext(file)[1]==".xml":
-              continue
-        xmlFile=p.join(blastResultsDir,file)
-        xml2csv(xmlFile,csvDir)
-    # make a dataframe from results
-    dfs=[]
-    for csvFile in os.listdir(csvDir):
-        csvFile=p.join(csvDir,csvFile)
-        df=pd.read_csv(csvFile)
-        dfs.append(df)
-    blastDf=pd.concat(dfs,ignore_index=True)
+    # the store is the fully redundant dataset, excel copy only on request
+    if exportExcel:
+        redundantDataSet=p.join(outDir,"fully_redundant_post-BLAST.xlsx")
+        hit_store.export_excel(hit_store.read_hits(hitStoreDir),redundantDataSet)
+    # make a non-redundant dataframe, reading only the columns it needs
+    blastDf=hit_store.read_hits(hitStoreDir,columns=["Alignment Accession","Alignment Info","Alignment Sequence",
+                                                     "HSP E-value","HSP Bit Score","HSP Identity"])
+    # dedupe on a 64 bit hash of "Alignment Info" rather than the strings themselves
+    numHits=len(blastDf)
+    infoHash=pd.util.hash_pandas_object(blastDf["Alignment Info"],index=False)
+    blastDf=blastDf[~infoHash.duplicated().to_numpy()].reset_index(drop=True)
+    filterCounts.append({"filter":"dedup","threshold":"Alignment Info","in":numHits,"out":len(blastDf)})
+    hit_filters.print_counts(filterCounts[-1:])
+    blastDf["FASTA"]=">"+blastDf["Alignment Accession"]+"\n"+blastDf["Alignment Sequence"]
+    # write a non-redundant dataset
+    blastDf.to_parquet(nonRedundantFile,index=False)
+    if exportExcel:
+        hit_store.export_excel(blastDf,p.splitext(nonRedundantFile)[0]+".xlsx")
+    return blastDf, filterCounts
 
-    redundantDataSet=p.join(excelDir,"fully_redundant_post-BLAST.xlsx")
-    if not p.isfile(redundantDataSet):
-        blastDf.to_excel(redundantDataSet,index=False)
-    # write fully redundant dataframe to xlsx file
-    blastDf=blastDf.drop_duplicates(subset="Alignment Info")
-    blastDf["FASTA"] = blastDf.apply(lambda row:makeFasta(row["Alignment Accession"],row['Alignment Sequence']),axis=1)
-    # write a non-redundant dataset 
-    nonRedundantDataSet=p.join(excelDir,"non_redundant_post-BLAST.xlsx")
-    if not p.isfile(nonRedundantDataSet):
-        blastDf.to_excel(nonRedundantDataSet,index=False)
-###########################S#####################################################################################
+def main(exportExcel=False):
+    blastResultsDir="/home/esp/dataset_generation/flavin_dataset/02_BLAST/blast_results"
+    hitStoreDir="/home/esp/dataset_generation/flavin_dataset/02_BLAST/blast_hit_store"
+    excelDir="/home/esp/dataset_generation/flavin_dataset/00_Excel_and_Fasta/03_post_BLAST"
+    set_metrics_file(p.join(excelDir,"metrics.jsonl"))
+    with measure("stage","parse_hits") as metrics:
+        blastDf,filterCounts=build_hit_store(blastResultsDir,hitStoreDir,p.join(excelDir,"non_redundant_post-BLAST.parquet"),
+                                             exportExcel)
+        metrics["records"]=len(blastDf)
+        metrics["filterCounts"]=filterCounts
+################################################################################################################
 # run main (if statement prevents running if this script is imported)
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -25,11 +25,18 @@ import sys
 import os
 from os import path as p
 import time
+import json
+import hashlib
 # Import multiprocessing for paralell CPUs
 import multiprocessing
-# Import commandline functions from NCBI
-from Bio.Blast.Applications import NcbiblastpCommandline
+import subprocess
 from Bio.Blast import NCBIXML
+# tabular output columns and reader
+from blast_tabular import OUTFMT, tabular_is_complete
+# shared fasta reader / index
+from fasta_index import FastaIndex
+# performance records
+from instrumentation import measure, run_command, set_metrics_file
 ################################################################################################################
 ## utilities
 # basic dir creation with a check
@@ -37,161 +44,291 @@ def ifnotmkdir(dir):
     if not p.isdir(dir):
         os.mkdir(dir)
     return dir
-# basic file creation with a check
-def ifnotmkfile(file):
-    if not p.isfile(file):
-        open(file,"w").close()
-    return file
-# split fasta file into blocks of n - makes a new fasta file for each of these blocks in ./fasta_blocks
-def splitFasta(mainDir,fastaFile,blockSize):
-    fastaBlockDir=ifnotmkdir(p.join(mainDir,"fasta_blocks"))
-    blocks=[]
-
-    tmpFasta=''
-    with open(fastaFile,'r') as f:
-        for line in f:
-            if line.startswith('>') and tmpFasta=='':
-                tmpFasta=line
-            elif line.startswith('>'):
-                blocks.append(tmpFasta)
-                tmpFasta=line
-            else:
-                tmpFasta+=line
-        blocks.append(tmpFasta)
-    blockNum=0
-    for block in blocks:
-        blockNum+=1
-        with open(p.join(fastaBlockDir,f"fasta_block_{blockNum}.fasta"),"w") as outFile:
-            outFile.write(block)
-    numBlocks=len(blocks)
-    return fastaBlockDir, numBlocks
-# converts fasta file (result of cdhit clustering) to list of fasta
-def fastaFileToList(mainDir,fastaFile,blockSize):
-    fastaList=[]
-    fastaTmp=''
-    with open(fastaFile,'r') as f:
+# packs the query fasta into blocks by total residue count instead of sequence count, so every
+# block costs roughly the same. Returns blockNum -> accessions, block 1 has the most residues
+def packFastaByResidues(fastaIndex,residuesPerBlock):
+    blocks=fastaIndex.blocks_by_residues(residuesPerBlock)
+    return {blockNum:block for blockNum,block in enumerate(blocks,start=1)}
+
+# splits the machine between pool workers and blastp threads - one thread per job while there
+# are more blocks than cores, more threads per job (up to maxThreads) once blocks run out
+def split_cores(totalCores,numTasks,maxThreads=4):
+    numTasks=max(numTasks,1)
+    numThreads=max(1,min(maxThreads,totalCores//numTasks))
+    numWorkers=max(1,min(numTasks,totalCores//numThreads))
+    return numWorkers, numThreads
+
+# files of a protein database volume that blastp memory-maps: index, sequences and headers
+VOLUME_EXTENSIONS=[".pin",".psq",".phr"]
+
+# volumes of a database, read from its .pal alias file (DBLIST line, paths relative to the
+# alias) for multi-volume databases such as nr, or the database itself for a single volume
+def database_volumes(database):
+    aliasFile=database+".pal"
+    if not p.isfile(aliasFile):
+        return [database]
+    volumes=[]
+    with open(aliasFile,"r") as f:
         for line in f:
-            if line.startswith(">"):
-                fastaTmp=line
-            else:
-                fastaTmp+=line
-                fastaList.append(fastaTmp)
-    blocks=[]       
-    numBlocks= len(fastaList) // blockSize
-    remainder= len(fastaList) % blockSize
-    for i in range(numBlocks):
-        block = ''.join(fastaList[i * blockSize : (i + 1) * blockSize])
-        blocks.append(block)
-    if remainder > 0:
-        block = ''.join(fastaList[numBlocks*blockSize :])
-        blocks.append(block)
-
-    fastaBlockDir=ifnotmkdir(p.join(mainDir,"fasta_blocks"))
-    blockNum=0
-    for block in blocks:
-        blockNum+=1
-        with open(p.join(fastaBlockDir,f"fasta_block_{blockNum}.fasta"),"w") as outFile:
-            outFile.write(block)
-    numBlocks=len(blocks)
-    return fastaBlockDir, numBlocks
-
-# basic stopwatch
-def stopwatch(command,timeLogFile=None,comment=None,startTime=None):
-    if command=="START":
-        startTime=time.time()
-        return startTime
-    elif command=="STOP":
-        stopTime=time.time()
-        executionTime=stopTime-startTime
-        # format nicely
-        minutes,seconds=divmod(executionTime,60)
-        hours,minutes=divmod(minutes,60)
-        executionTime="%02d:%02d:%02d" % (hours, minutes, seconds)
-        #write to file
-        with open(timeLogFile,"a") as f:
-            f.write('{} {}\n'.format(comment,executionTime))
+            if line.startswith("DBLIST"):
+                for volume in line.split()[1:]:
+                    volume=p.join(p.dirname(database),volume.strip('"'))
+                    # an alias may list other aliases
+                    volumes.extend(database_volumes(volume) if volume!=database else [volume])
+    return volumes
+
+def database_files(database):
+    return [volume+extension for volume in database_volumes(database) for extension in VOLUME_EXTENSIONS
+            if p.isfile(volume+extension)]
+
+# blastp memory-maps the database, reading every volume once puts it in the page cache where
+# all concurrent blastp processes share it instead of each faulting it in from disk
+def warm_database(database):
+    numBytes=0
+    for dbFile in database_files(database):
+        with open(dbFile,"rb") as f:
+            while True:
+                chunk=f.read(16*1024*1024)
+                if not chunk:
+                    break
+                numBytes+=len(chunk)
+    print(f'Loaded {numBytes/1024**3:.1f} GB of database files into the page cache')
+
 ################################################################################################################
-def run_blast_local(outDir,databaseDir,fasta,count):
-    # start stopwatch
-    startTime=stopwatch("START",None,None,None)
-    # run qBLAST search on local nr database, write result to xml file
-    outFile = p.join(outDir,f"BLAST_Block_{count}.xml")
+# queryFasta is the block's fasta text, piped to blastp on stdin so no block files are written
+# outputFormat is "xml" (outfmt 5) or "tabular" (outfmt 7 with the columns in blast_tabular.py)
+def run_blast_local(outDir,databaseDir,queryFasta,count,numThreads=1,outputFormat="xml"):
+    # run qBLAST search on local nr database, write result to xml / tsv file
+    outFile = block_output_file(outDir,count,outputFormat)
     errFile = p.join(outDir,f"Errors_Block_{count}.txt")
     print(f'Running BLAST for batch {count}')
-    blastCommand=NcbiblastpCommandline(cmd="blastp",query=fasta, db=databaseDir, out=outFile,  outfmt=5)
-    stdout, stderr = blastCommand()
+    blastCommand=["blastp","-query","-","-db",databaseDir,"-out",outFile,
+                  "-outfmt","5" if outputFormat=="xml" else OUTFMT,"-num_threads",str(numThreads)]
+    result=run_command(blastCommand,input=queryFasta,text=True,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
 
     with open(errFile,"w") as f:
-        f.write(stderr)
+        f.write(result.stderr)
+    if result.returncode!=0:
+        raise subprocess.CalledProcessError(result.returncode,blastCommand,result.stdout,result.stderr)
     print(f'Completed BLAST for batch {count}')
 
-    # stop stopwatch, write to file
-    timeLogFile=ifnotmkfile(p.join(outDir,"times_report.log"))
-    comment=f'Local BLAST for batch {count}:\t'
-    stopwatch("STOP",startTime,timeLogFile,comment)
+################################################################################################################
+## job ledger - one json file recording the state of every block, so restarts skip finished blocks
+def block_output_file(outDir,count,outputFormat):
+    extension="xml" if outputFormat=="xml" else "tsv"
+    return p.join(outDir,f"BLAST_Block_{count}.{extension}")
+
+# every output a block may have left behind, in either format
+def block_files(outDir,count):
+    return [block_output_file(outDir,count,"xml"),block_output_file(outDir,count,"tabular"),
+            p.join(outDir,f"Errors_Block_{count}.txt")]
+
+def remove_block_files(outDir,count):
+    for blockFile in block_files(outDir,count):
+        if p.isfile(blockFile):
+            os.remove(blockFile)
+
+# sha256 of the block's fasta records, a block is only reused for the same sequences
+def block_digest(fastaIndex,accessions):
+    return hashlib.sha256(fastaIndex.block_bytes(accessions)).hexdigest()
+
+def output_is_complete(outFile,outputFormat):
+    if outputFormat=="xml":
+        return xml_is_complete(outFile)
+    return tabular_is_complete(outFile)
+
+# checks that a BLAST xml file was written to the end
+def xml_is_complete(xmlFile):
+    if not p.isfile(xmlFile):
+        return False
+    with open(xmlFile,"rb") as f:
+        f.seek(0,os.SEEK_END)
+        f.seek(max(0,f.tell()-256))
+        return f.read().rstrip().endswith(b"</BlastOutput>")
+
+def load_ledger(ledgerFile):
+    if not p.isfile(ledgerFile):
+        return {}
+    with open(ledgerFile,"r") as f:
+        return json.load(f)
+
+# ledger is rewritten through a temporary file so a crash never leaves it half written
+def save_ledger(ledger,ledgerFile):
+    tmpFile=ledgerFile+".tmp"
+    with open(tmpFile,"w") as f:
+        json.dump(ledger,f,indent=1)
+    os.replace(tmpFile,ledgerFile)
+
+# each pool worker maps the query fasta once, blocks are then sliced out of it by accession
+workerIndex=None
+
+def init_worker(fastaFile):
+    global workerIndex
+    workerIndex=FastaIndex(fastaFile)
+
+# runs one block, retrying failures with exponential backoff. Returns the block's ledger record
+def run_block_with_retries(outDir,databaseDir,count,accessions,numThreads=1,outputFormat="xml",maxAttempts=3,backoff=60):
+    outFile = block_output_file(outDir,count,outputFormat)
+    queryFasta = bytes(workerIndex.block_bytes(accessions)).decode()
+    startTime=time.time()
+    with measure("unit","blast_block",block=count,records=len(accessions),numThreads=numThreads) as metrics:
+        for attempt in range(1,maxAttempts+1):
+            try:
+                run_blast_local(outDir,databaseDir,queryFasta,count,numThreads,outputFormat)
+                exitStatus=0
+                error=None
+            except subprocess.CalledProcessError as e:
+                exitStatus=e.returncode
+                error=e.stderr.strip()[-500:] if e.stderr else str(e)
+            except Exception as e:
+                exitStatus=None
+                error=repr(e)
+            if exitStatus==0 and not output_is_complete(outFile,outputFormat):
+                error=f"{outFile} is incomplete"
+            if error is None:
+                state="done"
+                break
+            state="failed"
+            print(f'BLAST for batch {count} failed (attempt {attempt}/{maxAttempts}): {error}')
+            if attempt<maxAttempts:
+                time.sleep(backoff*2**(attempt-1))
+        metrics.update({"residues":sum(workerIndex.length(accession) for accession in accessions),
+                        "attempts":attempt,"ok":state=="done"})
+    return {"block":count,"state":state,"attempts":attempt,"exitStatus":exitStatus,"error":error,
+            "numThreads":numThreads,"runtime":time.time()-startTime,"finished":time.strftime("%Y-%m-%d %H:%M:%S")}
+
+# wrapper so the pool can pass a single tuple
+def run_block_task(task):
+    return run_block_with_retries(*task)
+
+# format seconds as hh:mm:ss
+def format_seconds(seconds):
+    minutes,seconds=divmod(int(seconds),60)
+    hours,minutes=divmod(minutes,60)
+    return "%02d:%02d:%02d" % (hours, minutes, seconds)
+
+# seconds per residue from finished blocks in the ledger, used to predict block runtimes
+def calibrate_cost(ledger):
+    residues=sum(r["residues"] for r in ledger.values() if r.get("state")=="done" and r.get("residues"))
+    seconds=sum(r["runtime"]*r["numThreads"] for r in ledger.values()
+                if r.get("state")=="done" and r.get("residues"))
+    if residues==0:
+        return None
+    return seconds/residues
+
+# runs every block not already marked done (with a complete xml) in the ledger. A block is only
+# reused if its sequences have the digest recorded in the ledger, otherwise its old output is
+# deleted and it runs again. Blocks are dispatched most residues first, and the cores are split
+# between workers and blastp threads
+def run_blocks(blastDir,database,fastaIndex,blocks,totalCores,maxAttempts=3,backoff=60,maxThreads=4,
+               outputFormat="xml",warmDatabase=False):
+    residuesByBlock={blockNum:sum(fastaIndex.length(accession) for accession in block)
+                     for blockNum,block in blocks.items()}
+    digestByBlock={blockNum:block_digest(fastaIndex,block) for blockNum,block in blocks.items()}
+    ledgerFile=p.join(blastDir,"blast_ledger.json")
+    ledger=load_ledger(ledgerFile)
+    # blocks of an earlier, larger split of the fasta would otherwise be parsed with the new ones
+    for blockKey in [blockKey for blockKey in ledger if int(blockKey) not in blocks]:
+        remove_block_files(blastDir,blockKey)
+        del ledger[blockKey]
+    todo=[]
+    for blockNum in residuesByBlock:
+        record=ledger.get(str(blockNum),{})
+        outFile=block_output_file(blastDir,blockNum,outputFormat)
+        if (record.get("state")=="done" and record.get("digest")==digestByBlock[blockNum]
+                and output_is_complete(outFile,outputFormat)):
+            continue
+        # a stale result (other sequences or the other output format) must not outlive the rerun
+        remove_block_files(blastDir,blockNum)
+        ledger[str(blockNum)]={"block":blockNum,"state":"pending","residues":residuesByBlock[blockNum],
+                               "digest":digestByBlock[blockNum]}
+        todo.append(blockNum)
+    save_ledger(ledger,ledgerFile)
+    print(f'{len(residuesByBlock)-len(todo)} blocks already done, {len(todo)} to run')
+    # share the database between blastp processes through the page cache, only worth the read
+    # when there are blocks to run and the database fits in memory
+    if warmDatabase and todo:
+        warm_database(database)
+
+    # longest blocks first so the big ones don't straggle at the end of the pool
+    todo.sort(key=lambda blockNum:residuesByBlock[blockNum],reverse=True)
+    numWorkers,numThreads=split_cores(totalCores,len(todo),maxThreads)
+    print(f'{numWorkers} workers x {numThreads} blastp threads')
+    tasks=[(blastDir,database,blockNum,blocks[blockNum],
+            numThreads,outputFormat,maxAttempts,backoff) for blockNum in todo]
+
+    # run blast search for all remaining blocks - this will make xml / tsv files in blastDir
+    startTime=time.time()
+    numDone=0
+    numFailed=0
+    # chunksize=1 hands tasks out one at a time, in the longest-first order
+    with multiprocessing.Pool(processes=numWorkers,initializer=init_worker,
+                              initargs=(fastaIndex.fastaFile,)) as pool:
+        for record in pool.imap_unordered(run_block_task,tasks,chunksize=1):
+            secondsPerResidue=calibrate_cost(ledger)
+            residues=residuesByBlock[record["block"]]
+            record["residues"]=residues
+            record["digest"]=digestByBlock[record["block"]]
+            record["predictedRuntime"]=None if secondsPerResidue is None else secondsPerResidue*residues/numThreads
+            ledger[str(record["block"])]=record
+            save_ledger(ledger,ledgerFile)
+            numDone+=1
+            if record["state"]=="failed":
+                numFailed+=1
+            elapsed=time.time()-startTime
+            eta=elapsed/numDone*(len(tasks)-numDone)
+            predicted="n/a" if record["predictedRuntime"] is None else format_seconds(record["predictedRuntime"])
+            print(f'[{numDone}/{len(tasks)}] block {record["block"]} ({residues} residues) {record["state"]} '
+                  f'in {format_seconds(record["runtime"])} (predicted {predicted}), {numFailed} failed, '
+                  f'elapsed {format_seconds(elapsed)}, ETA {format_seconds(eta)}')
+    return ledger
 
 ################################################################################################################
-# parses results of run_BLAST
+# parses xml results of run_BLAST, one row per HSP
 def parse_BLAST_result(xmlFile):
         # initialse empty masterlist
         hitsList=[]
-        # open and parse output xml file from NCBIWWW search 
-        result_handle=open(xmlFile,'r')
-        blast_records=NCBIXML.parse(result_handle,debug=0)     
-        # extract desired info from each hit   
-        for blast_record in blast_records:
-            query_id=blast_record.query_id
-            for alignment in blast_record.alignments:
-                # new empty temp list
-                hitList=[]
-                for hsp in alignment.hsps:
-                    alignment_length = alignment.length         
-                    hsp_evalue = hsp.expect
-                    hsp_bitscore = hsp.bits
-                    hsp_identity = hsp.identities
-                    alignment_accession=alignment.accession
-                    hsp_sequence=hsp.spjct
-                # collect info into the temp list
-                hitList=','.join([query_id,alignment_accession,hsp_sequence,alignment_length,hsp_evalue,hsp_bitscore,hsp_identity])
-            # append to master list
-            hitsList.append(hitList)
+        # open and parse output xml file from NCBIWWW search
+        with open(xmlFile,'r') as result_handle:
+            blast_records=NCBIXML.parse(result_handle,debug=0)
+            # extract desired info from each hsp of each hit
+            for blast_record in blast_records:
+                query_id=blast_record.query_id
+                for alignment in blast_record.alignments:
+                    for hsp in alignment.hsps:
+                        hitsList.append([query_id,alignment.accession,hsp.sbjct,alignment.length,
+                                         hsp.expect,hsp.bits,hsp.identities])
         #r output master list
         return hitsList
 ################################################################################################################  
 # main function to run
+# blasts every sequence of a fasta file against the database, results go to blastDir
+def blast_fasta(fastaFile,database,blastDir,residuesPerBlock=2000,totalCores=15,outputFormat="xml",warmDatabase=False):
+    # pack sequences into blocks of roughly equal residue count
+    fastaIndex=FastaIndex(fastaFile)
+    blocks=packFastaByResidues(fastaIndex,residuesPerBlock)
+    print(f'{len(blocks)} blocks of up to {residuesPerBlock} residues')
+    # new dir for results
+    blastDir=ifnotmkdir(blastDir)
+    print(f'Output Directory made at:\t{blastDir}')
+
+    # split the cores between workers and blastp threads, run every block that is not done yet
+    return run_blocks(blastDir,database,fastaIndex,blocks,totalCores,outputFormat=outputFormat,
+                      warmDatabase=warmDatabase)
+
 def main():
     # database directory
     database="/scratch/non_redundant_protein_database/nr_db"
     #load file
     clusterFile="data50fasta.fasta"
-    # convert to list of fasta seqs
-    blockSize=5
-    fastaBlockDir,numBlocks=fastaFileToList(os.getcwd(),clusterFile,blockSize)
-    print(f'{numBlocks} blocks of {blockSize} fasta sequences')
-    # new dir for results
+    # "xml" (outfmt 5) or "tabular" (outfmt 7, far smaller and faster to parse)
+    outputFormat = "xml"
     blastDir=ifnotmkdir("./blast_results")
-    if p.isdir(blastDir):
-        print(f'Output Directory made at:\t{blastDir}')
-    else:
-        print("No Output Directory made: Exiting!")
-        exit
-
-    inputData=[]
-    for blockNum in range(1,numBlocks):
-        blockFile=p.join(fastaBlockDir,f"fasta_block_{blockNum}.fasta")
-        if p.isfile(blockFile):
-            inputData.append((blastDir,database,blockFile,blockNum))
-
-    # Create a pool of 16 worker processes
-    num_cpus = 15
-    pool = multiprocessing.Pool(processes=num_cpus)
-    # run blast search for all sequences in list - this will make xml files in blastDir
-    for blockNum in range(1,numBlocks):
-        blockFile=p.join(fastaBlockDir,f"fasta_block_{blockNum}.fasta")
-        pool.apply_async(run_blast_local,(blastDir,database,blockFile,blockNum))
-    # Close the pool and wait for all processes to complete
-    pool.close()
-    pool.join()
+    set_metrics_file(p.join(blastDir,"metrics.jsonl"))
+    with measure("stage","local_blast") as metrics:
+        ledger=blast_fasta(clusterFile,database,blastDir,residuesPerBlock=2000,totalCores=15,outputFormat=outputFormat)
+        metrics["records"]=len(FastaIndex(clusterFile))
+        metrics["ok"]=all(record["state"]=="done" for record in ledger.values())
 ###########################S#####################################################################################
 
 # run main (if statement prevents running if this script is imported)
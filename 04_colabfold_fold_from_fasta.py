@@ -1,7 +1,11 @@
 # import libraries
 import os
 from os import path as p
-from subprocess import call
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fasta_index import iter_fasta, format_record
+# performance records
+from instrumentation import measure, run_command, set_metrics_file
 
 ## 
 # utilities
@@ -9,20 +13,47 @@ def ifnotmkdir(dir):
     if not p.isdir(dir):
         os.mkdir(dir)
     return dir
-##
-def split_fasta_to_dirs(fastaFile,inputDir):
-    fastaList=[]
-    with open(fastaFile,"r") as f:
-        for line in f:
-            if line.startswith(">"):
-                enzName=line.strip("\n")[1:]
-                accessionLine=line
-            else:
-                sequenceLine=line
-                fastaDir=ifnotmkdir(p.join(inputDir,enzName))
-                outputFasta=p.join(fastaDir,f"{enzName}.fasta")
-                with open(outputFasta,"w") as outFasta:
-                    outFasta.write(accessionLine+sequenceLine)
+
+# colabfold names each job after its fasta header, with unsafe characters replaced
+def colabfold_jobname(header):
+    return "".join(c if c.isalnum() or c in ["_",".","-"] else "_" for c in header)
+
+# colabfold_batch writes {jobname}.done.txt into the output dir once a query is finished
+def is_prediction_done(predictionsDir,jobname):
+    return p.isfile(p.join(predictionsDir,f"{jobname}.done.txt"))
+########################################################################################
+# groups the sequences still to predict into length buckets, then into batches of at most
+# batchSize sequences. Batches are returned longest bucket first
+def make_batches(inputFasta,predictionsDir,bucketEdges,batchSize):
+    buckets={}
+    numDone=0
+    for header,sequence in iter_fasta(inputFasta):
+        if is_prediction_done(predictionsDir,colabfold_jobname(header)):
+            numDone+=1
+            continue
+        # first edge the sequence fits under, sequences longer than every edge share the last bucket
+        bucket=next((edge for edge in bucketEdges if len(sequence)<=edge),None)
+        buckets.setdefault(bucket,[]).append((header,sequence))
+    batches=[]
+    for bucket in sorted(buckets,key=lambda edge:float("inf") if edge is None else edge,reverse=True):
+        records=sorted(buckets[bucket],key=lambda record:len(record[1]),reverse=True)
+        for start in range(0,len(records),batchSize):
+            batches.append((bucket,records[start:start+batchSize]))
+    return batches, numDone
+
+# writes one batch as a multi-record fasta and runs colabfold_batch on it
+def run_batch(batchFasta,records,predictionsDir,colabfoldArgs):
+    with open(batchFasta,"w") as f:
+        for header,sequence in records:
+            f.write(format_record(header,sequence))
+    startTime=time.time()
+    command=["colabfold_batch",*colabfoldArgs,batchFasta,predictionsDir]
+    # batches run on threads, CPU time of the unit is the whole process' and it records no peak
+    # RSS - the command record holds colabfold_batch's own
+    with measure("unit","colabfold_batch",batch=p.basename(batchFasta),records=len(records)) as metrics:
+        exitStatus=run_command(command).returncode
+        metrics["ok"]=exitStatus==0
+    return exitStatus, time.time()-startTime
 ########################################################################################
 def inputs():
     inputFasta="/home/eugene/AlphaFold/known_photoenzymes_for_folding.fasta"
@@ -31,29 +62,43 @@ def inputs():
 
     return inputFasta, inputDir, predictionsDir
 ########################################################################################
-def main():
-    inputFasta, inputDir, predictionsDir = inputs()
+# runs one colabfold_batch per length bucket batch, so model loading and JAX compilation are
+# paid once per batch rather than once per protein. Finished predictions are skipped on re-runs
+# returns the number of sequences still without a prediction
+def fold_fasta(inputFasta,inputDir,predictionsDir,numWorkers=1,batchSize=50,
+               bucketEdges=(200,400,600,800,1000,1500,2500),colabfoldArgs=()):
     inputDir=ifnotmkdir(inputDir)
     predictionsDir=ifnotmkdir(predictionsDir)
-    split_fasta_to_dirs(inputFasta,inputDir)
-
-    fastaDirs=os.listdir(inputDir)
-    for enzymeName in fastaDirs:
-         # check output dir
-        if p.isdir(p.join(predictionsDir,enzymeName)):
-            continue
-
-        fastaDir=p.join(inputDir,enzymeName)
-        outputDir=ifnotmkdir(p.join(predictionsDir,enzymeName))
 
+    batches,numDone=make_batches(inputFasta,predictionsDir,bucketEdges,batchSize)
+    numPending=sum(len(records) for _,records in batches)
+    print(f"{numDone} predictions already done, {numPending} sequences in {len(batches)} batches")
 
-        command= ["colabfold_batch",fastaDir,outputDir]
-        call(command)
-
+    numMissing=0
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        futures={}
+        for batchNum,(bucket,records) in enumerate(batches,start=1):
+            bucketName="longer" if bucket is None else f"upto_{bucket}"
+            batchFasta=p.join(inputDir,f"batch_{batchNum}_{bucketName}.fasta")
+            future=executor.submit(run_batch,batchFasta,records,predictionsDir,colabfoldArgs)
+            futures[future]=(batchNum,records)
+        for future in as_completed(futures):
+            batchNum,records=futures[future]
+            exitStatus,runTime=future.result()
+            numFinished=sum(is_prediction_done(predictionsDir,colabfold_jobname(header)) for header,_ in records)
+            numMissing+=len(records)-numFinished
+            print(f"batch {batchNum}: {numFinished}/{len(records)} predictions done, "
+                  f"exit status {exitStatus}, {runTime:.0f} s")
+    return numMissing
 
+def main(numWorkers=1,batchSize=50,bucketEdges=(200,400,600,800,1000,1500,2500),colabfoldArgs=()):
+    inputFasta, inputDir, predictionsDir = inputs()
+    set_metrics_file(p.join(ifnotmkdir(predictionsDir),"metrics.jsonl"))
+    with measure("stage","folding",workers=numWorkers) as metrics:
+        numMissing=fold_fasta(inputFasta,inputDir,predictionsDir,numWorkers,batchSize,bucketEdges,colabfoldArgs)
+        metrics["ok"]=numMissing==0
 
 ########################################################################################
 # run main (if statement prevents running if this script is imported)
 if __name__ == '__main__':
     main()
-
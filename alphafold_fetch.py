@@ -0,0 +1,193 @@
+########################################################################################
+#   --> Downloads AlphaFold DB models for a list of UniProt accessions
+#
+#   --> Downloads run on a thread pool with a bounded number of workers, each worker keeps
+#       one keep-alive requests.Session so connections are reused between files
+#   --> Responses stream to a temporary file and are renamed once complete. Every finished
+#       file is recorded in {outDir}/download_manifest.tsv with its size and sha256, files
+#       that are on disk and match the manifest are skipped on re-runs
+#   --> Failures (connection errors, 429 and 5xx) are retried with exponential backoff,
+#       anything still failing is written to {outDir}/failed_downloads.tsv
+#   --> Accessions without a model (404 / 410) are a final answer, recorded in the manifest
+#       with status "not_found" and not asked for again (delete the line to recheck)
+#   --> baseUrl / urlTemplate are arguments, so a local http server can stand in for the EBI
+########################################################################################
+# import libraries
+import os
+from os import path as p
+import csv
+import pandas as pd
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+########################################################################################
+ALPHAFOLD_URL="https://alphafold.ebi.ac.uk/files"
+URL_TEMPLATE="{baseUrl}/AF-{accession}-F1-model_v4.pdb"
+# http status codes worth retrying, everything else is a permanent failure (eg. 404)
+RETRY_STATUS=[429,500,502,503,504]
+CHUNK_SIZE=1024*1024
+# http status codes meaning AlphaFold DB has no model for the accession
+NOT_FOUND_STATUS=[404,410]
+MANIFEST_COLUMNS=["accession","status","file","size","sha256"]
+FAILED_COLUMNS=["accession","url","status","error","attempts"]
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.mkdir(dir)
+    return dir
+
+def sha256_file(file):
+    digest=hashlib.sha256()
+    with open(file,"rb") as f:
+        for chunk in iter(lambda:f.read(CHUNK_SIZE),b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_tsv(tsvFile):
+    if not p.isfile(tsvFile):
+        return []
+    with open(tsvFile,"r",newline="") as f:
+        return list(csv.DictReader(f,delimiter="\t"))
+
+# one session per worker thread, each with its own keep-alive connection pool
+threadLocal=threading.local()
+
+def get_session():
+    if not hasattr(threadLocal,"session"):
+        session=requests.Session()
+        session.mount("http://",HTTPAdapter(pool_connections=1,pool_maxsize=1))
+        session.mount("https://",HTTPAdapter(pool_connections=1,pool_maxsize=1))
+        threadLocal.session=session
+    return threadLocal.session
+########################################################################################
+# rewrites a manifest of an older layout (no status column) in the current one
+def upgrade_manifest(manifestFile):
+    entries=read_tsv(manifestFile)
+    if not entries or "status" in entries[0]:
+        return
+    tmpFile=manifestFile+".tmp"
+    with open(tmpFile,"w",newline="") as f:
+        writer=csv.DictWriter(f,fieldnames=MANIFEST_COLUMNS,delimiter="\t")
+        writer.writeheader()
+        writer.writerows({**entry,"status":"ok"} for entry in entries)
+    os.replace(tmpFile,manifestFile)
+
+def is_not_found(manifestEntry):
+    return manifestEntry is not None and manifestEntry.get("status")=="not_found"
+
+# is a file on disk the one recorded in the manifest
+def is_verified(pdbFile,manifestEntry):
+    if manifestEntry is None or manifestEntry.get("status")!="ok" or not p.isfile(pdbFile):
+        return False
+    if p.getsize(pdbFile)!=int(manifestEntry["size"]):
+        return False
+    return sha256_file(pdbFile)==manifestEntry["sha256"]
+
+# downloads one url to pdbFile, streaming through a temporary file
+# returns a result dict with either a manifest entry or the error
+def download(accession,url,pdbFile,maxAttempts,backoff,timeout):
+    tmpFile=pdbFile+".part"
+    status=None
+    error=None
+    for attempt in range(1,maxAttempts+1):
+        try:
+            with get_session().get(url,stream=True,timeout=timeout) as response:
+                status=response.status_code
+                if status==200:
+                    digest=hashlib.sha256()
+                    size=0
+                    with open(tmpFile,"wb") as f:
+                        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                            f.write(chunk)
+                            digest.update(chunk)
+                            size+=len(chunk)
+                    os.replace(tmpFile,pdbFile)
+                    return {"accession":accession,"ok":True,
+                            "entry":{"accession":accession,"status":"ok","file":p.basename(pdbFile),
+                                     "size":size,"sha256":digest.hexdigest()}}
+                if status in NOT_FOUND_STATUS:
+                    return {"accession":accession,"ok":True,
+                            "entry":{"accession":accession,"status":"not_found","file":"","size":"","sha256":""}}
+                error=f"http {status}"
+                if status not in RETRY_STATUS:
+                    break
+        except requests.RequestException as e:
+            status=None
+            error=repr(e)
+        if attempt<maxAttempts:
+            time.sleep(backoff*2**(attempt-1))
+    if p.isfile(tmpFile):
+        os.remove(tmpFile)
+    return {"accession":accession,"ok":False,
+            "failure":{"accession":accession,"url":url,"status":status,"error":error,"attempts":attempt}}
+
+########################################################################################
+# fetches every accession into outDir as {accession}.pdb. Accessions may carry the trailing
+# ";" of the UniProt AlphaFoldDB column. Returns counts of skipped, downloaded, not found (this run
+# and earlier ones) and failed files
+def fetch_structures(accessions,outDir,baseUrl=ALPHAFOLD_URL,urlTemplate=URL_TEMPLATE,
+                     maxWorkers=16,maxAttempts=5,backoff=1.0,timeout=60):
+    outDir=ifnotmkdir(outDir)
+    manifestFile=p.join(outDir,"download_manifest.tsv")
+    failedFile=p.join(outDir,"failed_downloads.tsv")
+    upgrade_manifest(manifestFile)
+    manifest={entry["accession"]:entry for entry in read_tsv(manifestFile)}
+
+    # unique, cleaned accessions, minus those already verified on disk
+    todo=[]
+    numSkipped=0
+    numNotFound=0
+    # missing cells (NaN / None) are dropped before str() turns them into accessions
+    for accession in dict.fromkeys(str(a).strip().rstrip(";") for a in accessions if not pd.isna(a)):
+        if not accession:
+            continue
+        pdbFile=p.join(outDir,f"{accession}.pdb")
+        if is_not_found(manifest.get(accession)):
+            numNotFound+=1
+            continue
+        if is_verified(pdbFile,manifest.get(accession)):
+            numSkipped+=1
+            continue
+        todo.append((accession,urlTemplate.format(baseUrl=baseUrl.rstrip("/"),accession=accession),pdbFile))
+    print(f"-->\t {numSkipped} structures already downloaded, {numNotFound} known to have no model, {len(todo)} to fetch")
+
+    failures=[]
+    numDone=0
+    numDownloaded=0
+    startTime=time.time()
+    writeHeader=not p.isfile(manifestFile)
+    with open(manifestFile,"a",newline="") as manifestHandle, \
+         ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        writer=csv.DictWriter(manifestHandle,fieldnames=MANIFEST_COLUMNS,delimiter="\t")
+        if writeHeader:
+            writer.writeheader()
+        futures=[executor.submit(download,accession,url,pdbFile,maxAttempts,backoff,timeout)
+                 for accession,url,pdbFile in todo]
+        for future in as_completed(futures):
+            result=future.result()
+            numDone+=1
+            if result["ok"]:
+                # manifest only written from this thread, flushed so a crash keeps what finished
+                writer.writerow(result["entry"])
+                manifestHandle.flush()
+                if result["entry"]["status"]=="ok":
+                    numDownloaded+=1
+                else:
+                    numNotFound+=1
+            else:
+                failures.append(result["failure"])
+            if numDone%100==0 or numDone==len(todo):
+                rate=numDone/max(time.time()-startTime,1e-9)
+                print(f"-->\t {numDone}/{len(todo)} fetched ({rate:.1f}/s), {numNotFound} without a model, "
+                      f"{len(failures)} failed")
+
+    # failure manifest describes this run only
+    with open(failedFile,"w",newline="") as f:
+        writer=csv.DictWriter(f,fieldnames=FAILED_COLUMNS,delimiter="\t")
+        writer.writeheader()
+        writer.writerows(failures)
+    return {"skipped":numSkipped,"downloaded":numDownloaded,"notFound":numNotFound,"failed":len(failures)}
@@ -0,0 +1,86 @@
+########################################################################################
+#   --> Compares BLAST xml (outfmt 5) with tabular (outfmt 7) output for the same block:
+#       file size, parse time and HSP count
+#
+#   --> Usage, run blastp on one block in both formats:
+#           python benchmarks/bench_blast_tabular.py --query fasta_block_1.fasta --db nr_db
+#       or compare two files blastp already wrote for the same block:
+#           python benchmarks/bench_blast_tabular.py --xml BLAST_Block_1.xml --tsv BLAST_Block_1.tsv
+########################################################################################
+# import libraries
+import os
+import sys
+from os import path as p
+import argparse
+import importlib
+import tempfile
+import time
+sys.path.insert(0,p.dirname(p.dirname(p.abspath(__file__))))
+localBlast=importlib.import_module("03_local_blast")
+blastHits=importlib.import_module("03_blast_hits")
+from blast_tabular import read_tabular
+########################################################################################
+# runs blastp on one block in both formats, returns the two output files
+def run_both_formats(queryFasta,database,outDir,numThreads):
+    files={}
+    with open(queryFasta,"r") as f:
+        queryText=f.read()
+    for outputFormat in ["xml","tabular"]:
+        startTime=time.perf_counter()
+        localBlast.run_blast_local(outDir,database,queryText,1,numThreads,outputFormat)
+        print(f"blastp {outputFormat:<8}{time.perf_counter()-startTime:>10.2f} s")
+        files[outputFormat]=localBlast.block_output_file(outDir,1,outputFormat)
+    return files["xml"], files["tabular"]
+
+# best of a few runs, returns (seconds, rows)
+def time_parser(parser,blastFile,repeats):
+    times=[]
+    for _ in range(repeats):
+        startTime=time.perf_counter()
+        numRows=parser(blastFile)
+        times.append(time.perf_counter()-startTime)
+    return min(times), numRows
+
+def parse_xml_streaming(xmlFile):
+    return sum(1 for _ in blastHits.iter_blast_xml(xmlFile))
+
+def parse_xml_biopython(xmlFile):
+    return len(localBlast.parse_BLAST_result(xmlFile))
+
+def parse_tabular(tabFile):
+    return read_tabular(tabFile).num_rows
+########################################################################################
+def main():
+    parser=argparse.ArgumentParser(description="BLAST xml vs tabular output: size and parse time")
+    parser.add_argument("--query")
+    parser.add_argument("--db")
+    parser.add_argument("--xml")
+    parser.add_argument("--tsv")
+    parser.add_argument("--threads",type=int,default=1)
+    parser.add_argument("--repeats",type=int,default=3)
+    args=parser.parse_args()
+
+    if args.query and args.db:
+        xmlFile,tabFile=run_both_formats(args.query,args.db,tempfile.mkdtemp(prefix="bench_blast_"),args.threads)
+    elif args.xml and args.tsv:
+        xmlFile,tabFile=args.xml,args.tsv
+    else:
+        parser.error("give either --query and --db, or --xml and --tsv")
+
+    xmlSize=os.path.getsize(xmlFile)
+    tabSize=os.path.getsize(tabFile)
+    print(f"{'':<22}{'size MB':>10}{'parse s':>10}{'HSPs':>10}")
+    results=[("xml (iterparse)",xmlSize,parse_xml_streaming,xmlFile),
+             ("xml (Bio NCBIXML)",xmlSize,parse_xml_biopython,xmlFile),
+             ("tabular (pyarrow)",tabSize,parse_tabular,tabFile)]
+    times={}
+    for name,size,parserFunc,blastFile in results:
+        seconds,numRows=time_parser(parserFunc,blastFile,args.repeats)
+        times[name]=seconds
+        print(f"{name:<22}{size/1024**2:>10.2f}{seconds:>10.3f}{numRows:>10}")
+    print(f"xml / tabular size: {xmlSize/tabSize:.1f}x, "
+          f"parse speedup vs iterparse: {times['xml (iterparse)']/times['tabular (pyarrow)']:.1f}x")
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+########################################################################################
+#   --> Benchmarks the two scoring backends of 03_Calculate_similarity.gen_similarity_matrix
+#       on the same set of sequence pairs: one blastp run per pair vs the in-process
+#       Smith-Waterman in smith_waterman.py
+#
+#   --> Usage:  python benchmarks/bench_similarity_backends.py [fastaFile] [--pairs 200]
+#       without a fasta file, random related sequences are generated
+#   --> The blastp path is skipped if blastp is not on PATH. It runs with BLOSUM62, gaps
+#       11 + k and -comp_based_stats 0, where both backends give the raw local alignment
+#       score: any pair scored differently fails the benchmark. The stand-in blastp of
+#       benchmarks/stubs writes synthetic scores, so with it only the timings are reported
+########################################################################################
+# import libraries
+import sys
+from os import path as p
+import argparse
+import importlib
+import random
+import shutil
+import tempfile
+import time
+import numpy as np
+# the pipeline scripts live one directory up and start with digits, so import by name
+sys.path.insert(0,p.dirname(p.dirname(p.abspath(__file__))))
+similarity=importlib.import_module("03_Calculate_similarity")
+from smith_waterman import sw_scores
+########################################################################################
+# utilities
+aminoAcids="ACDEFGHIKLMNPQRSTVWY"
+
+# random family of related sequences, so that both backends find real alignments
+def random_sequences(numSeqs,length,seed=0):
+    rng=random.Random(seed)
+    ancestor=[rng.choice(aminoAcids) for _ in range(length)]
+    sequences=[]
+    for _ in range(numSeqs):
+        seq=list(ancestor)
+        for _ in range(rng.randint(0,length//2)):
+            seq[rng.randrange(len(seq))]=rng.choice(aminoAcids)
+        sequences.append("".join(seq))
+    return sequences
+
+def sample_pairs(numSeqs,numPairs,seed=0):
+    rng=random.Random(seed)
+    pairs=set()
+    while len(pairs)<min(numPairs,numSeqs*(numSeqs-1)//2):
+        i,j=sorted(rng.sample(range(numSeqs),2))
+        pairs.add((i,j))
+    return sorted(pairs)
+########################################################################################
+# pairwise blastp without composition based statistics, the scores smith-waterman reproduces
+def bench_blastp(ids,sequences,pairs):
+    tmpDir=tempfile.mkdtemp(prefix="bench_blastp_")
+    try:
+        startTime=time.perf_counter()
+        scores=[similarity.calculate_similarity(ids[i],sequences[i],ids[j],sequences[j],tmpDir,compBasedStats=0)
+                for i,j in pairs]
+        wallTime=time.perf_counter()-startTime
+    finally:
+        shutil.rmtree(tmpDir,ignore_errors=True)
+    return np.array(scores), wallTime
+
+def bench_smith_waterman(sequences,pairs):
+    scores=np.zeros(len(pairs))
+    startTime=time.perf_counter()
+    # pairs are sorted, so pairs sharing a query are scored in a single call
+    rowStart=0
+    while rowStart<len(pairs):
+        i=pairs[rowStart][0]
+        rowEnd=rowStart
+        while rowEnd<len(pairs) and pairs[rowEnd][0]==i:
+            rowEnd+=1
+        subjects=[sequences[j] for _,j in pairs[rowStart:rowEnd]]
+        scores[rowStart:rowEnd]=sw_scores(sequences[i],subjects)
+        rowStart=rowEnd
+    wallTime=time.perf_counter()-startTime
+    return scores, wallTime
+
+def report(name,numPairs,wallTime):
+    print(f"{name:<16}{numPairs:>8} pairs{wallTime:>10.2f} s{numPairs/wallTime:>12.1f} pairs/s")
+########################################################################################
+def main():
+    parser=argparse.ArgumentParser(description="blastp vs in-process Smith-Waterman")
+    parser.add_argument("fastaFile",nargs="?",default=None)
+    parser.add_argument("--pairs",type=int,default=200)
+    parser.add_argument("--length",type=int,default=350)
+    args=parser.parse_args()
+
+    if args.fastaFile is None:
+        sequences=random_sequences(100,args.length)
+        ids=[f"seq_{i}" for i in range(len(sequences))]
+    else:
+        fastaDf=similarity.fasta2df(args.fastaFile)
+        ids=fastaDf["ID"].to_list()
+        sequences=fastaDf["Sequence"].to_list()
+    pairs=sample_pairs(len(sequences),args.pairs)
+
+    swScores,swTime=bench_smith_waterman(sequences,pairs)
+    report("smith-waterman",len(pairs),swTime)
+
+    if shutil.which("blastp") is None:
+        print("blastp not found on PATH, skipping blastp backend")
+        return
+    blastScores,blastTime=bench_blastp(ids,sequences,pairs)
+    report("blastp",len(pairs),blastTime)
+    print(f"speedup: {blastTime/swTime:.1f}x")
+    if p.dirname(p.realpath(shutil.which("blastp")))==p.join(p.dirname(p.abspath(__file__)),"stubs"):
+        print("blastp is the benchmark stand-in, scores not compared")
+        return
+    # BLOSUM62 11/1 without composition based statistics: every pair blastp aligns must score the same
+    found=~np.isnan(blastScores)
+    mismatches=[(pairs[k],blastScores[k],swScores[k]) for k in np.flatnonzero(found & (blastScores!=swScores))]
+    print(f"identical scores: {found.sum()-len(mismatches)}/{found.sum()} pairs with a blastp HSP")
+    for (i,j),blastScore,swScore in mismatches[:10]:
+        print(f"  {ids[i]} / {ids[j]}: blastp {blastScore:.0f}, smith-waterman {swScore:.0f}")
+    assert not mismatches, f"{len(mismatches)} pairs scored differently by blastp and smith-waterman"
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+########################################################################################
+#   --> Benchmark suite covering every pipeline stage on synthetic data
+#
+#   --> Every stage runs in a fresh process and reports wall time, CPU time (its own
+#       and its subprocesses'), peak RSS, records processed and records/sec. Results are
+#       written as JSON tagged with the git commit, so two runs can be compared
+#   --> blastp, cd-hit and colabfold_batch are the stubs in benchmarks/stubs, put first on
+#       PATH, so the suite runs on any plain linux box
+#
+#   --> Usage:
+#           python benchmarks/run_benchmarks.py run --scale 1k [--stages xml_to_parquet,...]
+#           python benchmarks/run_benchmarks.py compare old.json new.json
+########################################################################################
+# import libraries
+import os
+import sys
+from os import path as p
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import shutil
+import subprocess
+import time
+benchDir=p.dirname(p.abspath(__file__))
+repoDir=p.dirname(benchDir)
+sys.path.insert(0,repoDir)
+sys.path.insert(0,benchDir)
+import synthetic_data
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+# empty working dir for one stage
+def fresh_dir(dir):
+    shutil.rmtree(dir,ignore_errors=True)
+    return ifnotmkdir(dir)
+
+def git_commit():
+    result=subprocess.run(["git","rev-parse","--short","HEAD"],cwd=repoDir,capture_output=True,text=True)
+    return result.stdout.strip() or "unknown"
+
+# first numSeqs records of the dataset as their own fasta file
+def subsample_fasta(data,numSeqs,fastaFile):
+    from fasta_index import iter_fasta
+    records=[]
+    for header,sequence in iter_fasta(data["fasta"]):
+        if len(records)==numSeqs:
+            break
+        records.append((header,sequence))
+    synthetic_data.write_fasta(records,fastaFile)
+    return fastaFile
+
+def script(name):
+    return importlib.import_module(name)
+########################################################################################
+## stages - each takes the dataset paths, an empty work dir and the options, returns records
+def stage_fasta_iter(data,workDir,options):
+    from fasta_index import iter_fasta
+    return sum(1 for _ in iter_fasta(data["fasta"]))
+
+def stage_fasta_index(data,workDir,options):
+    from fasta_index import FastaIndex
+    fastaFile=p.join(workDir,"sequences.fasta")
+    shutil.copy(data["fasta"],fastaFile)
+    with FastaIndex(fastaFile) as index:
+        for accession in index.accessions:
+            index.fetch(accession)
+        return len(index)
+
+def stage_local_blast(data,workDir,options):
+    from fasta_index import FastaIndex
+    localBlast=script("03_local_blast")
+    with FastaIndex(data["fasta"]) as index:
+        blocks=localBlast.packFastaByResidues(index,50000)
+        localBlast.run_blocks(workDir,"nr",index,blocks,os.cpu_count(),outputFormat="xml")
+        return len(index)
+
+def stage_xml_to_parquet(data,workDir,options):
+    blastHits=script("03_blast_hits")
+    xmlDir=data["blastXml"]
+    return sum(blastHits.xml2parquet(p.join(xmlDir,xmlFile),workDir)["rows"]
+               for xmlFile in sorted(os.listdir(xmlDir)))
+
+def stage_tabular_to_parquet(data,workDir,options):
+    blastHits=script("03_blast_hits")
+    tabularDir=data["blastTabular"]
+    return sum(blastHits.tabular2parquet(p.join(tabularDir,tabFile),workDir)["rows"]
+               for tabFile in sorted(os.listdir(tabularDir)))
+
+def stage_hit_store_read(data,workDir,options):
+    import pyarrow.dataset as ds
+    import hit_store
+    storeDir=p.join(data["dataDir"],"hit_store")
+    if not p.isdir(storeDir):
+        stage_tabular_to_parquet(data,ifnotmkdir(storeDir),options)
+    hits=hit_store.read_hits(storeDir,columns=["Alignment Info","Alignment Sequence"],
+                             filter=ds.field("HSP E-value")<1e-5)
+    return len(hits)
+
+# motif scan of the hit store, built from the tabular output on the first run as hit_store_read does
+def stage_motif_scan(data,workDir,options):
+    import hit_store
+    from motif_scan import scan_hit_store
+    storeDir=p.join(data["dataDir"],"hit_store")
+    if not p.isdir(storeDir):
+        stage_tabular_to_parquet(data,ifnotmkdir(storeDir),options)
+    scan_hit_store(storeDir)
+    return len(hit_store.read_hits(storeDir,columns=["Alignment Accession"]))
+
+def stage_cdhit_cascade(data,workDir,options):
+    from fasta_index import iter_fasta, header_accession
+    clustering=script("02_CD-hit_cluster")
+    ids=[header_accession(header) for header,_ in iter_fasta(data["fasta"])]
+    clustering.cluster_thresholds(data["fasta"],ids,[0.5,0.6,0.7,0.8,0.9],workDir,cascade=True)
+    return len(ids)
+
+def stage_sketch_prefilter(data,workDir,options):
+    from fasta_index import iter_fasta
+    from kmer_sketch import sketch_matrix, candidate_pairs
+    sequences=[sequence for _,sequence in iter_fasta(data["fasta"])]
+    candidate_pairs(sketch_matrix(sequences,4),0.02)
+    return len(sequences)
+
+def stage_similarity_sw(data,workDir,options):
+    similarity=script("03_Calculate_similarity")
+    numSeqs=options["similaritySeqs"]
+    fastaFile=subsample_fasta(data,numSeqs,p.join(workDir,"subsample.fasta"))
+    os.chdir(workDir)
+    similarity.gen_similarity_matrix(fastaFile,"bench",backend="smith-waterman")
+    return numSeqs*(numSeqs-1)//2
+
+def stage_similarity_blastp(data,workDir,options):
+    similarity=script("03_Calculate_similarity")
+    numSeqs=options["blastpSeqs"]
+    fastaFile=subsample_fasta(data,numSeqs,p.join(workDir,"subsample.fasta"))
+    os.chdir(workDir)
+    similarity.gen_similarity_matrix(fastaFile,"bench",backend="blastp")
+    return numSeqs*(numSeqs-1)//2
+
+# clustering at every threshold from a smith-waterman matrix of the similarity subsample,
+# the matrix is computed on the first run and kept with the data
+def stage_threshold_sweep(data,workDir,options):
+    from threshold_sweep import sweep_thresholds
+    numSeqs=options["similaritySeqs"]
+    sweepDir=ifnotmkdir(p.join(data["dataDir"],f"sweep_{numSeqs}"))
+    fastaFile=p.join(sweepDir,"subsample.fasta")
+    matrixName=p.join(sweepDir,"similarity_matrix_bench")
+    if not p.isfile(matrixName+".json"):
+        subsample_fasta(data,numSeqs,fastaFile)
+        script("03_Calculate_similarity").gen_similarity_matrix(fastaFile,"bench",backend="smith-waterman",outDir=sweepDir)
+    return len(sweep_thresholds(fastaFile,matrixName))
+
+# query index of the synthetic sequences, then the top 10 similar entries of every sequence
+def stage_query_index(data,workDir,options):
+    import pandas as pd
+    from fasta_index import iter_fasta, header_accession
+    from query_index import build_index, QueryIndex
+    records=[(header_accession(header),sequence) for header,sequence in iter_fasta(data["fasta"])]
+    build_index(pd.DataFrame(records,columns=["Entry","Sequence"]),p.join(workDir,"query_index"))
+    with QueryIndex(p.join(workDir,"query_index")) as index:
+        index.similar_batch(records,10)
+    return len(records)
+
+# structure archive of synthetic AlphaFold models (written on the first run and kept with the
+# data), then mean pLDDT and the residues within 8 angstrom of residue 10 of every protein
+def stage_structure_archive(data,workDir,options):
+    import random
+    from fasta_index import iter_fasta, header_accession
+    from structure_archive import build_archive, StructureArchive
+    numSeqs=options["foldSeqs"]
+    structuresDir=p.join(data["dataDir"],f"structures_{numSeqs}")
+    if not p.isdir(structuresDir):
+        rng=random.Random(0)
+        ifnotmkdir(structuresDir)
+        for header,sequence in list(iter_fasta(data["fasta"]))[:numSeqs]:
+            synthetic_data.write_pdb(sequence,p.join(structuresDir,f"{header_accession(header)}.pdb"),rng)
+    archiveDir=p.join(workDir,"structure_archive")
+    build_archive([structuresDir],archiveDir)
+    archive=StructureArchive(archiveDir)
+    archive.mean_plddt()
+    archive.residues_within_all({accession:10 for accession in archive.accessions},8.0)
+    return len(archive)
+
+# dataset build of dataset_build.py, with an empty sheet cache (every spreadsheet read)
+def stage_dataset_excel(data,workDir,options):
+    from dataset_build import build_dataset
+    dataDir=data["dataDir"]
+    dataNonRedundant,_=build_dataset([p.join(dataDir,"FAD_unfiltered.xlsx"),p.join(dataDir,"FMN_unfiltered.xlsx")],
+                                     p.join(dataDir,"Known_Photoenzymes.xlsx"),p.join(workDir,"sheet_cache"))
+    return len(dataNonRedundant)
+
+# the same build from a warm sheet cache, filled on the first run
+def stage_dataset_cached(data,workDir,options):
+    from dataset_build import build_dataset
+    dataDir=data["dataDir"]
+    dataNonRedundant,_=build_dataset([p.join(dataDir,"FAD_unfiltered.xlsx"),p.join(dataDir,"FMN_unfiltered.xlsx")],
+                                     p.join(dataDir,"Known_Photoenzymes.xlsx"),p.join(dataDir,"sheet_cache"))
+    return len(dataNonRedundant)
+
+def stage_colabfold_schedule(data,workDir,options):
+    folding=script("04_colabfold_fold_from_fasta")
+    numSeqs=options["foldSeqs"]
+    fastaFile=subsample_fasta(data,numSeqs,p.join(workDir,"subsample.fasta"))
+    predictionsDir=ifnotmkdir(p.join(workDir,"predictions"))
+    batches,_=folding.make_batches(fastaFile,predictionsDir,(200,400,600,800,1000,1500,2500),50)
+    for batchNum,(bucket,records) in enumerate(batches,start=1):
+        folding.run_batch(p.join(workDir,f"batch_{batchNum}.fasta"),records,predictionsDir,())
+    return numSeqs
+
+STAGES={"fasta_iter":stage_fasta_iter,
+        "fasta_index":stage_fasta_index,
+        "local_blast":stage_local_blast,
+        "xml_to_parquet":stage_xml_to_parquet,
+        "tabular_to_parquet":stage_tabular_to_parquet,
+        "hit_store_read":stage_hit_store_read,
+        "motif_scan":stage_motif_scan,
+        "cdhit_cascade":stage_cdhit_cascade,
+        "sketch_prefilter":stage_sketch_prefilter,
+        "similarity_sw":stage_similarity_sw,
+        "similarity_blastp":stage_similarity_blastp,
+        "threshold_sweep":stage_threshold_sweep,
+        "query_index":stage_query_index,
+        "dataset_excel":stage_dataset_excel,
+        "dataset_cached":stage_dataset_cached,
+        "colabfold_schedule":stage_colabfold_schedule,
+        "structure_archive":stage_structure_archive}
+########################################################################################
+# runs inside the stage's own process: times one stage, returns its measurements
+def measure_stage(name,data,workDir,options):
+    selfStart=resource.getrusage(resource.RUSAGE_SELF)
+    childStart=resource.getrusage(resource.RUSAGE_CHILDREN)
+    baselineRss=selfStart.ru_maxrss/1024
+    startTime=time.perf_counter()
+    # stages print progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        records=STAGES[name](data,workDir,options)
+    wallTime=time.perf_counter()-startTime
+    selfEnd=resource.getrusage(resource.RUSAGE_SELF)
+    childEnd=resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpuTime=(selfEnd.ru_utime-selfStart.ru_utime+selfEnd.ru_stime-selfStart.ru_stime+
+             childEnd.ru_utime-childStart.ru_utime+childEnd.ru_stime-childStart.ru_stime)
+    # ru_maxrss is in kB on linux
+    peakRss=max(selfEnd.ru_maxrss,childEnd.ru_maxrss)/1024
+    return {"stage":name,"records":records,"wallSeconds":wallTime,"cpuSeconds":cpuTime,
+            "cpuUtilisation":cpuTime/wallTime if wallTime>0 else None,
+            "recordsPerSec":records/wallTime if wallTime>0 else None,
+            "peakRssMb":peakRss,"baselineRssMb":baselineRss}
+
+def stage_process(connection,name,data,workDir,options):
+    try:
+        connection.send(measure_stage(name,data,workDir,options))
+    except Exception as e:
+        connection.send({"stage":name,"error":repr(e)})
+    connection.close()
+
+# one process per stage so peak RSS and CPU time belong to that stage alone. A plain
+# Process rather than a Pool, stages start pools of their own and pool workers can't
+def run_stage(name,data,workDir,options):
+    receiver,sender=multiprocessing.Pipe(duplex=False)
+    process=multiprocessing.Process(target=stage_process,args=(sender,name,data,fresh_dir(workDir),options))
+    process.start()
+    result=receiver.recv()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(f"stage {name} failed: {result['error']}")
+    return result
+
+# generates (or reuses) the synthetic dataset for a scale
+def prepare_data(workRoot,numSeqs,hitsPerQuery,seed):
+    dataDir=p.join(workRoot,f"data_{numSeqs}_{hitsPerQuery}_{seed}")
+    doneFile=p.join(dataDir,".complete")
+    if not p.isfile(doneFile):
+        print(f"generating synthetic dataset of {numSeqs} sequences in {dataDir}")
+        shutil.rmtree(dataDir,ignore_errors=True)
+        synthetic_data.generate_dataset(dataDir,numSeqs,hitsPerQuery,seed=seed)
+        open(doneFile,"w").close()
+    return {"dataDir":dataDir,"fasta":p.join(dataDir,"sequences.fasta"),
+            "blastXml":p.join(dataDir,"blast_xml"),"blastTabular":p.join(dataDir,"blast_tabular")}
+########################################################################################
+def print_results(results):
+    print(f"{'stage':<22}{'records':>10}{'wall s':>10}{'cpu s':>10}{'rec/s':>12}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['stage']:<22}{r['records']:>10}{r['wallSeconds']:>10.2f}{r['cpuSeconds']:>10.2f}"
+              f"{r['recordsPerSec']:>12.1f}{r['peakRssMb']:>10.0f}")
+
+def run_suite(args):
+    numSeqs=synthetic_data.SCALES.get(args.scale) or int(args.scale)
+    stages=args.stages.split(",") if args.stages else list(STAGES)
+    unknown=[stage for stage in stages if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages: {unknown}, choose from {list(STAGES)}")
+    # stubs first on PATH, inherited by every stage worker and the programs they start
+    os.environ["PATH"]=p.join(benchDir,"stubs")+os.pathsep+os.environ["PATH"]
+    workRoot=ifnotmkdir(p.abspath(args.work))
+    # the pipeline's own performance records, kept out of the working directory
+    from instrumentation import set_metrics_file
+    set_metrics_file(p.join(workRoot,"metrics.jsonl"))
+    data=prepare_data(workRoot,numSeqs,args.hits,args.seed)
+    options={"similaritySeqs":args.similarity_seqs,"blastpSeqs":args.blastp_seqs,"foldSeqs":args.fold_seqs}
+
+    results=[]
+    for stage in stages:
+        print(f"running {stage}")
+        results.append(run_stage(stage,data,p.join(workRoot,"stages",stage),options))
+    print_results(results)
+
+    report={"commit":git_commit(),"timestamp":time.strftime("%Y-%m-%d %H:%M:%S"),
+            "machine":{"platform":platform.platform(),"python":platform.python_version(),
+                       "cpus":os.cpu_count()},
+            "scale":numSeqs,"hitsPerQuery":args.hits,"seed":args.seed,"options":options,
+            "stages":results}
+    outFile=args.out or p.join(ifnotmkdir(p.join(benchDir,"results")),f"{report['commit']}_{numSeqs}.json")
+    with open(outFile,"w") as f:
+        json.dump(report,f,indent=1)
+    print(f"results written to {outFile}")
+
+# stage by stage change in wall time, throughput and peak memory between two result files
+def compare(args):
+    with open(args.old) as f:
+        old=json.load(f)
+    with open(args.new) as f:
+        new=json.load(f)
+    if old["scale"]!=new["scale"]:
+        print(f"warning: comparing different scales ({old['scale']} vs {new['scale']})")
+    oldStages={r["stage"]:r for r in old["stages"]}
+    print(f"{old['commit']} -> {new['commit']}")
+    print(f"{'stage':<22}{'old wall s':>12}{'new wall s':>12}{'speedup':>10}{'old MB':>10}{'new MB':>10}")
+    for r in new["stages"]:
+        if r["stage"] not in oldStages:
+            continue
+        o=oldStages[r["stage"]]
+        speedup=o["wallSeconds"]/r["wallSeconds"] if r["wallSeconds"]>0 else float("nan")
+        print(f"{r['stage']:<22}{o['wallSeconds']:>12.2f}{r['wallSeconds']:>12.2f}{speedup:>9.2f}x"
+              f"{o['peakRssMb']:>10.0f}{r['peakRssMb']:>10.0f}")
+
+def main():
+    parser=argparse.ArgumentParser(description="FlavInDex pipeline benchmarks")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+    runParser=subparsers.add_parser("run",help="run the benchmark suite")
+    runParser.add_argument("--scale",default="1k",help="number of sequences, or one of "+"/".join(synthetic_data.SCALES))
+    runParser.add_argument("--stages",default=None,help="comma separated, default all: "+",".join(STAGES))
+    runParser.add_argument("--hits",type=int,default=5,help="BLAST hits per query")
+    runParser.add_argument("--seed",type=int,default=0)
+    runParser.add_argument("--work",default=p.join(benchDir,"data"),help="dir for data and stage outputs")
+    runParser.add_argument("--out",default=None,help="results json, default benchmarks/results/{commit}_{scale}.json")
+    runParser.add_argument("--similarity-seqs",type=int,default=300)
+    runParser.add_argument("--blastp-seqs",type=int,default=30)
+    runParser.add_argument("--fold-seqs",type=int,default=200)
+    compareParser=subparsers.add_parser("compare",help="compare two result files")
+    compareParser.add_argument("old")
+    compareParser.add_argument("new")
+    args=parser.parse_args()
+    if args.command=="run":
+        run_suite(args)
+    else:
+        compare(args)
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
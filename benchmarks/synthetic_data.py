@@ -0,0 +1,224 @@
+########################################################################################
+#   --> Synthetic inputs for benchmarking every pipeline stage without real data
+#
+#   --> Sequences come in families: each ancestor carries a Rossmann GXGXXG dinucleotide
+#       binding motif near its N-terminus, descendants are point-mutated copies, so
+#       clustering, k-mer prefilters and alignments all have real structure to find
+#   --> BLAST output is written both as xml (outfmt 5, parsable by Bio.Blast.NCBIXML) and as
+#       tabular outfmt 7 with the columns of blast_tabular.py, for the same hits
+#   --> UniProt style spreadsheets (Entry / Sequence / AlphaFoldDB) stand in for the FAD,
+#       FMN and known photoenzyme exports read by 01_genDataset
+#
+#   --> Usage:  python benchmarks/synthetic_data.py outDir --seqs 1000 [--hits 5]
+########################################################################################
+# import libraries
+import os
+import sys
+from os import path as p
+import argparse
+import random
+sys.path.insert(0,p.dirname(p.dirname(p.abspath(__file__))))
+from blast_tabular import TABULAR_COLUMNS
+from fasta_index import format_record
+########################################################################################
+aminoAcids="ACDEFGHIKLMNPQRSTVWY"
+SCALES={"1k":1000,"10k":10000,"100k":100000}
+
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+# Rossmann fold GXGXXG with random X
+def rossmann_motif(rng):
+    return f"G{rng.choice(aminoAcids)}G{rng.choice(aminoAcids)}{rng.choice(aminoAcids)}G"
+
+def mutate(sequence,rate,rng):
+    residues=list(sequence)
+    for _ in range(int(len(residues)*rate)):
+        residues[rng.randrange(len(residues))]=rng.choice(aminoAcids)
+    return "".join(residues)
+
+# list of (accession, sequence) in families of familySize
+def flavoprotein_sequences(numSeqs,seed=0,familySize=10,minLength=150,maxLength=800):
+    rng=random.Random(seed)
+    records=[]
+    while len(records)<numSeqs:
+        length=rng.randint(minLength,maxLength)
+        motifStart=rng.randint(3,30)
+        ancestor=[rng.choice(aminoAcids) for _ in range(length)]
+        ancestor[motifStart:motifStart+6]=rossmann_motif(rng)
+        ancestor="".join(ancestor)
+        for _ in range(min(familySize,numSeqs-len(records))):
+            # keep the motif glycines while the rest drifts
+            child=list(mutate(ancestor,rng.uniform(0.0,0.4),rng))
+            child[motifStart:motifStart+6]=ancestor[motifStart:motifStart+6]
+            records.append((f"SYN{len(records):07d}","".join(child)))
+    return records
+
+def write_fasta(records,fastaFile,lineWidth=None):
+    with open(fastaFile,"w") as f:
+        for accession,sequence in records:
+            if lineWidth:
+                sequence="\n".join(sequence[i:i+lineWidth] for i in range(0,len(sequence),lineWidth))
+            f.write(format_record(accession,sequence))
+########################################################################################
+## fake BLAST hits, one dict per HSP
+def fake_hits(queryAccession,querySequence,hitsPerQuery,rng):
+    hits=[]
+    for hitNum in range(1,hitsPerQuery+1):
+        start=rng.randint(0,len(querySequence)//4)
+        end=rng.randint(3*len(querySequence)//4,len(querySequence))
+        qseq=querySequence[start:end]
+        hseq=mutate(qseq,rng.uniform(0.05,0.6),rng)
+        identity=sum(a==b for a,b in zip(qseq,hseq))
+        bitscore=round(identity*1.9,1)
+        hits.append({"qseqid":queryAccession,"sacc":f"HIT{rng.randrange(10**8):08d}",
+                     "stitle":f"flavoprotein_{hitNum} FAD-dependent oxidoreductase [Synthetic organism]",
+                     "evalue":float(f"{10**-(identity/8):.3g}"),"bitscore":bitscore,
+                     "score":int(bitscore*2.2),"nident":identity,"pident":round(100*identity/len(qseq),2),
+                     "length":len(qseq),"qstart":start+1,"qend":end,"qlen":len(querySequence),
+                     "sstart":1,"send":len(hseq),"slen":len(hseq)+rng.randint(0,50),
+                     "qseq":qseq,"sseq":hseq,
+                     "midline":"".join(a if a==b else " " for a,b in zip(qseq,hseq))})
+    return hits
+
+XML_HEADER="""<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastp</BlastOutput_program>
+  <BlastOutput_version>BLASTP 2.14.0+</BlastOutput_version>
+  <BlastOutput_reference>synthetic</BlastOutput_reference>
+  <BlastOutput_db>{db}</BlastOutput_db>
+  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>
+  <BlastOutput_query-def>{firstQuery}</BlastOutput_query-def>
+  <BlastOutput_query-len>{firstLength}</BlastOutput_query-len>
+  <BlastOutput_param>
+    <Parameters>
+      <Parameters_matrix>BLOSUM62</Parameters_matrix>
+      <Parameters_expect>10</Parameters_expect>
+      <Parameters_gap-open>11</Parameters_gap-open>
+      <Parameters_gap-extend>1</Parameters_gap-extend>
+      <Parameters_filter>F</Parameters_filter>
+    </Parameters>
+  </BlastOutput_param>
+<BlastOutput_iterations>
+"""
+XML_STATISTICS="""  <Iteration_stat>
+    <Statistics>
+      <Statistics_db-num>1000</Statistics_db-num>
+      <Statistics_db-len>300000</Statistics_db-len>
+      <Statistics_hsp-len>0</Statistics_hsp-len>
+      <Statistics_eff-space>0</Statistics_eff-space>
+      <Statistics_kappa>0.041</Statistics_kappa>
+      <Statistics_lambda>0.267</Statistics_lambda>
+      <Statistics_entropy>0.14</Statistics_entropy>
+    </Statistics>
+  </Iteration_stat>
+"""
+
+# BLAST xml for a list of (accession, sequence) queries, written to an open handle
+def write_blast_xml(queries,hitsPerQuery,handle,rng,db="nr"):
+    handle.write(XML_HEADER.format(db=db,firstQuery=queries[0][0] if queries else "",
+                                   firstLength=len(queries[0][1]) if queries else 0))
+    for iterNum,(accession,sequence) in enumerate(queries,start=1):
+        handle.write(f"<Iteration>\n  <Iteration_iter-num>{iterNum}</Iteration_iter-num>\n"
+                     f"  <Iteration_query-ID>Query_{iterNum}</Iteration_query-ID>\n"
+                     f"  <Iteration_query-def>{accession}</Iteration_query-def>\n"
+                     f"  <Iteration_query-len>{len(sequence)}</Iteration_query-len>\n<Iteration_hits>\n")
+        for hitNum,hit in enumerate(fake_hits(accession,sequence,hitsPerQuery,rng),start=1):
+            handle.write(f"<Hit>\n  <Hit_num>{hitNum}</Hit_num>\n  <Hit_id>ref|{hit['sacc']}|</Hit_id>\n"
+                         f"  <Hit_def>{hit['stitle']}</Hit_def>\n  <Hit_accession>{hit['sacc']}</Hit_accession>\n"
+                         f"  <Hit_len>{hit['slen']}</Hit_len>\n  <Hit_hsps>\n    <Hsp>\n"
+                         f"      <Hsp_num>1</Hsp_num>\n      <Hsp_bit-score>{hit['bitscore']}</Hsp_bit-score>\n"
+                         f"      <Hsp_score>{hit['score']}</Hsp_score>\n      <Hsp_evalue>{hit['evalue']}</Hsp_evalue>\n"
+                         f"      <Hsp_query-from>{hit['qstart']}</Hsp_query-from>\n      <Hsp_query-to>{hit['qend']}</Hsp_query-to>\n"
+                         f"      <Hsp_hit-from>{hit['sstart']}</Hsp_hit-from>\n      <Hsp_hit-to>{hit['send']}</Hsp_hit-to>\n"
+                         f"      <Hsp_identity>{hit['nident']}</Hsp_identity>\n      <Hsp_positive>{hit['nident']}</Hsp_positive>\n"
+                         f"      <Hsp_gaps>0</Hsp_gaps>\n      <Hsp_align-len>{hit['length']}</Hsp_align-len>\n"
+                         f"      <Hsp_qseq>{hit['qseq']}</Hsp_qseq>\n      <Hsp_hseq>{hit['sseq']}</Hsp_hseq>\n"
+                         f"      <Hsp_midline>{hit['midline']}</Hsp_midline>\n    </Hsp>\n  </Hit_hsps>\n</Hit>\n")
+        handle.write("</Iteration_hits>\n"+XML_STATISTICS+"</Iteration>\n")
+    handle.write("</BlastOutput_iterations>\n</BlastOutput>\n")
+
+# the same kind of hits as tabular outfmt 7
+def write_blast_tabular(queries,hitsPerQuery,handle,rng,db="nr"):
+    columns=[name for name,_ in TABULAR_COLUMNS]
+    for accession,sequence in queries:
+        hits=fake_hits(accession,sequence,hitsPerQuery,rng)
+        handle.write(f"# BLASTP 2.14.0+\n# Query: {accession}\n# Database: {db}\n"
+                     f"# Fields: {', '.join(columns)}\n# {len(hits)} hits found\n")
+        for hit in hits:
+            handle.write("\t".join(str(hit[column]) for column in columns)+"\n")
+    handle.write(f"# BLAST processed {len(queries)} queries\n")
+
+########################################################################################
+# UniProt style spreadsheets for the dataset build, known photoenzymes overlap FAD entries
+def write_excel_inputs(records,outDir,rng):
+    import pandas as pd
+    rows=[{"Entry":accession,"Sequence":sequence,"Length":len(sequence),
+           "AlphaFoldDB":f"{accession};" if rng.random()<0.8 else None} for accession,sequence in records]
+    half=len(rows)//2
+    # some sequences appear in both FAD and FMN sets, as in the real exports
+    overlap=rows[half-len(rows)//20:half]
+    pd.DataFrame(rows[:half]).to_excel(p.join(outDir,"FAD_unfiltered.xlsx"),index=False)
+    pd.DataFrame(overlap+rows[half:]).to_excel(p.join(outDir,"FMN_unfiltered.xlsx"),index=False)
+    pd.DataFrame(rng.sample(rows,max(1,len(rows)//100))).to_excel(p.join(outDir,"Known_Photoenzymes.xlsx"),index=False)
+
+########################################################################################
+THREE_LETTER={"A":"ALA","C":"CYS","D":"ASP","E":"GLU","F":"PHE","G":"GLY","H":"HIS","I":"ILE","K":"LYS","L":"LEU",
+              "M":"MET","N":"ASN","P":"PRO","Q":"GLN","R":"ARG","S":"SER","T":"THR","V":"VAL","W":"TRP","Y":"TYR"}
+BACKBONE=[("N",-1.2,0.6,0.0),("CA",0.0,0.0,0.0),("C",1.2,0.6,0.0),("O",1.3,1.8,0.3)]
+
+# AlphaFold style pdb of a sequence: backbone atoms along an alpha helix, pLDDT in the B-factor,
+# confident in the core and dropping towards disordered termini
+def write_pdb(sequence,pdbFile,rng):
+    import math
+    core=rng.uniform(75,95)
+    with open(pdbFile,"w") as f:
+        serial=1
+        for i,residue in enumerate(sequence,start=1):
+            angle=math.radians(100*i)
+            x,y,z=2.3*math.cos(angle),2.3*math.sin(angle),1.5*i
+            ends=min(i,len(sequence)-i+1)
+            plddt=max(20,core-max(0,30-ends)*2+rng.uniform(-5,5))
+            for name,dx,dy,dz in BACKBONE:
+                f.write(f"ATOM  {serial:>5} {name:<4} {THREE_LETTER.get(residue,'UNK')} A{i:>4}    "
+                        f"{x+dx:>8.3f}{y+dy:>8.3f}{z+dz:>8.3f}  1.00{plddt:>6.2f}           {name[0]}  \n")
+                serial+=1
+        f.write("END\n")
+
+########################################################################################
+# writes a complete synthetic dataset into outDir:
+#   sequences.fasta, blast_xml/BLAST_Block_{n}.xml, blast_tabular/BLAST_Block_{n}.tsv, *.xlsx
+def generate_dataset(outDir,numSeqs,hitsPerQuery=5,queriesPerBlock=100,seed=0,excel=True):
+    rng=random.Random(seed)
+    outDir=ifnotmkdir(outDir)
+    records=flavoprotein_sequences(numSeqs,seed)
+    write_fasta(records,p.join(outDir,"sequences.fasta"))
+    xmlDir=ifnotmkdir(p.join(outDir,"blast_xml"))
+    tabularDir=ifnotmkdir(p.join(outDir,"blast_tabular"))
+    for blockNum,start in enumerate(range(0,len(records),queriesPerBlock),start=1):
+        queries=records[start:start+queriesPerBlock]
+        with open(p.join(xmlDir,f"BLAST_Block_{blockNum}.xml"),"w") as f:
+            write_blast_xml(queries,hitsPerQuery,f,random.Random(seed+blockNum))
+        with open(p.join(tabularDir,f"BLAST_Block_{blockNum}.tsv"),"w") as f:
+            write_blast_tabular(queries,hitsPerQuery,f,random.Random(seed+blockNum))
+    if excel:
+        write_excel_inputs(records,outDir,rng)
+    return outDir
+
+def main():
+    parser=argparse.ArgumentParser(description="write a synthetic FlavInDex dataset")
+    parser.add_argument("outDir")
+    parser.add_argument("--seqs",default="1k",help="number of sequences, or one of "+"/".join(SCALES))
+    parser.add_argument("--hits",type=int,default=5,help="BLAST hits per query")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--no-excel",action="store_true")
+    args=parser.parse_args()
+    numSeqs=SCALES.get(args.seqs) or int(args.seqs)
+    generate_dataset(args.outDir,numSeqs,args.hits,seed=args.seed,excel=not args.no_excel)
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+########################################################################################
+#   --> Tabular BLAST output (-outfmt 7) with a fixed column list, and a typed reader
+#
+#   --> outfmt 7 is tab separated, one line per HSP, with "#" comment lines around each
+#       query and a final "# BLAST processed N queries" line that marks a complete file
+#   --> The reader is pyarrow's multithreaded csv parser: columns come out typed, comment
+#       lines are skipped as invalid rows (they have a single field)
+########################################################################################
+# import libraries
+import os
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+from hit_store import HIT_SCHEMA
+from hit_filters import PARSE_SCHEMA
+########################################################################################
+# blast column names and their types, sseq is the aligned subject sequence (with gaps)
+TABULAR_COLUMNS=[("qseqid",pa.string()),
+                 ("sacc",pa.string()),
+                 ("evalue",pa.float64()),
+                 ("bitscore",pa.float64()),
+                 ("score",pa.float64()),
+                 ("nident",pa.int32()),
+                 ("pident",pa.float64()),
+                 ("length",pa.int32()),
+                 ("qstart",pa.int32()),
+                 ("qend",pa.int32()),
+                 ("qlen",pa.int32()),
+                 ("sstart",pa.int32()),
+                 ("send",pa.int32()),
+                 ("slen",pa.int32()),
+                 ("sseq",pa.string()),
+                 # free text title last, so any stray characters in it can't shift other columns
+                 ("stitle",pa.string())]
+# value for blastp's -outfmt
+OUTFMT="7 "+" ".join(name for name,_ in TABULAR_COLUMNS)
+########################################################################################
+# checks that blast wrote the closing "# BLAST processed" comment
+def tabular_is_complete(tabFile):
+    if not os.path.isfile(tabFile):
+        return False
+    with open(tabFile,"rb") as f:
+        f.seek(0,os.SEEK_END)
+        f.seek(max(0,f.tell()-256))
+        return b"# BLAST processed" in f.read()
+
+# comment lines have one field, everything else is a hit
+def skip_comment(row):
+    if row.text.startswith("#"):
+        return "skip"
+    return "error"
+
+# reads an outfmt 7 file into a typed pyarrow table, one row per HSP
+def read_tabular(tabFile):
+    readOptions=pacsv.ReadOptions(column_names=[name for name,_ in TABULAR_COLUMNS])
+    parseOptions=pacsv.ParseOptions(delimiter="\t",quote_char=False,
+                                    invalid_row_handler=skip_comment)
+    convertOptions=pacsv.ConvertOptions(column_types=dict(TABULAR_COLUMNS))
+    return pacsv.read_csv(tabFile,read_options=readOptions,parse_options=parseOptions,
+                          convert_options=convertOptions)
+
+# as read_tabular, returned as a DataFrame
+def parse_blast_tabular(tabFile):
+    return read_tabular(tabFile).to_pandas()
+
+# converts a tabular table to the parse schema of hit_filters: the hit store columns plus
+# the alignment length and query coordinates the identity / coverage filters use
+def to_parse_table(table):
+    # "Alignment Info" is the first word of the subject title, as in the xml path
+    info=pc.list_element(pc.split_pattern(table["stitle"]," ",max_splits=1),0)
+    return pa.Table.from_arrays([table["qseqid"],table["sacc"],info,table["sseq"],
+                                 table["evalue"],table["bitscore"],table["nident"],
+                                 table["length"],table["qstart"],table["qend"],table["qlen"]],
+                                schema=PARSE_SCHEMA)
+
+# converts a tabular table to the hit store schema
+def to_hit_table(table):
+    return to_parse_table(table).select(HIT_SCHEMA.names)
@@ -0,0 +1,130 @@
+########################################################################################
+#   --> Builds the flavoprotein dataset from the UniProt spreadsheets (FAD, FMN and the
+#       known photoenzymes), as the first cells of 01_genDataset.ipynb did
+#
+#   --> Every spreadsheet is read once and cached as {cacheDir}/{name}.parquet. The cache
+#       records the sheet's size, mtime and sha256 in its metadata: a matching size and mtime
+#       is trusted as is, otherwise the sheet is rehashed and only re-read if its content
+#       changed. Adding a source re-reads that one sheet
+#   --> Duplicate sequences are found on Sequence_Digest, a fixed width (32 hex character)
+#       blake2b digest of the sequence, instead of comparing full sequence strings
+#   --> Known_Photoenzyme is a hash join of Entry against the photoenzyme accessions
+#   --> Outputs are parquet, by default {outDir}/flavins_non-redundant.parquet and
+#       flavins_alphaFold.parquet, plus the non-redundant sequences as flavins_non-redundant.fasta
+########################################################################################
+# import libraries
+import os
+from os import path as p
+import hashlib
+import json
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fasta_index import format_record
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+def sha256_file(file):
+    digest=hashlib.sha256()
+    with open(file,"rb") as f:
+        for chunk in iter(lambda:f.read(1024*1024),b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# fixed width digest of every sequence, 16 bytes as 32 hex characters
+def sequence_digest(sequences):
+    return pd.Series([hashlib.blake2b(str(sequence).encode(),digest_size=16).hexdigest() for sequence in sequences],
+                     index=sequences.index if isinstance(sequences,pd.Series) else None,dtype="string")
+########################################################################################
+## spreadsheet cache
+CACHE_KEY=b"flavindex_source"
+
+def cache_file(excelFile,cacheDir):
+    return p.join(cacheDir,p.splitext(p.basename(excelFile))[0]+".parquet")
+
+def read_cache_source(cacheFile):
+    metadata=pq.read_schema(cacheFile).metadata or {}
+    if CACHE_KEY not in metadata:
+        return None
+    return json.loads(metadata[CACHE_KEY])
+
+# excel columns can mix types (eg. numbers and text), parquet needs one type per column
+def to_parquet_types(df):
+    objectColumns=df.select_dtypes(include="object").columns
+    return df.astype({column:"string" for column in objectColumns})
+
+# the sheet as a dataframe, from the parquet cache when the sheet hasn't changed since
+def read_sheet(excelFile,cacheDir):
+    cacheFile=cache_file(excelFile,ifnotmkdir(cacheDir))
+    stat=os.stat(excelFile)
+    source={"file":p.abspath(excelFile),"size":stat.st_size,"mtime":stat.st_mtime_ns}
+    cached=read_cache_source(cacheFile) if p.isfile(cacheFile) else None
+    if cached is not None:
+        if cached["size"]==source["size"] and cached["mtime"]==source["mtime"]:
+            return pd.read_parquet(cacheFile)
+        # touched but maybe not changed, the content hash decides
+        source["sha256"]=sha256_file(excelFile)
+        if cached["sha256"]==source["sha256"]:
+            table=pq.read_table(cacheFile)
+            write_cache(table,source,cacheFile)
+            return table.to_pandas()
+    source.setdefault("sha256",sha256_file(excelFile))
+    print(f"-->\t reading {excelFile}")
+    df=to_parquet_types(pd.read_excel(excelFile))
+    write_cache(pa.Table.from_pandas(df,preserve_index=False),source,cacheFile)
+    return df
+
+def write_cache(table,source,cacheFile):
+    metadata={**(table.schema.metadata or {}),CACHE_KEY:json.dumps(source).encode()}
+    tmpFile=cacheFile+".tmp"
+    pq.write_table(table.replace_schema_metadata(metadata),tmpFile)
+    os.replace(tmpFile,cacheFile)
+########################################################################################
+# combines the source sheets and the known photoenzymes into one non-redundant dataset,
+# first occurrence of a sequence kept, in source order then photoenzymes
+def build_dataset(sourceFiles,photoenzymeFile,cacheDir):
+    sources=[read_sheet(sourceFile,cacheDir) for sourceFile in sourceFiles]
+    knownFlavinPhotoezymes=read_sheet(photoenzymeFile,cacheDir)
+    for sourceFile,source in zip(sourceFiles,sources):
+        print(f"{p.basename(sourceFile)} dataset{source.shape}")
+    dataUnfiltered=pd.concat(sources+[knownFlavinPhotoezymes],ignore_index=True)
+
+    # hash join of every entry against the photoenzyme accessions
+    photoenzymeIDs=pd.Index(knownFlavinPhotoezymes["Entry"].dropna().unique())
+    dataUnfiltered["Known_Photoenzyme"]=photoenzymeIDs.get_indexer(dataUnfiltered["Entry"])!=-1
+
+    # remove dupes on the sequence digest
+    dataUnfiltered["Sequence_Digest"]=sequence_digest(dataUnfiltered["Sequence"])
+    dataNonRedundant=dataUnfiltered.drop_duplicates(subset="Sequence_Digest",ignore_index=True)
+    print(f"non-redundant dataset{dataNonRedundant.shape}")
+    # remove entries without alphafold predictions
+    dataAlphaFold=dataNonRedundant.dropna(subset=["AlphaFoldDB"])
+    print(f"has alphafold predictions dataset{dataAlphaFold.shape}")
+    return dataNonRedundant, dataAlphaFold
+
+def dataset_files(outDir):
+    return (p.join(outDir,"flavins_non-redundant.parquet"),p.join(outDir,"flavins_alphaFold.parquet"),
+            p.join(outDir,"flavins_non-redundant.fasta"))
+
+def write_dataset(dataNonRedundant,dataAlphaFold,nonRedundantFile,alphaFoldFile,fastaFile):
+    dataNonRedundant.to_parquet(nonRedundantFile,index=False)
+    dataAlphaFold.to_parquet(alphaFoldFile,index=False)
+    with open(fastaFile,"w") as f:
+        for entry,sequence in zip(dataNonRedundant["Entry"],dataNonRedundant["Sequence"]):
+            f.write(format_record(entry,sequence))
+    return nonRedundantFile, alphaFoldFile, fastaFile
+
+def main():
+    excelDir="/home/esp/dataset_generation/flavin_dataset/Excel_and_Fasta"
+    sourceFiles=[p.join(excelDir,"FAD_unfiltered.xlsx"),p.join(excelDir,"FMN_unfiltered.xlsx")]
+    dataNonRedundant,dataAlphaFold=build_dataset(sourceFiles,p.join(excelDir,"Known_Photoenzymes.xlsx"),
+                                                 p.join(excelDir,"sheet_cache"))
+    write_dataset(dataNonRedundant,dataAlphaFold,*dataset_files(excelDir))
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
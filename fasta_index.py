@@ -0,0 +1,177 @@
+########################################################################################
+#   --> Shared FASTA handling for every pipeline script
+#
+#   --> iter_fasta streams (header, sequence) records with bounded memory, sequences may be
+#       wrapped over any number of lines
+#   --> FastaIndex memory-maps a FASTA file and keeps an offset index next to it
+#       ({fastaFile}.fxi, rebuilt when the FASTA is newer), so any record is fetched by
+#       accession in O(1) without reading the rest of the file
+#   --> Blocks of records (for BLAST / CD-HIT / ColabFold) are slices of the mapped file:
+#       record_bytes returns a zero-copy memoryview, block_bytes joins a block's records,
+#       ready to be written once or piped to a program's stdin
+########################################################################################
+# import libraries
+import os
+from os import path as p
+import mmap
+########################################################################################
+# converts sequence and header to fasta
+def format_record(header,sequence):
+    return f">{header}\n{sequence}\n"
+
+# accession is the first word of the header, the ID blast and cd-hit report
+def header_accession(header):
+    return header.split(maxsplit=1)[0] if header.strip() else ""
+
+# streams (header, sequence) tuples from a FASTA file, header without the ">"
+def iter_fasta(fastaFile):
+    header=None
+    seqLines=[]
+    with open(fastaFile,"r") as f:
+        for line in f:
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(seqLines)
+                header=line[1:].rstrip("\r\n")
+                seqLines=[]
+            elif header is not None:
+                seqLines.append(line.strip())
+    if header is not None:
+        yield header, "".join(seqLines)
+
+########################################################################################
+# offset index of a FASTA file, one line per record:
+#   accession  length  recordOffset  sequenceOffset  endOffset
+def build_index(fastaFile):
+    entries=[]
+    offset=0
+    current=None
+    with open(fastaFile,"rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if current is not None:
+                    current[4]=offset
+                    entries.append(current)
+                accession=header_accession(line[1:].decode())
+                current=[accession,0,offset,offset+len(line),None]
+            elif current is not None:
+                current[1]+=len(line.strip())
+            offset+=len(line)
+    if current is not None:
+        current[4]=offset
+        entries.append(current)
+    check_unique(entries,fastaFile)
+    return entries
+
+# records are looked up by accession, so a repeated one would silently shadow the first
+def check_unique(entries,fastaFile):
+    seen=set()
+    duplicates=list(dict.fromkeys(entry[0] for entry in entries if entry[0] in seen or seen.add(entry[0])))
+    if duplicates:
+        raise ValueError(f"{fastaFile}: {len(duplicates)} duplicate accessions, eg. {duplicates[:5]}")
+
+def index_file(fastaFile):
+    return fastaFile+".fxi"
+
+def write_index(entries,indexFile):
+    tmpFile=indexFile+".tmp"
+    with open(tmpFile,"w") as f:
+        for entry in entries:
+            f.write("\t".join(str(value) for value in entry)+"\n")
+    os.replace(tmpFile,indexFile)
+
+def read_index(indexFile):
+    entries=[]
+    with open(indexFile,"r") as f:
+        for line in f:
+            accession,length,recordOffset,seqOffset,endOffset=line.rstrip("\n").split("\t")
+            entries.append([accession,int(length),int(recordOffset),int(seqOffset),int(endOffset)])
+    return entries
+
+########################################################################################
+class FastaIndex:
+    # opens (building or refreshing the index if needed) and memory-maps a FASTA file
+    def __init__(self,fastaFile):
+        self.fastaFile=fastaFile
+        indexFile=index_file(fastaFile)
+        if p.isfile(indexFile) and p.getmtime(indexFile)>=p.getmtime(fastaFile):
+            entries=read_index(indexFile)
+            check_unique(entries,fastaFile)
+        else:
+            entries=build_index(fastaFile)
+            write_index(entries,indexFile)
+        # accessions in file order, and accession -> (length, recordOffset, seqOffset, endOffset)
+        self.accessions=[entry[0] for entry in entries]
+        self.entries={entry[0]:tuple(entry[1:]) for entry in entries}
+        self.file=open(fastaFile,"rb")
+        self.mm=mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ) if entries else b""
+
+    def close(self):
+        if isinstance(self.mm,mmap.mmap):
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.accessions)
+
+    def __contains__(self,accession):
+        return accession in self.entries
+
+    def length(self,accession):
+        return self.entries[accession][0]
+
+    # header line of a record, without the ">"
+    def header(self,accession):
+        _,recordOffset,seqOffset,_=self.entries[accession]
+        return self.mm[recordOffset+1:seqOffset].decode().rstrip("\r\n")
+
+    # sequence of a record as one unwrapped string
+    def fetch(self,accession):
+        _,_,seqOffset,endOffset=self.entries[accession]
+        return self.mm[seqOffset:endOffset].translate(None,b"\r\n").decode()
+
+    # raw record (header and sequence lines) as a zero-copy view of the mapped file
+    def record_bytes(self,accession):
+        _,recordOffset,_,endOffset=self.entries[accession]
+        return memoryview(self.mm)[recordOffset:endOffset]
+
+    # one FASTA text for a block of records, a single view if they are contiguous in the file.
+    # Otherwise the records are joined, each ending in a newline so the last record of a file
+    # without one doesn't run into the next header
+    def block_bytes(self,accessions):
+        views=[self.record_bytes(accession) for accession in accessions]
+        contiguous=all(self.entries[a][3]==self.entries[b][1] for a,b in zip(accessions,accessions[1:]))
+        if views and contiguous:
+            return memoryview(self.mm)[self.entries[accessions[0]][1]:self.entries[accessions[-1]][3]]
+        return b"".join(view if view[-1:]==b"\n" else bytes(view)+b"\n" for view in views)
+
+    # streams (header, sequence) for every record in file order
+    def __iter__(self):
+        for accession in self.accessions:
+            yield self.header(accession), self.fetch(accession)
+
+    ########################################################################################
+    # blocks of blockSize records in file order, as lists of accessions
+    def blocks_by_count(self,blockSize):
+        return [self.accessions[start:start+blockSize] for start in range(0,len(self.accessions),blockSize)]
+
+    # blocks of up to residuesPerBlock residues, filled longest sequence first so every block
+    # costs roughly the same. Returned most residues first
+    def blocks_by_residues(self,residuesPerBlock):
+        byLength=sorted(self.accessions,key=self.length,reverse=True)
+        blocks=[]
+        blockResidues=[]
+        for accession in byLength:
+            if not blocks or blockResidues[-1]+self.length(accession)>residuesPerBlock:
+                blocks.append([])
+                blockResidues.append(0)
+            blocks[-1].append(accession)
+            blockResidues[-1]+=self.length(accession)
+        order=sorted(range(len(blocks)),key=lambda i:blockResidues[i],reverse=True)
+        return [blocks[i] for i in order]
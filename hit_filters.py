@@ -0,0 +1,76 @@
+########################################################################################
+#   --> E-value, bit score, identity and coverage filters for BLAST hits, applied while
+#       the BLAST output is parsed so rejected HSPs never reach the hit store
+#
+#   --> Parsers produce tables in PARSE_SCHEMA: the hit store columns plus the alignment
+#       length and query coordinates the identity and coverage filters need. filter_table
+#       drops the failing rows with pyarrow compute and returns the hit store columns
+#   --> Filters run in a fixed order (E-value, bit score, identity, coverage) and each one
+#       counts the hits it was given and the hits it kept. A filter set to None is off
+#   --> identity = 100 x identical residues / alignment length
+#       coverage = 100 x query residues in the alignment / query length
+########################################################################################
+# import libraries
+import pyarrow as pa
+import pyarrow.compute as pc
+from hit_store import HIT_SCHEMA
+########################################################################################
+# all filters off, the behaviour before filtering was added
+DEFAULT_FILTERS={"maxEvalue":None,"minBitscore":None,"minIdentity":None,"minCoverage":None}
+FILTER_COLUMNS=[("Alignment Length",pa.int32()),
+                ("Query Start",pa.int32()),
+                ("Query End",pa.int32()),
+                ("Query Length",pa.int32())]
+PARSE_SCHEMA=pa.schema(list(HIT_SCHEMA)+[pa.field(name,dtype) for name,dtype in FILTER_COLUMNS])
+########################################################################################
+# the filters to apply, defaults filled in and unknown names refused (a typo would silently
+# keep everything)
+def resolve_filters(filters=None):
+    filters=dict(filters or {})
+    unknown=set(filters)-set(DEFAULT_FILTERS)
+    if unknown:
+        raise ValueError(f"unknown hit filters {sorted(unknown)}, expected {list(DEFAULT_FILTERS)}")
+    return {**DEFAULT_FILTERS,**filters}
+
+def percent_identity(table):
+    return pc.multiply(pc.divide(pc.cast(table["HSP Identity"],pa.float64()),
+                                 pc.cast(table["Alignment Length"],pa.float64())),100.0)
+
+def percent_coverage(table):
+    # query coordinates run backwards on the minus strand, so take the span either way
+    span=pc.add(pc.abs(pc.subtract(table["Query End"],table["Query Start"])),1)
+    return pc.multiply(pc.divide(pc.cast(span,pa.float64()),pc.cast(table["Query Length"],pa.float64())),100.0)
+
+# filter name -> keep mask of a table for a threshold, in the order the filters run
+FILTER_MASKS={"maxEvalue":lambda table,value:pc.less_equal(table["HSP E-value"],value),
+              "minBitscore":lambda table,value:pc.greater_equal(table["HSP Bit Score"],value),
+              "minIdentity":lambda table,value:pc.greater_equal(percent_identity(table),value),
+              "minCoverage":lambda table,value:pc.greater_equal(percent_coverage(table),value)}
+
+# applies the active filters to a PARSE_SCHEMA table, returns the kept rows as a HIT_SCHEMA
+# table and the hits in / out of each filter
+def filter_table(table,filters=None):
+    filters=resolve_filters(filters)
+    counts=[]
+    for name,mask in FILTER_MASKS.items():
+        if filters[name] is None:
+            continue
+        numIn=table.num_rows
+        # null (missing value) fails the filter
+        table=table.filter(pc.fill_null(mask(table,filters[name]),False))
+        counts.append({"filter":name,"threshold":filters[name],"in":numIn,"out":table.num_rows})
+    return table.select(HIT_SCHEMA.names), counts
+
+# adds up the counts of several tables or files, filter by filter
+def merge_counts(countLists):
+    merged={}
+    for counts in countLists:
+        for count in counts:
+            total=merged.setdefault(count["filter"],{"filter":count["filter"],"threshold":count["threshold"],"in":0,"out":0})
+            total["in"]+=count["in"]
+            total["out"]+=count["out"]
+    return list(merged.values())
+
+def print_counts(counts):
+    for count in counts:
+        print(f"-->\t {count['filter']} {count['threshold']}: {count['in']} hits in, {count['out']} out")
@@ -0,0 +1,109 @@
+########################################################################################
+#   --> Columnar store for BLAST hits
+#
+#   --> The store is a directory of parquet files, one per BLAST block
+#       (hits_block_{n}.parquet). A block is appended by writing its file, so converting
+#       a new block never touches the others and finished blocks are skipped on re-runs.
+#   --> Columns are typed (float E-value / bit score, int identity) and keep the names
+#       used by the old per-block csv files, so downstream code reads the same columns.
+#   --> Readers ask for the columns and row filters they need, pyarrow only reads those.
+#       Excel is only written on request, as a final export.
+#   --> A block can carry metadata on how it was written (03_blast_hits keeps its hit filters,
+#       their counts and the BLAST file it came from there), so a block written with other
+#       settings or from a changed file is rewritten rather than reused.
+########################################################################################
+# import libraries
+import os
+from os import path as p
+from glob import glob
+import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+########################################################################################
+HIT_SCHEMA=pa.schema([("Query Accession",pa.string()),
+                      ("Alignment Accession",pa.string()),
+                      ("Alignment Info",pa.string()),
+                      ("Alignment Sequence",pa.string()),
+                      ("HSP E-value",pa.float64()),
+                      ("HSP Bit Score",pa.float64()),
+                      ("HSP Identity",pa.int32())])
+# rows buffered in memory before a row group is written
+BATCH_ROWS=100000
+# excel sheets stop at 1,048,576 rows
+EXCEL_MAX_ROWS=1048575
+# parquet metadata key of what a block was written with (eg. the hit filters)
+METADATA_KEY=b"flavindex_block"
+########################################################################################
+def block_file(storeDir,blockNum):
+    return p.join(storeDir,f"hits_block_{blockNum}.parquet")
+
+# typed tables of up to batchRows rows from an iterable of row tuples in schema order
+def batch_tables(rows,schema=HIT_SCHEMA,batchRows=BATCH_ROWS):
+    columns=[[] for _ in schema]
+    for row in rows:
+        for column,value in zip(columns,row):
+            column.append(value)
+        if len(columns[0])>=batchRows:
+            yield to_table(columns,schema)
+    if columns[0]:
+        yield to_table(columns,schema)
+
+def to_table(columns,schema):
+    # values come from text (xml / tabular), pyarrow casts them to the schema types
+    arrays=[pa.array(column).cast(field.type) for column,field in zip(columns,schema)]
+    for column in columns:
+        column.clear()
+    return pa.Table.from_arrays(arrays,schema=schema)
+
+# writes an iterable of HIT_SCHEMA tables as one block of the store, one table at a time so
+# memory stays bounded. metadata (a json-able dict) is kept in the block, see block_metadata.
+# It is written to the file footer after the last table, so a caller streaming the tables
+# can still fill it in (eg. counts of the rows it dropped). Returns the number of rows
+def write_tables(tables,storeDir,blockNum,metadata=None):
+    outFile=block_file(storeDir,blockNum)
+    # temporary name first so readers never see a half written block
+    tmpFile=outFile+".tmp"
+    numRows=0
+    with pq.ParquetWriter(tmpFile,HIT_SCHEMA) as writer:
+        for table in tables:
+            writer.write_table(table.replace_schema_metadata(None),row_group_size=BATCH_ROWS)
+            numRows+=table.num_rows
+        if metadata is not None:
+            writer.add_key_value_metadata({METADATA_KEY:json.dumps(metadata)})
+    os.replace(tmpFile,outFile)
+    return numRows
+
+# writes an iterable of hit rows (tuples in HIT_SCHEMA order) as one block of the store
+def write_block(rows,storeDir,blockNum,metadata=None):
+    return write_tables(batch_tables(rows),storeDir,blockNum,metadata)
+
+# writes an already typed pyarrow table (HIT_SCHEMA) as one block of the store
+def write_table_block(table,storeDir,blockNum,metadata=None):
+    return write_tables([table],storeDir,blockNum,metadata)
+
+# block number -> file of every block in the store
+def store_blocks(storeDir):
+    return {p.basename(blockFile)[len("hits_block_"):-len(".parquet")]:blockFile
+            for blockFile in sorted(glob(p.join(storeDir,"hits_block_*.parquet")))}
+
+# the metadata a block was written with, None if it has none
+def block_metadata(blockFile):
+    metadata=pq.ParquetFile(blockFile).metadata.metadata or {}
+    if METADATA_KEY not in metadata:
+        return None
+    return json.loads(metadata[METADATA_KEY])
+########################################################################################
+# reads the store into a DataFrame - only the given columns, only rows passing filter
+# filter is a pyarrow expression, eg. ds.field("HSP E-value") < 1e-10
+def read_hits(storeDir,columns=None,filter=None):
+    blockFiles=sorted(glob(p.join(storeDir,"hits_block_*.parquet")))
+    dataset=ds.dataset(blockFiles,format="parquet",schema=HIT_SCHEMA)
+    return dataset.to_table(columns=columns,filter=filter).to_pandas()
+
+# optional final step: write a DataFrame to excel, refusing frames excel can't hold
+def export_excel(df,excelFile):
+    if len(df)>EXCEL_MAX_ROWS:
+        print(f"-->\t {len(df)} rows is over the excel limit, not writing {excelFile}")
+        return
+    df.to_excel(excelFile,index=False)
@@ -0,0 +1,284 @@
+########################################################################################
+#   --> Performance records for every script, appended to a JSON lines file
+#
+#   --> measure(kind,name) times a block of code, kind is "stage" (a whole step of the
+#       pipeline) or "unit" (one work item: a BLAST block, a parquet file, a chunk of pairs).
+#       It records wall time, CPU time (the process and the programs it waited on) and peak
+#       RSS. Callers add a record count, and anything else, to the dict it yields
+#   --> run_command runs an external program (blastp, cd-hit, colabfold_batch) and records its
+#       runtime, exit code and its own CPU time and peak RSS, taken from wait4
+#   --> Units and commands carry the name of the stage they ran in, pool workers inherit it
+#   --> The file is {metricsFile}, set by set_metrics_file or the FLAVINDEX_METRICS variable,
+#       one line per record. Lines are written with a single append, so workers share a file
+#
+#   --> Usage:
+#           python instrumentation.py report metrics.jsonl [--top 10]
+########################################################################################
+# import libraries
+import os
+from os import path as p
+import argparse
+import json
+import resource
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+########################################################################################
+METRICS_ENV="FLAVINDEX_METRICS"
+DEFAULT_METRICS_FILE="metrics.jsonl"
+currentStage=None
+
+# child processes (pool workers, the runner's stage processes) pick the file up from the environment
+def set_metrics_file(metricsFile):
+    os.environ[METRICS_ENV]=p.abspath(metricsFile)
+    return os.environ[METRICS_ENV]
+
+def metrics_file():
+    return os.environ.get(METRICS_ENV,DEFAULT_METRICS_FILE)
+
+def record(kind,name,**fields):
+    entry={"time":time.strftime("%Y-%m-%d %H:%M:%S"),"timestamp":time.time(),"kind":kind,"name":name,
+           "stage":currentStage,"host":socket.gethostname(),"pid":os.getpid(),**fields}
+    line=json.dumps(entry,default=str)+"\n"
+    # one write on an O_APPEND descriptor, lines from different processes don't interleave
+    fd=os.open(metrics_file(),os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    try:
+        os.write(fd,line.encode())
+    finally:
+        os.close(fd)
+    return entry
+########################################################################################
+## peak RSS
+# linux keeps a resettable high water mark (VmHWM), so each unit gets its own peak even when a
+# worker runs many. Elsewhere this falls back to ru_maxrss, the peak of the process so far
+#   --> measures nest (a unit inside a stage), so before a reset the peak so far is carried
+#       into every measure still open in the process, which reports the larger of the two
+#   --> VmHWM is per process, a unit running on a thread can't tell its memory from that of
+#       the other threads: it neither resets the mark nor reports a peak
+peakLock=threading.Lock()
+# pid the open measures belong to (a forked child starts with none) and their carried peaks
+openPeaks={"pid":None,"peaks":{}}
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs","w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status","r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+# resident set now, the baseline a peak is measured from. None where /proc isn't there
+def rss_mb():
+    try:
+        with open("/proc/self/status","r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return None
+
+def cpu_seconds(usage):
+    return usage.ru_utime+usage.ru_stime
+
+# opens the peak of a measure, returns its token (None on a thread, where there is no peak)
+def open_peak():
+    if threading.current_thread() is not threading.main_thread():
+        return None
+    token=object()
+    with peakLock:
+        if openPeaks["pid"]!=os.getpid():
+            openPeaks["pid"]=os.getpid()
+            openPeaks["peaks"]={}
+        peakSoFar=peak_rss_mb()
+        for other in openPeaks["peaks"]:
+            openPeaks["peaks"][other]=max(openPeaks["peaks"][other],peakSoFar)
+        reset_peak_rss()
+        openPeaks["peaks"][token]=0.0
+    return token
+
+# peak since open_peak, including what nested measures reset in between
+def close_peak(token):
+    if token is None:
+        return None
+    with peakLock:
+        return max(peak_rss_mb(),openPeaks["peaks"].pop(token,0.0))
+########################################################################################
+# times the block of code inside the with statement and records it on exit, also when it raises
+#   with measure("unit","blast_block",block=3) as metrics:
+#       ...
+#       metrics["records"]=numSequences
+def measure(kind,name,**fields):
+    return _measure(kind,name,fields)
+
+@contextmanager
+def _measure(kind,name,fields):
+    global currentStage
+    previousStage=currentStage
+    if kind=="stage":
+        currentStage=name
+    peakToken=open_peak()
+    selfStart=resource.getrusage(resource.RUSAGE_SELF)
+    childStart=resource.getrusage(resource.RUSAGE_CHILDREN)
+    startTime=time.perf_counter()
+    metrics=dict(fields)
+    try:
+        yield metrics
+        metrics.setdefault("ok",True)
+    except BaseException as e:
+        metrics["ok"]=False
+        metrics["error"]=repr(e)[:500]
+        raise
+    finally:
+        wallTime=time.perf_counter()-startTime
+        selfEnd=resource.getrusage(resource.RUSAGE_SELF)
+        childEnd=resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpuTime=cpu_seconds(selfEnd)-cpu_seconds(selfStart)+cpu_seconds(childEnd)-cpu_seconds(childStart)
+        # a stage's peak includes its pool workers and programs, the largest of them
+        peakRss=close_peak(peakToken)
+        if kind=="stage" and peakRss is not None:
+            peakRss=max(peakRss,childEnd.ru_maxrss/1024)
+        records=metrics.get("records")
+        record(kind,name,wallSeconds=wallTime,cpuSeconds=cpuTime,peakRssMb=peakRss,
+               recordsPerSec=records/wallTime if records is not None and wallTime>0 else None,**metrics)
+        currentStage=previousStage
+
+########################################################################################
+def _feed(stream,data):
+    try:
+        stream.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        stream.close()
+
+def _drain(stream,chunks):
+    chunks.append(stream.read())
+    stream.close()
+
+# subprocess.run look-alike that reaps the program with wait4, so its own CPU time and peak RSS
+# are recorded rather than those of every child of this process. input is fed on stdin,
+# stdout / stderr are returned when set to subprocess.PIPE. log=False skips the record, for
+# callers running so many short commands that their unit record stands in for them
+def run_command(command,input=None,check=False,name=None,log=True,**popenArgs):
+    name=name or p.basename(command[0])
+    startTime=time.perf_counter()
+    process=subprocess.Popen(command,stdin=subprocess.PIPE if input is not None else popenArgs.pop("stdin",None),
+                             **popenArgs)
+    # stdin / stdout / stderr are serviced from threads so a full pipe never blocks the program
+    threads=[]
+    outputs={"stdout":[],"stderr":[]}
+    if input is not None:
+        data=input.encode() if isinstance(input,str) and not hasattr(process.stdin,"encoding") else input
+        threads.append(threading.Thread(target=_feed,args=(process.stdin,data)))
+    for stream in ["stdout","stderr"]:
+        if getattr(process,stream) is not None:
+            threads.append(threading.Thread(target=_drain,args=(getattr(process,stream),outputs[stream])))
+    for thread in threads:
+        thread.start()
+    _,status,usage=os.wait4(process.pid,0)
+    process.returncode=os.waitstatus_to_exitcode(status)
+    for thread in threads:
+        thread.join()
+    wallTime=time.perf_counter()-startTime
+    # ru_maxrss is in kB on linux
+    if log:
+        record("command",name,command=" ".join(str(arg) for arg in command)[:1000],exitCode=process.returncode,
+               wallSeconds=wallTime,cpuSeconds=cpu_seconds(usage),peakRssMb=usage.ru_maxrss/1024)
+    stdout=outputs["stdout"][0] if outputs["stdout"] else None
+    stderr=outputs["stderr"][0] if outputs["stderr"] else None
+    if check and process.returncode!=0:
+        raise subprocess.CalledProcessError(process.returncode,command,stdout,stderr)
+    return subprocess.CompletedProcess(command,process.returncode,stdout,stderr)
+
+########################################################################################
+## report
+# largest of the peaks, blank for units that ran on threads and have none
+def format_peak(peaks):
+    peaks=[peak for peak in peaks if peak is not None]
+    return f"{max(peaks):.0f}" if peaks else ""
+
+def load_records(metricsFiles):
+    records=[]
+    for metricsFile in metricsFiles:
+        with open(metricsFile,"r") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+    return records
+
+# per stage totals, per unit type throughput and spread, the slowest units, per program totals,
+# and how busy each stage kept its workers (unit seconds over stage seconds x workers)
+def report(records,top=10):
+    stages=[r for r in records if r["kind"]=="stage"]
+    units=[r for r in records if r["kind"]=="unit"]
+    commands=[r for r in records if r["kind"]=="command"]
+
+    print("== stages")
+    print(f"{'stage':<24}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'records':>12}{'rec/s':>12}{'pool util':>11}")
+    for s in stages:
+        # units of this run of the stage, the file may hold several runs
+        stageStart=s["timestamp"]-s["wallSeconds"]
+        stageUnits=[u for u in units if u["stage"]==s["name"] and stageStart<=u["timestamp"]<=s["timestamp"]]
+        numWorkers=s.get("workers") or len({(u["host"],u["pid"]) for u in stageUnits}) or 1
+        utilisation=""
+        if stageUnits and s["wallSeconds"]>0:
+            utilisation=f"{sum(u['wallSeconds'] for u in stageUnits)/(s['wallSeconds']*numWorkers):.0%}"
+        records="" if s.get("records") is None else s["records"]
+        throughput="" if s.get("recordsPerSec") is None else f"{s['recordsPerSec']:.1f}"
+        print(f"{s['name']:<24}{s['wallSeconds']:>10.1f}{s['cpuSeconds']:>10.1f}{format_peak([s['peakRssMb']]):>10}"
+              f"{records:>12}{throughput:>12}{utilisation:>11}"+("" if s.get("ok",True) else "  FAILED"))
+
+    print("\n== units")
+    print(f"{'stage/unit':<36}{'count':>8}{'mean s':>10}{'max s':>10}{'records':>12}{'rec/s':>12}{'max MB':>10}")
+    groups={}
+    for u in units:
+        groups.setdefault((u["stage"],u["name"]),[]).append(u)
+    for (stage,name),group in groups.items():
+        wallTimes=[u["wallSeconds"] for u in group]
+        records=sum(u.get("records") or 0 for u in group)
+        throughput=records/sum(wallTimes) if sum(wallTimes)>0 else 0
+        unitName=f"{stage}/{name}"
+        print(f"{unitName:<36}{len(group):>8}{sum(wallTimes)/len(group):>10.2f}{max(wallTimes):>10.2f}"
+              f"{records:>12}{throughput:>12.1f}{format_peak(u['peakRssMb'] for u in group):>10}")
+
+    print(f"\n== slowest {top} units")
+    for u in sorted(units,key=lambda u:u["wallSeconds"],reverse=True)[:top]:
+        details={k:v for k,v in u.items() if k not in ["time","timestamp","kind","name","stage","host","pid","wallSeconds",
+                                                       "cpuSeconds","peakRssMb","recordsPerSec","ok"]}
+        print(f"{u['wallSeconds']:>10.2f} s  {u['stage']}/{u['name']}  {details}")
+
+    print("\n== commands")
+    print(f"{'program':<20}{'runs':>8}{'failed':>8}{'total s':>10}{'mean s':>10}{'cpu s':>10}{'max MB':>10}")
+    programs={}
+    for c in commands:
+        programs.setdefault(c["name"],[]).append(c)
+    for name,group in programs.items():
+        total=sum(c["wallSeconds"] for c in group)
+        print(f"{name:<20}{len(group):>8}{sum(c['exitCode']!=0 for c in group):>8}{total:>10.1f}{total/len(group):>10.2f}"
+              f"{sum(c['cpuSeconds'] for c in group):>10.1f}{max(c['peakRssMb'] for c in group):>10.0f}")
+
+def main():
+    parser=argparse.ArgumentParser(description="summarise FlavInDex performance records")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+    reportParser=subparsers.add_parser("report",help="throughput, slowest units and pool utilisation")
+    reportParser.add_argument("metricsFiles",nargs="+")
+    reportParser.add_argument("--top",type=int,default=10,help="number of slowest units to list")
+    args=parser.parse_args()
+    report(load_records(args.metricsFiles),args.top)
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
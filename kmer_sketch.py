@@ -0,0 +1,62 @@
+########################################################################################
+#   --> k-mer sketches of protein sequences, used to find candidate pairs before aligning
+#
+#   --> Every sequence becomes a binary row of a sparse (numSeqs x 24^k) matrix holding
+#       its distinct k-mers. Shared k-mer counts for a block of rows against all rows are
+#       one sparse matrix product, so candidate search never touches the full N x N
+#       table at once.
+#   --> Sketch similarity is the k-mer containment of the shorter sequence:
+#           shared k-mers / min(k-mers in i, k-mers in j)
+#       for k=4 unrelated flavoproteins sit well below 0.01
+########################################################################################
+# import libraries
+import numpy as np
+from scipy import sparse
+from smith_waterman import RESIDUE_LOOKUP, PAD_CODE
+########################################################################################
+# residues are coded with the BLOSUM62 alphabet of smith_waterman (24 letters)
+ALPHABET_SIZE=PAD_CODE
+
+# distinct k-mer codes of one sequence as a sorted int64 array
+def kmer_codes(sequence,kmerSize):
+    if len(sequence)<kmerSize:
+        return np.zeros(0,dtype=np.int64)
+    residues=RESIDUE_LOOKUP[np.frombuffer(sequence.encode("ascii"),dtype=np.uint8)].astype(np.int64)
+    codes=np.zeros(len(residues)-kmerSize+1,dtype=np.int64)
+    for offset in range(kmerSize):
+        codes=codes*ALPHABET_SIZE+residues[offset:offset+len(codes)]
+    return np.unique(codes)
+
+# binary CSR matrix, one row per sequence, one column per possible k-mer
+def sketch_matrix(sequences,kmerSize=4):
+    rowCodes=[kmer_codes(sequence,kmerSize) for sequence in sequences]
+    indptr=np.zeros(len(sequences)+1,dtype=np.int64)
+    indptr[1:]=np.cumsum([len(codes) for codes in rowCodes])
+    indices=np.concatenate(rowCodes) if rowCodes else np.zeros(0,dtype=np.int64)
+    data=np.ones(len(indices),dtype=np.int32)
+    return sparse.csr_matrix((data,indices,indptr),
+                             shape=(len(sequences),ALPHABET_SIZE**kmerSize))
+
+########################################################################################
+# pairs (i<j) whose sketch similarity is at least cutoff, sorted by i then j
+# returns arrays rows, cols, similarities
+def candidate_pairs(sketches,cutoff,blockRows=1000):
+    numSeqs=sketches.shape[0]
+    kmerCounts=np.asarray(sketches.sum(axis=1)).ravel()
+    sketchesT=sketches.T.tocsr()
+    rows, cols, sims = [], [], []
+    for start in range(0,numSeqs,blockRows):
+        stop=min(start+blockRows,numSeqs)
+        # shared k-mer counts of this block against every sequence, upper triangle only
+        shared=sparse.triu(sketches[start:stop]@sketchesT,k=start+1).tocoo()
+        blockRowIdx=shared.row+start
+        smaller=np.minimum(kmerCounts[blockRowIdx],kmerCounts[shared.col])
+        similarity=shared.data/np.maximum(smaller,1)
+        keep=similarity>=cutoff
+        order=np.lexsort((shared.col[keep],blockRowIdx[keep]))
+        rows.append(blockRowIdx[keep][order])
+        cols.append(shared.col[keep][order])
+        sims.append(similarity[keep][order])
+    if not rows:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.int64), np.zeros(0)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(sims)
@@ -0,0 +1,184 @@
+########################################################################################
+#   --> Flavin-binding motif scan of the BLAST hits (or any FASTA), an annotation for the
+#       hits the UniProt spreadsheets know nothing about
+#
+#   --> Motifs are named regular expressions, MOTIFS by default or a json file of
+#       {name: pattern}. Matches may overlap (GXGXXG inside GXGXXGXXG counts twice)
+#   --> The hit store is scanned in parallel, one task per parquet row group. Each task first
+#       finds the sequences holding a motif at all with pyarrow's vectorized regex match, and
+#       only those get the per match positions
+#   --> Matches come back as a table: accession, motif, start, end (1-based, inclusive) and
+#       the matched residues. Hit sequences are the aligned part of the subject with gaps
+#       removed, so positions count from the start of the alignment, not of the protein
+#   --> As a prefilter, matched_accessions gives the accessions carrying a motif and
+#       filter_fasta keeps only those records, before clustering or folding. matched_records
+#       checks given sequences themselves, for when only one of an accession's HSPs is kept
+#
+#   --> Usage:
+#           python motif_scan.py store blast_hit_store --out motif_matches.parquet [--motifs motifs.json]
+#           python motif_scan.py fasta sequences.fasta --out motif_matches.parquet [--keep with_motif.fasta]
+########################################################################################
+# import libraries
+import os
+from os import path as p
+from glob import glob
+import argparse
+import json
+import multiprocessing
+import re
+from functools import partial
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from fasta_index import iter_fasta, header_accession, format_record
+# performance records
+from instrumentation import measure
+########################################################################################
+MOTIFS={# Rossmann fold dinucleotide binding loop, FAD / NAD(P)
+        "rossmann_GXGXXG":"G.G..G",
+        # the GXGXXA variant common in FAD binding domains
+        "rossmann_GXGXXA":"G.G..A",
+        # GG motif of FAD dependent oxidoreductases, RXGGRXXS/T
+        "gg_motif":"R.GGR..[ST]",
+        # flavodoxin FMN binding signature (PROSITE PS00201)
+        "flavodoxin_fmn":"[LIV][LIVFY][FY].[ST]..[AG].[AGT]..[AT]..[LIVM]"}
+MATCH_SCHEMA=pa.schema([("accession",pa.string()),
+                        ("motif",pa.string()),
+                        ("start",pa.int32()),
+                        ("end",pa.int32()),
+                        ("match",pa.string())])
+########################################################################################
+# patterns are compiled up front, so a typo fails before any worker starts. They have to suit
+# both python's re and pyarrow's RE2 (no lookarounds or backreferences)
+def check_motifs(motifs):
+    for name,pattern in motifs.items():
+        try:
+            re.compile(pattern)
+            pc.match_substring_regex(pa.array([""]),pattern)
+        except (re.error,pa.ArrowInvalid) as e:
+            raise ValueError(f"motif {name}: bad pattern {pattern!r} ({e})")
+    return dict(motifs)
+
+# motifs from a json file of {name: pattern}, MOTIFS without one
+def load_motifs(motifFile=None):
+    if motifFile is None:
+        return dict(MOTIFS)
+    with open(motifFile,"r") as f:
+        return check_motifs(json.load(f))
+
+# aligned sequences carry gaps, motifs are matched on the residues
+def ungapped(sequences):
+    return pc.utf8_upper(pc.replace_substring(sequences,"-",""))
+
+# every (overlapping) match of every motif in the accession / sequence arrays
+def scan_sequences(accessions,sequences,motifs):
+    sequences=ungapped(sequences)
+    columns={name:[] for name in MATCH_SCHEMA.names}
+    for name,pattern in motifs.items():
+        # vectorized has-a-match first, positions only for the sequences that have one
+        hasMatch=pc.fill_null(pc.match_substring_regex(sequences,pattern),False)
+        # a lookahead finds overlapping matches
+        regex=re.compile(f"(?=({pattern}))")
+        for accession,sequence in zip(pc.filter(accessions,hasMatch).to_pylist(),pc.filter(sequences,hasMatch).to_pylist()):
+            for match in regex.finditer(sequence):
+                columns["accession"].append(accession)
+                columns["motif"].append(name)
+                columns["start"].append(match.start()+1)
+                columns["end"].append(match.start()+len(match.group(1)))
+                columns["match"].append(match.group(1))
+    return pa.Table.from_pydict(columns,schema=MATCH_SCHEMA)
+########################################################################################
+## hit store
+# one task per row group of every block
+def store_chunks(storeDir):
+    return [(blockFile,rowGroup) for blockFile in sorted(glob(p.join(storeDir,"hits_block_*.parquet")))
+            for rowGroup in range(pq.ParquetFile(blockFile).num_row_groups)]
+
+def scan_chunk(chunk,motifs):
+    blockFile,rowGroup=chunk
+    with measure("unit","motif_chunk",file=p.basename(blockFile),rowGroup=rowGroup) as metrics:
+        table=pq.ParquetFile(blockFile).read_row_group(rowGroup,columns=["Alignment Accession","Alignment Sequence"])
+        # a subject hit by many queries is often the same aligned sequence, scanned once
+        table=table.group_by(["Alignment Accession","Alignment Sequence"]).aggregate([])
+        matches=scan_sequences(table["Alignment Accession"],table["Alignment Sequence"],motifs)
+        metrics["records"]=table.num_rows
+        metrics["matches"]=matches.num_rows
+    return matches
+
+# scans the whole hit store, returns the matches (repeats across chunks dropped)
+def scan_hit_store(storeDir,motifs=None,numWorkers=None):
+    motifs=check_motifs(motifs or MOTIFS)
+    chunks=store_chunks(storeDir)
+    with multiprocessing.Pool(processes=numWorkers or os.cpu_count()) as pool:
+        tables=pool.map(partial(scan_chunk,motifs=motifs),chunks)
+    matches=pa.concat_tables([MATCH_SCHEMA.empty_table()]+tables)
+    matches=matches.group_by(MATCH_SCHEMA.names).aggregate([]).select(MATCH_SCHEMA.names)
+    print(f"-->\t {matches.num_rows} motif matches in {len(pc.unique(matches['accession']))} accessions, "
+          f"{len(chunks)} chunks scanned")
+    return matches
+
+########################################################################################
+## fasta
+def scan_fasta(fastaFile,motifs=None):
+    accessions,sequences=[],[]
+    for header,sequence in iter_fasta(fastaFile):
+        accessions.append(header_accession(header))
+        sequences.append(sequence)
+    return scan_sequences(pa.array(accessions,pa.string()),pa.array(sequences,pa.string()),check_motifs(motifs or MOTIFS))
+
+# accessions with at least one match, of any motif or of the given ones
+def matched_accessions(matches,motifNames=None):
+    if motifNames is not None:
+        matches=matches.filter(pc.is_in(matches["motif"],pa.array(list(motifNames),pa.string())))
+    return set(pc.unique(matches["accession"]).to_pylist())
+
+# per record, whether its own sequence carries a match. An accession's matches come from every
+# sequence scanned for it (every HSP in the hit store), so matched_accessions can't vouch for
+# one particular sequence. A matched stretch is a motif match wherever it occurs, so checking
+# the record's residues for the accession's matched strings is exact for any scanned sequence
+def matched_records(accessions,sequences,matches,motifNames=None):
+    if motifNames is not None:
+        matches=matches.filter(pc.is_in(matches["motif"],pa.array(list(motifNames),pa.string())))
+    matched={}
+    for accession,match in zip(matches["accession"].to_pylist(),matches["match"].to_pylist()):
+        matched.setdefault(accession,set()).add(match)
+    sequences=ungapped(pa.array(sequences,pa.string())).to_pylist()
+    return [any(match in sequence for match in matched.get(accession,()))
+            for accession,sequence in zip(accessions,sequences)]
+
+# copies the records of fastaFile with a motif match to outFasta, returns the number kept
+def filter_fasta(fastaFile,outFasta,matches,motifNames=None):
+    keep=matched_accessions(matches,motifNames)
+    numKept=0
+    with open(outFasta,"w") as f:
+        for header,sequence in iter_fasta(fastaFile):
+            if header_accession(header) in keep:
+                f.write(format_record(header,sequence))
+                numKept+=1
+    return numKept
+
+def main():
+    parser=argparse.ArgumentParser(description="scan sequences for flavin-binding motifs")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+    storeParser=subparsers.add_parser("store",help="scan every sequence of the BLAST hit store")
+    storeParser.add_argument("storeDir")
+    storeParser.add_argument("--workers",type=int,default=None)
+    fastaParser=subparsers.add_parser("fasta",help="scan a fasta file, optionally keeping the records with a motif")
+    fastaParser.add_argument("fastaFile")
+    fastaParser.add_argument("--keep",default=None,help="fasta file for the records with a match")
+    for subparser in [storeParser,fastaParser]:
+        subparser.add_argument("--out",required=True,help="parquet file of the matches")
+        subparser.add_argument("--motifs",default=None,help="json file of {name: regex}, default the built-in motifs")
+    args=parser.parse_args()
+    motifs=load_motifs(args.motifs)
+    if args.command=="store":
+        matches=scan_hit_store(args.storeDir,motifs,args.workers)
+    else:
+        matches=scan_fasta(args.fastaFile,motifs)
+        if args.keep is not None:
+            print(f"-->\t {filter_fasta(args.fastaFile,args.keep,matches)} records with a motif written to {args.keep}")
+    pq.write_table(matches,args.out)
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
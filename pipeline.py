@@ -0,0 +1,406 @@
+########################################################################################
+#   --> Incremental runner for the whole pipeline, dataset build to folding
+#
+#   --> Every path comes from one JSON config (see pipeline_config.json). Relative paths are
+#       taken from the config's "root"
+#   --> Each stage declares the config paths it reads and writes. A stage's cache key is a
+#       hash of its parameters and the contents of its inputs. It reruns only when that key
+#       differs from the one in the state file, or when its outputs are missing or were changed
+#   --> Stages run in their own process as soon as their upstream stages finish, so
+#       independent branches (eg. folding and BLAST) run side by side. A failed stage only
+#       holds back the stages downstream of it, the next run picks up from there
+#   --> Files are hashed by content (sha256, memoised on size and mtime in the state file).
+#       Directories (eg. the hit store) and the BLAST database are fingerprinted by the name,
+#       size and mtime of every file in them
+#
+#   --> Usage:
+#           python pipeline.py pipeline_config.json [--stages a,b] [--force a,b] [--dry-run]
+########################################################################################
+# import libraries
+import os
+from os import path as p
+import argparse
+import glob
+import hashlib
+import importlib
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import time
+import traceback
+import pandas as pd
+# performance records
+from instrumentation import measure, set_metrics_file
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+def script(name):
+    return importlib.import_module(name)
+
+def load_config(configFile):
+    with open(configFile,"r") as f:
+        config=json.load(f)
+    root=p.abspath(p.join(p.dirname(p.abspath(configFile)),config.get("root",".")))
+    config["paths"]={key:p.normpath(p.join(root,path)) for key,path in config["paths"].items()}
+    return config
+
+def load_state(stateFile):
+    if not p.isfile(stateFile):
+        return {"stages":{},"hashes":{}}
+    with open(stateFile,"r") as f:
+        return json.load(f)
+
+# written to a temporary file then renamed, so a crash never leaves a half written state
+def save_state(state,stateFile):
+    tmpFile=stateFile+".tmp"
+    with open(tmpFile,"w") as f:
+        json.dump(state,f,indent=1)
+    os.replace(tmpFile,stateFile)
+########################################################################################
+## fingerprints
+def sha256_file(file):
+    digest=hashlib.sha256()
+    with open(file,"rb") as f:
+        for chunk in iter(lambda:f.read(1024*1024),b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# content hash of a file, only recomputed when its size or mtime changed
+def hash_file(file,memo):
+    stat=os.stat(file)
+    cached=memo.get(file)
+    if cached and cached["size"]==stat.st_size and cached["mtime"]==stat.st_mtime_ns:
+        return cached["sha256"]
+    digest=sha256_file(file)
+    memo[file]={"size":stat.st_size,"mtime":stat.st_mtime_ns,"sha256":digest}
+    return digest
+
+# name, size and mtime of every file below a directory
+def hash_dir(dir):
+    digest=hashlib.sha256()
+    for root,dirs,files in os.walk(dir):
+        dirs.sort()
+        for file in sorted(files):
+            stat=os.stat(p.join(root,file))
+            digest.update(f"{p.relpath(p.join(root,file),dir)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+# None for a path that does not exist. A path that is neither a file nor a directory is taken
+# as a prefix, as BLAST database names are, and fingerprinted through the files that share it
+def fingerprint(path,memo):
+    if p.isfile(path):
+        return hash_file(path,memo)
+    if p.isdir(path):
+        return hash_dir(path)
+    prefixFiles=sorted(glob.glob(glob.escape(path)+".*"))
+    if prefixFiles:
+        digest=hashlib.sha256()
+        for file in prefixFiles:
+            stat=os.stat(file)
+            digest.update(f"{p.basename(file)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+    return None
+
+# moving an output also invalidates the stage
+def stage_key(name,parameters,inputHashes,outputPaths):
+    payload=json.dumps({"stage":name,"parameters":parameters,"inputs":inputHashes,"outputs":outputPaths},sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+########################################################################################
+## stages - each takes the config's paths and the stage's parameters, and raises on failure
+## the number of records processed is returned for the performance record, where there is one
+def build_dataset(paths,params):
+    from dataset_build import build_dataset, write_dataset
+    dataNonRedundant,dataAlphaFold=build_dataset([paths["fadExcel"],paths["fmnExcel"]],paths["photoenzymeExcel"],
+                                                 paths["sheetCache"])
+    ifnotmkdir(p.dirname(paths["dataset"]))
+    write_dataset(dataNonRedundant,dataAlphaFold,paths["dataset"],paths["datasetAlphaFold"],paths["datasetFasta"])
+    return len(dataNonRedundant)
+
+def download_structures(paths,params):
+    from alphafold_fetch import fetch_structures
+    dataset=pd.read_parquet(paths["datasetAlphaFold"],columns=["AlphaFoldDB"])
+    summary=fetch_structures(dataset["AlphaFoldDB"],paths["structuresDir"],**params)
+    print(summary)
+    # accessions without a model are recorded in the manifest and final, only errors worth a
+    # retry (network, 429, 5xx) keep the stage from being current
+    if summary["failed"]:
+        raise RuntimeError(f"{summary['failed']} structures failed to download")
+    return summary["downloaded"]
+
+def initial_clustering(paths,params):
+    clustering=script("02_CD-hit_cluster")
+    clusterDir=ifnotmkdir(p.dirname(paths["initialClusterFasta"]))
+    outputFile,clstrFile=clustering.run_clustering(paths["datasetFasta"],params["tolerance"],clusterDir)
+    os.replace(outputFile,paths["initialClusterFasta"])
+    os.replace(clstrFile,paths["initialClusterFasta"]+".clstr")
+
+def local_blast(paths,params):
+    ledger=script("03_local_blast").blast_fasta(paths["initialClusterFasta"],paths["blastDatabase"],
+                                               ifnotmkdir(paths["blastResultsDir"]),**params)
+    failed=[record["block"] for record in ledger.values() if record.get("state")!="done"]
+    if failed:
+        raise RuntimeError(f"BLAST blocks not done: {sorted(failed)}")
+    return len(ledger)
+
+def parse_hits(paths,params):
+    # blocks of unchanged BLAST files are reused, blocks without a BLAST file are removed
+    ifnotmkdir(p.dirname(paths["nonRedundantHits"]))
+    blastDf,_=script("03_blast_hits").build_hit_store(paths["blastResultsDir"],paths["hitStoreDir"],
+                                                      paths["nonRedundantHits"],**params)
+    return len(blastDf)
+
+# flavin-binding motif matches of every sequence in the hit store
+def motif_scan(paths,params):
+    import pyarrow.parquet as pq
+    from motif_scan import scan_hit_store
+    matches=scan_hit_store(paths["hitStoreDir"],**params)
+    ifnotmkdir(p.dirname(paths["motifMatches"]))
+    pq.write_table(matches,paths["motifMatches"])
+    return matches.num_rows
+
+# BLAST hits plus the dataset they were found from, one row per sequence. With motifPrefilter
+# only hits carrying a flavin-binding motif go on to clustering, the dataset is always kept
+def include_inputs(paths,params):
+    hitsDf=pd.read_parquet(paths["nonRedundantHits"],columns=["Alignment Accession","Alignment Sequence","FASTA"])
+    hitsDf=hitsDf.rename(columns={"Alignment Accession":"Entry","Alignment Sequence":"Sequence"})
+    if params["motifPrefilter"]:
+        from motif_scan import matched_records
+        import pyarrow.parquet as pq
+        # the scan covered every HSP, only the first one of each hit is kept, so the kept
+        # sequence itself has to carry the motif
+        withMotif=matched_records(hitsDf["Entry"].tolist(),hitsDf["Sequence"].tolist(),
+                                  pq.read_table(paths["motifMatches"]))
+        numHits=len(hitsDf)
+        hitsDf=hitsDf[withMotif]
+        print(f"-->\t {len(hitsDf)} of {numHits} hits carry a motif")
+    # assign, not item assignment: after the prefilter hitsDf is a slice of the hits
+    hitsDf=hitsDf.assign(Input=False)
+    inputsDf=pd.read_parquet(paths["dataset"],columns=["Entry","Sequence"])
+    inputsDf["FASTA"]=">"+inputsDf["Entry"]+"\n"+inputsDf["Sequence"]
+    inputsDf["Input"]=True
+    # inputs first, so a hit that is also an input keeps its dataset entry
+    combined=pd.concat([inputsDf,hitsDf],ignore_index=True).drop_duplicates(subset="Sequence")
+    combined.to_parquet(paths["reclusterInput"],index=False)
+    return len(combined)
+
+def recluster(paths,params):
+    dataDf=pd.read_parquet(paths["reclusterInput"])
+    script("02_CD-hit_cluster").recluster(dataDf,ifnotmkdir(paths["reclusterDataDir"]),
+                                          ifnotmkdir(paths["reclusterDir"]),**params)
+    return len(dataDf)
+
+def similarity(paths,params):
+    return script("03_Calculate_similarity").gen_similarity_matrix(paths["similarityFasta"],
+                                                                   outDir=ifnotmkdir(paths["similarityDir"]),**params)
+
+# clusters the similarity output at every threshold in one pass, the matrix if there is one,
+# otherwise the sketch prefiltered edge list
+def threshold_sweep(paths,params):
+    from threshold_sweep import sweep_thresholds
+    matrixName=p.join(paths["similarityDir"],f"similarity_matrix_{params['similarityName']}")
+    if p.isfile(matrixName+".npy"):
+        similarityFile=matrixName
+    else:
+        similarityFile=p.join(paths["similarityDir"],f"similarity_edges_{params['similarityName']}.csv")
+    membershipDf=sweep_thresholds(paths["similarityFasta"],similarityFile,params["thresholds"])
+    ifnotmkdir(p.dirname(paths["sweepMembership"]))
+    membershipDf.to_parquet(paths["sweepMembership"])
+    return len(membershipDf)
+
+# the persistent query index of the final dataset, with CD-HIT cluster membership and which
+# AlphaFold models were actually downloaded
+def query_index(paths,params):
+    from query_index import build_index_from_files
+    meta=build_index_from_files(paths["reclusterInput"],paths["queryIndexDir"],paths["dataset"],
+                                p.join(paths["reclusterDir"],"cluster_membership.parquet"),
+                                manifestFile=p.join(paths["structuresDir"],"download_manifest.tsv"),**params)
+    return meta["numEntries"]
+
+# every downloaded and predicted structure parsed into one memory-mapped archive
+def structure_archive(paths,params):
+    from structure_archive import build_archive
+    header=build_archive([paths["structuresDir"],paths["predictionsDir"]],paths["structureArchive"],
+                         fastaFiles=[paths["foldingFasta"]],**params)
+    return header["numProteins"]
+
+def folding(paths,params):
+    numMissing=script("04_colabfold_fold_from_fasta").fold_fasta(paths["foldingFasta"],paths["foldingBatchDir"],
+                                                                 paths["predictionsDir"],**params)
+    if numMissing:
+        raise RuntimeError(f"{numMissing} sequences have no prediction")
+
+# stage: (function, config paths read, config paths written, default parameters), in pipeline order
+# a stage depends on every stage that writes one of the paths it reads
+STAGES={"dataset":(build_dataset,["fadExcel","fmnExcel","photoenzymeExcel"],
+                   ["dataset","datasetAlphaFold","datasetFasta"],{}),
+        "structures":(download_structures,["datasetAlphaFold"],["structuresDir"],{"maxWorkers":16}),
+        "initial_clustering":(initial_clustering,["datasetFasta"],["initialClusterFasta"],{"tolerance":0.5}),
+        "local_blast":(local_blast,["initialClusterFasta","blastDatabase"],["blastResultsDir"],
+                       {"residuesPerBlock":2000,"totalCores":15,"outputFormat":"xml","warmDatabase":False}),
+        "parse_hits":(parse_hits,["blastResultsDir"],["hitStoreDir","nonRedundantHits"],{"exportExcel":False,"filters":{}}),
+        "motif_scan":(motif_scan,["hitStoreDir"],["motifMatches"],{"motifs":None,"numWorkers":None}),
+        "include_inputs":(include_inputs,["nonRedundantHits","dataset"],["reclusterInput"],{"motifPrefilter":False}),
+        "recluster":(recluster,["reclusterInput"],["reclusterDir","reclusterDataDir","similarityFasta"],
+                     {"tolerances":[0.5,0.6,0.7,0.8,0.9],"cascade":True}),
+        "similarity":(similarity,["similarityFasta"],["similarityDir"],
+                      {"outputName":"50percent","backend":"blastp","sketchCutoff":None}),
+        "threshold_sweep":(threshold_sweep,["similarityFasta","similarityDir"],["sweepMembership"],
+                           {"similarityName":"50percent","thresholds":[0.5,0.6,0.7,0.8,0.9]}),
+        "query_index":(query_index,["reclusterInput","dataset","reclusterDir","structuresDir"],["queryIndexDir"],
+                       {"kmerSize":4}),
+        "folding":(folding,["foldingFasta"],["predictionsDir"],{"batchSize":50,"numWorkers":1}),
+        "structure_archive":(structure_archive,["structuresDir","predictionsDir","foldingFasta"],["structureArchive"],
+                             {"numWorkers":None})}
+# stage: {config path: parameter}, paths a stage only reads when that parameter is set
+OPTIONAL_INPUTS={"include_inputs":{"motifMatches":"motifPrefilter"}}
+
+def stage_parameters(config,name):
+    return {**STAGES[name][3],**config.get("parameters",{}).get(name,{})}
+
+# the config paths a stage reads with its parameters in the config
+def stage_inputs(config,name):
+    params=stage_parameters(config,name)
+    return STAGES[name][1]+[key for key,param in OPTIONAL_INPUTS.get(name,{}).items() if params[param]]
+
+def upstream_stages(config,name):
+    inputKeys=stage_inputs(config,name)
+    return [other for other,(_,_,outputKeys,_) in STAGES.items() if set(inputKeys)&set(outputKeys)]
+########################################################################################
+## running
+# runs in the stage's own process, output goes to {logDir}/{stage}.log and performance
+# records to {logDir}/metrics.jsonl
+def stage_process(connection,name,paths,params,logFile):
+    with open(logFile,"a") as log:
+        os.dup2(log.fileno(),1)
+        os.dup2(log.fileno(),2)
+        print(f"=== {name} started {time.strftime('%Y-%m-%d %H:%M:%S')} with {params}",flush=True)
+        try:
+            with measure("stage",name) as metrics:
+                metrics["records"]=STAGES[name][0](paths,params)
+            connection.send(None)
+        except Exception:
+            traceback.print_exc()
+            connection.send(traceback.format_exc().strip().splitlines()[-1])
+        print(f"=== {name} finished {time.strftime('%Y-%m-%d %H:%M:%S')}",flush=True)
+    connection.close()
+
+# is the stage's cached output still valid: same key and outputs unchanged since it ran
+def is_current(record,key,paths,outputKeys,memo):
+    if record is None or record.get("key")!=key:
+        return False
+    for outputKey in outputKeys:
+        digest=fingerprint(paths[outputKey],memo)
+        if digest is None or digest!=record["outputs"].get(outputKey):
+            return False
+    return True
+
+def run_pipeline(config,stages=None,force=(),dryRun=False,maxParallel=None):
+    paths=config["paths"]
+    stateFile=paths["pipelineState"]
+    logDir=ifnotmkdir(paths["pipelineLogs"])
+    set_metrics_file(p.join(logDir,"metrics.jsonl"))
+    state=load_state(stateFile)
+    memo=state["hashes"]
+    selected=[name for name in STAGES if stages is None or name in stages]
+    missingKeys=sorted({key for name in selected for key in stage_inputs(config,name)+STAGES[name][2] if key not in paths})
+    if missingKeys:
+        raise ValueError(f"paths missing from the config: {missingKeys}")
+    # an output inside another stage's output dir would change that stage's fingerprint on every run
+    outputs=[(name,key,p.abspath(paths[key])) for name in STAGES for key in STAGES[name][2] if key in paths]
+    nested=sorted(f"{key} in {outerKey}" for name,key,path in outputs for outerName,outerKey,outerPath in outputs
+                  if name!=outerName and path.startswith(outerPath.rstrip("/")+"/"))
+    if nested:
+        raise ValueError(f"stage outputs nested in other stage outputs: {nested}")
+    maxParallel=maxParallel or config.get("maxParallelStages",2)
+
+    finished=set()
+    failed=set()
+    running={}
+    pending=list(selected)
+    while pending or running:
+        for name in list(pending):
+            upstream=[stage for stage in upstream_stages(config,name) if stage in selected]
+            if any(stage in failed for stage in upstream):
+                print(f"{name}: blocked by a failed upstream stage")
+                failed.add(name)
+                pending.remove(name)
+                continue
+            if not all(stage in finished for stage in upstream) or len(running)>=maxParallel:
+                continue
+            pending.remove(name)
+            outputKeys=STAGES[name][2]
+            inputKeys=stage_inputs(config,name)
+            params=stage_parameters(config,name)
+            inputHashes={inputKey:fingerprint(paths[inputKey],memo) for inputKey in inputKeys}
+            missing=[inputKey for inputKey,digest in inputHashes.items() if digest is None]
+            if missing and not dryRun:
+                print(f"{name}: missing inputs {[paths[inputKey] for inputKey in missing]}")
+                failed.add(name)
+                continue
+            key=stage_key(name,params,inputHashes,{outputKey:paths[outputKey] for outputKey in outputKeys})
+            if name not in force and is_current(state["stages"].get(name),key,paths,outputKeys,memo):
+                print(f"{name}: up to date")
+                finished.add(name)
+                continue
+            if dryRun:
+                # in a dry run everything downstream of a stale stage is reported stale too
+                print(f"{name}: would run")
+                finished.add(name)
+                continue
+            print(f"{name}: running, log in {p.join(logDir,name+'.log')}")
+            receiver,sender=multiprocessing.Pipe(duplex=False)
+            process=multiprocessing.Process(target=stage_process,
+                                            args=(sender,name,paths,params,p.join(logDir,name+".log")))
+            process.start()
+            running[name]=(process,receiver,key,time.time())
+
+        if not running:
+            continue
+        # wait for any stage to finish
+        ready=wait([receiver for _,receiver,_,_ in running.values()])
+        for name in [name for name,(_,receiver,_,_) in running.items() if receiver in ready]:
+            process,receiver,key,startTime=running.pop(name)
+            try:
+                error=receiver.recv()
+            except EOFError:
+                error="stage process died"
+            process.join()
+            runTime=time.time()-startTime
+            if error is None:
+                outputKeys=STAGES[name][2]
+                state["stages"][name]={"key":key,"finished":time.strftime("%Y-%m-%d %H:%M:%S"),"seconds":runTime,
+                                       "outputs":{outputKey:fingerprint(paths[outputKey],memo) for outputKey in outputKeys}}
+                finished.add(name)
+                print(f"{name}: done in {runTime:.0f} s")
+            else:
+                state["stages"].pop(name,None)
+                failed.add(name)
+                print(f"{name}: failed after {runTime:.0f} s - {error}")
+            save_state(state,stateFile)
+    save_state(state,stateFile)
+    return finished, failed
+
+def main():
+    parser=argparse.ArgumentParser(description="run the FlavInDex pipeline, skipping stages that are up to date")
+    parser.add_argument("config",help="pipeline config json")
+    parser.add_argument("--stages",default=None,help="comma separated subset, default all: "+",".join(STAGES))
+    parser.add_argument("--force",default="",help="comma separated stages to rerun even if up to date")
+    parser.add_argument("--dry-run",action="store_true",help="report what would run")
+    parser.add_argument("--max-parallel",type=int,default=None,help="stages run at once, default from config")
+    args=parser.parse_args()
+    stages=args.stages.split(",") if args.stages else None
+    force=[stage for stage in args.force.split(",") if stage]
+    unknown=[stage for stage in (stages or [])+force if stage not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages: {unknown}, choose from {list(STAGES)}")
+    _,failed=run_pipeline(load_config(args.config),stages,force,args.dry_run,args.max_parallel)
+    if failed:
+        raise SystemExit(f"failed stages: {sorted(failed)}")
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+########################################################################################
+#   --> Persistent query index of the final FlavInDex dataset
+#
+#   --> Built once into a directory, then opened and queried without reloading the
+#       spreadsheets or scanning the dataset:
+#           entries.parquet   one row per entry: Entry, Sequence_Digest, Length, Input,
+#                             Known_Photoenzyme, AlphaFold_Available and the cluster
+#                             representative at every threshold (representative_{percent}).
+#                             With the structure download manifest, AlphaFold_Available means
+#                             the model was downloaded, otherwise that the dataset lists one
+#           sequences.fasta   the sequences, fetched by accession through fasta_index
+#           kmers.npy, offsets.npy, postings.npy
+#                             inverted k-mer index: sorted k-mer codes, and for each the
+#                             slice postings[offsets[i]:offsets[i+1]] of entries holding it
+#           kmer_counts.npy   distinct k-mers per entry
+#           index.json        k-mer size, thresholds, number of entries, sources
+#   --> Accession and sequence digest lookups are hash lookups. Similar entries for a new
+#       sequence come from its k-mers' postings (memory-mapped), scored by k-mer containment
+#       as in kmer_sketch (shared k-mers / min(k-mers in query, k-mers in entry)), no blastp
+#
+#   --> Usage:
+#           python query_index.py build indexDir --entries Nr_dataset_inputs_included.parquet
+#                  [--dataset flavins_non-redundant.parquet] [--membership cluster_membership.parquet]
+#                  [--structures download_manifest.tsv]
+#           python query_index.py query indexDir [--accessions ids.txt] [--fasta queries.fasta]
+#                  [--top 10] [--out results.tsv]
+########################################################################################
+# import libraries
+import os
+import sys
+from os import path as p
+import argparse
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from dataset_build import sequence_digest
+from fasta_index import FastaIndex, iter_fasta, header_accession, format_record, index_file
+from kmer_sketch import kmer_codes
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+# aligned hit sequences can carry gaps, the index holds the plain residues
+def clean_sequence(sequence):
+    return str(sequence).replace("-","").replace("*","").upper()
+
+def index_files(indexDir):
+    return {name:p.join(indexDir,file) for name,file in [("entries","entries.parquet"),("fasta","sequences.fasta"),
+                                                         ("kmers","kmers.npy"),("offsets","offsets.npy"),
+                                                         ("postings","postings.npy"),("kmerCounts","kmer_counts.npy"),
+                                                         ("meta","index.json")]}
+########################################################################################
+## build
+# accessions with a downloaded model in an alphafold_fetch manifest (status "ok", every row in
+# manifests written before the status column)
+def downloaded_accessions(manifestFile):
+    manifestDf=pd.read_csv(manifestFile,sep="\t",dtype=str)
+    if "status" in manifestDf:
+        manifestDf=manifestDf[manifestDf["status"]=="ok"]
+    return set(manifestDf["accession"])
+
+# entry table: one row per accession (first kept), flags from the dataset and clusters from the
+# membership table. Entries missing from the dataset (BLAST hits) are not photoenzymes. With
+# downloaded (accessions from the structure manifest) an entry has a model if its AlphaFoldDB
+# accession (its own accession without one) was downloaded, otherwise if the dataset lists one
+def entry_table(entriesDf,datasetDf=None,membershipDf=None,downloaded=None):
+    entryDf=entriesDf[["Entry","Sequence"]].copy()
+    entryDf["Sequence"]=entryDf["Sequence"].map(clean_sequence)
+    entryDf["Input"]=entriesDf["Input"].astype(bool) if "Input" in entriesDf else False
+    numEntries=len(entryDf)
+    entryDf=entryDf.drop_duplicates(subset="Entry",ignore_index=True)
+    if len(entryDf)<numEntries:
+        print(f"-->\t {numEntries-len(entryDf)} repeated accessions dropped")
+    entryDf["Sequence_Digest"]=sequence_digest(entryDf["Sequence"])
+    entryDf["Length"]=entryDf["Sequence"].str.len().astype("int32")
+    entryDf["Known_Photoenzyme"]=False
+    entryDf["AlphaFold_Available"]=False
+    if datasetDf is not None:
+        datasetDf=datasetDf.drop_duplicates(subset="Entry").set_index("Entry")
+        if "Known_Photoenzyme" in datasetDf:
+            entryDf["Known_Photoenzyme"]=entryDf["Entry"].map(datasetDf["Known_Photoenzyme"]).fillna(False).astype(bool)
+        if "AlphaFoldDB" in datasetDf and downloaded is None:
+            entryDf["AlphaFold_Available"]=entryDf["Entry"].map(datasetDf["AlphaFoldDB"].notna()).fillna(False).astype(bool)
+    if downloaded is not None:
+        alphaFoldIds=entryDf["Entry"]
+        if datasetDf is not None and "AlphaFoldDB" in datasetDf:
+            # same cleaning as alphafold_fetch, "P12345;" -> "P12345"
+            listed=datasetDf["AlphaFoldDB"].dropna().astype(str).str.strip().str.rstrip(";")
+            alphaFoldIds=entryDf["Entry"].map(listed).fillna(entryDf["Entry"])
+        entryDf["AlphaFold_Available"]=alphaFoldIds.isin(downloaded).to_numpy()
+    if membershipDf is not None:
+        for column in [column for column in membershipDf.columns if column.startswith("representative_")]:
+            entryDf[column]=entryDf["Entry"].map(membershipDf[column]).astype("string")
+    return entryDf
+
+# inverted index of the distinct k-mers of every sequence
+def kmer_postings(sequences,kmerSize):
+    entryCodes=[kmer_codes(sequence,kmerSize) for sequence in sequences]
+    kmerCounts=np.array([len(codes) for codes in entryCodes],dtype=np.int32)
+    allCodes=np.concatenate(entryCodes) if entryCodes else np.zeros(0,dtype=np.int64)
+    entryIds=np.repeat(np.arange(len(entryCodes),dtype=np.int32),kmerCounts)
+    # stable, so every posting list is in entry order
+    order=np.argsort(allCodes,kind="stable")
+    kmers,starts=np.unique(allCodes[order],return_index=True)
+    offsets=np.append(starts,len(allCodes)).astype(np.int64)
+    return kmers, offsets, entryIds[order], kmerCounts
+
+def build_index(entriesDf,indexDir,datasetDf=None,membershipDf=None,kmerSize=4,sources=None,downloaded=None):
+    files=index_files(ifnotmkdir(indexDir))
+    entryDf=entry_table(entriesDf,datasetDf,membershipDf,downloaded)
+    kmers,offsets,postings,kmerCounts=kmer_postings(entryDf["Sequence"],kmerSize)
+    # the offset index of an earlier build would no longer match
+    if p.isfile(index_file(files["fasta"])):
+        os.remove(index_file(files["fasta"]))
+    with open(files["fasta"],"w") as f:
+        for entry,sequence in zip(entryDf["Entry"],entryDf["Sequence"]):
+            f.write(format_record(entry,sequence))
+    entryDf.drop(columns="Sequence").to_parquet(files["entries"],index=False)
+    for name,array in [("kmers",kmers),("offsets",offsets),("postings",postings),("kmerCounts",kmerCounts)]:
+        np.save(files[name],array)
+    thresholds=[column for column in entryDf.columns if column.startswith("representative_")]
+    meta={"kmerSize":kmerSize,"numEntries":len(entryDf),"numKmers":len(kmers),"thresholds":thresholds,
+          "sources":sources or {}}
+    # written last, an index without it is incomplete
+    tmpFile=files["meta"]+".tmp"
+    with open(tmpFile,"w") as f:
+        json.dump(meta,f,indent=1)
+    os.replace(tmpFile,files["meta"])
+    print(f"-->\t {len(entryDf)} entries, {len(kmers)} distinct {kmerSize}-mers indexed in {indexDir}")
+    return meta
+
+# builds from the pipeline's files: the entries (Entry, Sequence, Input), the dataset (flags), the
+# cluster membership (representative_{percent} columns, ID index) and the structure download
+# manifest (alphafold_fetch's download_manifest.tsv)
+def build_index_from_files(entriesFile,indexDir,datasetFile=None,membershipFile=None,kmerSize=4,manifestFile=None):
+    entriesDf=pd.read_parquet(entriesFile)
+    datasetDf=None
+    if datasetFile is not None:
+        # only the columns the flags come from
+        columns=[column for column in ["Entry","AlphaFoldDB","Known_Photoenzyme"] if column in pq.read_schema(datasetFile).names]
+        datasetDf=pd.read_parquet(datasetFile,columns=columns)
+    membershipDf=pd.read_parquet(membershipFile) if membershipFile is not None else None
+    downloaded=downloaded_accessions(manifestFile) if manifestFile is not None else None
+    sources={"entries":p.abspath(entriesFile),"dataset":datasetFile and p.abspath(datasetFile),
+             "membership":membershipFile and p.abspath(membershipFile),
+             "structures":manifestFile and p.abspath(manifestFile)}
+    return build_index(entriesDf,indexDir,datasetDf,membershipDf,kmerSize,sources,downloaded)
+
+########################################################################################
+## queries
+class QueryIndex:
+    # opens a built index, the k-mer postings are memory-mapped rather than read
+    def __init__(self,indexDir):
+        files=index_files(indexDir)
+        if not p.isfile(files["meta"]):
+            raise FileNotFoundError(f"no query index in {indexDir} (index.json missing)")
+        with open(files["meta"],"r") as f:
+            self.meta=json.load(f)
+        self.kmerSize=self.meta["kmerSize"]
+        self.entries=pd.read_parquet(files["entries"])
+        # hash tables for accession and digest lookups
+        self.byAccession=pd.Index(self.entries["Entry"])
+        self.byDigest=pd.Index(self.entries["Sequence_Digest"])
+        self.kmers=np.load(files["kmers"],mmap_mode="r")
+        self.offsets=np.load(files["offsets"],mmap_mode="r")
+        self.postings=np.load(files["postings"],mmap_mode="r")
+        self.kmerCounts=np.load(files["kmerCounts"],mmap_mode="r")
+        self.fasta=FastaIndex(files["fasta"])
+
+    def close(self):
+        self.fasta.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,accession):
+        return accession in self.byAccession
+
+    # entry rows of the given accessions, in the order asked, unknown accessions left out
+    def lookup(self,accessions):
+        positions=self.byAccession.get_indexer_for(list(accessions))
+        return self.entries.iloc[positions[positions!=-1]].reset_index(drop=True)
+
+    # entry row of one accession as a dict, None if it isn't indexed
+    def get(self,accession):
+        if accession not in self.byAccession:
+            return None
+        return self.entries.iloc[self.byAccession.get_loc(accession)].to_dict()
+
+    def sequence(self,accession):
+        return self.fasta.fetch(accession)
+
+    # entries holding exactly this sequence
+    def lookup_sequence(self,sequence):
+        digest=sequence_digest([clean_sequence(sequence)]).iloc[0]
+        positions=self.byDigest.get_indexer_for([digest])
+        return self.entries.iloc[positions[positions!=-1]].reset_index(drop=True)
+
+    # shared k-mer count of a sequence with every entry, and the query's k-mer count
+    def shared_kmers(self,sequence):
+        codes=kmer_codes(clean_sequence(sequence),self.kmerSize)
+        slots=np.searchsorted(self.kmers,codes)
+        inRange=slots<len(self.kmers)
+        slots=slots[inRange]
+        # k-mers no entry holds have no slot
+        slots=slots[self.kmers[slots]==codes[inRange]]
+        hits=[self.postings[self.offsets[slot]:self.offsets[slot+1]] for slot in slots]
+        entryHits=np.concatenate(hits) if hits else np.zeros(0,dtype=np.int32)
+        return np.bincount(entryHits,minlength=len(self.entries)), len(codes)
+
+    # the top most similar entries to a sequence by k-mer containment, most similar first
+    def similar(self,sequence,top=10):
+        shared,numCodes=self.shared_kmers(sequence)
+        similarity=shared/np.maximum(np.minimum(numCodes,self.kmerCounts),1)
+        candidates=np.flatnonzero(shared)
+        if len(candidates)>top:
+            candidates=candidates[np.argpartition(-similarity[candidates],top-1)[:top]]
+        # ties broken by shared k-mers, then index order
+        candidates=candidates[np.lexsort((candidates,-shared[candidates],-similarity[candidates]))]
+        resultDf=self.entries.iloc[candidates].reset_index(drop=True)
+        resultDf.insert(1,"Similarity",similarity[candidates])
+        resultDf.insert(2,"Shared_Kmers",shared[candidates])
+        return resultDf
+
+    # top hits for every (name, sequence), one table with a Query and Rank column
+    def similar_batch(self,queries,top=10):
+        results=[]
+        for name,sequence in queries:
+            resultDf=self.similar(sequence,top)
+            resultDf.insert(0,"Query",name)
+            resultDf.insert(1,"Rank",np.arange(1,len(resultDf)+1))
+            results.append(resultDf)
+        if not results:
+            return pd.DataFrame(columns=["Query","Rank","Entry","Similarity","Shared_Kmers"])
+        return pd.concat(results,ignore_index=True)
+
+########################################################################################
+def write_results(resultDf,outFile=None):
+    if outFile is None:
+        resultDf.to_csv(sys.stdout,sep="\t",index=False)
+    elif outFile.endswith(".parquet"):
+        resultDf.to_parquet(outFile,index=False)
+    else:
+        resultDf.to_csv(outFile,sep="\t",index=False)
+
+def main():
+    parser=argparse.ArgumentParser(description="build and query the FlavInDex query index")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+    buildParser=subparsers.add_parser("build",help="build an index from the final dataset")
+    buildParser.add_argument("indexDir")
+    buildParser.add_argument("--entries",required=True,help="parquet with Entry, Sequence (and Input) columns")
+    buildParser.add_argument("--dataset",default=None,help="dataset parquet with AlphaFoldDB and Known_Photoenzyme")
+    buildParser.add_argument("--membership",default=None,help="cluster membership parquet (representative_ columns)")
+    buildParser.add_argument("--structures",default=None,help="download_manifest.tsv of the AlphaFold downloads")
+    buildParser.add_argument("--kmer",type=int,default=4,help="k-mer size")
+    queryParser=subparsers.add_parser("query",help="batch lookups by accession and similar entries by sequence")
+    queryParser.add_argument("indexDir")
+    queryParser.add_argument("--accessions",default=None,help="file of accessions, one per line")
+    queryParser.add_argument("--fasta",default=None,help="query sequences")
+    queryParser.add_argument("--top",type=int,default=10,help="similar entries per query sequence")
+    queryParser.add_argument("--out",default=None,help=".tsv or .parquet, default tsv on stdout")
+    args=parser.parse_args()
+    if args.command=="build":
+        build_index_from_files(args.entries,args.indexDir,args.dataset,args.membership,args.kmer,args.structures)
+        return
+    if args.accessions is None and args.fasta is None:
+        parser.error("query needs --accessions and / or --fasta")
+    with QueryIndex(args.indexDir) as index:
+        if args.accessions is not None:
+            with open(args.accessions,"r") as f:
+                accessions=[line.strip() for line in f if line.strip()]
+            resultDf=index.lookup(accessions)
+            print(f"-->\t {len(resultDf)} of {len(accessions)} accessions found",file=sys.stderr)
+            write_results(resultDf,args.out if args.fasta is None else None)
+        if args.fasta is not None:
+            queries=[(header_accession(header),sequence) for header,sequence in iter_fasta(args.fasta)]
+            write_results(index.similar_batch(queries,args.top),args.out)
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
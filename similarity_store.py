@@ -0,0 +1,68 @@
+########################################################################################
+#   --> On-disk pairwise similarity matrix, stored as a condensed upper triangle
+#
+#   --> {name}.npy holds the N*(N-1)/2 float32 scores for i<j in scipy's condensed order
+#       (row by row along the upper triangle, as scipy.spatial.distance.squareform),
+#       so it is memory-mapped instead of loaded and the diagonal / lower half are not kept
+#   --> {name}.json is the header: sequence IDs, scoring backend and its parameters
+#   --> Workers open the same file read-write and fill in the pairs they scored
+########################################################################################
+# import libraries
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+########################################################################################
+def matrix_files(matrixName):
+    return matrixName+".npy", matrixName+".json"
+
+def num_condensed(numSeqs):
+    return numSeqs*(numSeqs-1)//2
+
+# position of pair (i,j), i<j, in the condensed vector - works on scalars and arrays
+def condensed_index(numSeqs,i,j):
+    i=np.asarray(i,dtype=np.int64)
+    j=np.asarray(j,dtype=np.int64)
+    return numSeqs*i-i*(i+1)//2+(j-i-1)
+
+# row and column of every condensed position, the inverse of condensed_index
+def condensed_pairs(numSeqs):
+    return np.triu_indices(numSeqs,k=1)
+########################################################################################
+# creates an empty (nan filled) matrix and its header, returns the writable memmap
+def create_matrix(matrixName,ids,backend,parameters=None):
+    dataFile,headerFile=matrix_files(matrixName)
+    matrix=open_memmap(dataFile,mode="w+",dtype=np.float32,shape=(num_condensed(len(ids)),))
+    matrix[:]=np.nan
+    header={"ids":list(ids),"backend":backend,"parameters":parameters or {},
+            "dtype":"float32","layout":"condensed upper triangle"}
+    with open(headerFile,"w") as f:
+        json.dump(header,f)
+    return matrix
+
+# opens the scores for writing from a worker
+def open_for_writing(matrixName):
+    return open_memmap(matrix_files(matrixName)[0],mode="r+")
+
+# writes scores for pairs (i,j) into an open matrix
+def write_pairs(matrix,numSeqs,rows,cols,scores):
+    matrix[condensed_index(numSeqs,rows,cols)]=np.asarray(scores,dtype=np.float32)
+
+########################################################################################
+# loads the header and a read-only memmap view of the scores
+def load_matrix(matrixName):
+    dataFile,headerFile=matrix_files(matrixName)
+    with open(headerFile,"r") as f:
+        header=json.load(f)
+    return header, np.load(dataFile,mmap_mode="r")
+
+# the scores as an in-memory float64 condensed vector, as scipy.cluster.hierarchy expects
+def load_condensed(matrixName):
+    header,matrix=load_matrix(matrixName)
+    return header, np.asarray(matrix,dtype=np.float64)
+
+# score of one pair, either order
+def pair_score(matrix,numSeqs,i,j):
+    if i==j:
+        return np.nan
+    i,j=min(i,j),max(i,j)
+    return matrix[condensed_index(numSeqs,i,j)]
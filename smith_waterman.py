@@ -0,0 +1,108 @@
+########################################################################################
+#   --> In-process local alignment scores (Smith-Waterman, BLOSUM62, affine gaps)
+#
+#   --> One query is scored against many subjects per call. Subjects are padded into a
+#       (numSubjects x length) array and the DP runs column by column along the subjects,
+#       vectorised over every subject and every query position at once. The vertical
+#       gap term is a running max (np.maximum.accumulate) so no python loop runs over
+#       the query.
+#
+#   --> Gap costs follow blastp defaults: a gap of length k costs gapOpen + k*gapExtend
+#       (11 + k). The score is the optimal raw local alignment score, this is the same
+#       number as the blastp HSP score whenever blastp finds the optimal HSP and
+#       composition based statistics do not rescale it (-comp_based_stats 0)
+########################################################################################
+# import libraries
+import numpy as np
+from Bio.Align import substitution_matrices
+########################################################################################
+# score given to padding positions, low enough that no alignment runs through them
+PAD_SCORE=-10000
+# number of DP cells (subjects x query length) held in memory per batch
+BATCH_CELLS=2000000
+########################################################################################
+# utilities
+# loads BLOSUM62 as an int32 array plus a 256 entry ascii -> matrix index lookup
+def load_blosum62():
+    blosum=substitution_matrices.load("BLOSUM62")
+    alphabet=blosum.alphabet
+    # extra last row/column is the padding residue
+    matrix=np.full((len(alphabet)+1,len(alphabet)+1),PAD_SCORE,dtype=np.int32)
+    matrix[:-1,:-1]=np.array(blosum,dtype=np.int32)
+    # unknown residues score as X
+    lookup=np.full(256,alphabet.index("X"),dtype=np.int32)
+    for index,residue in enumerate(alphabet):
+        lookup[ord(residue)]=index
+        lookup[ord(residue.lower())]=index
+    padCode=len(alphabet)
+    return matrix, lookup, padCode
+
+BLOSUM62, RESIDUE_LOOKUP, PAD_CODE = load_blosum62()
+
+# converts a sequence string to an array of matrix indices
+def encode(sequence):
+    return RESIDUE_LOOKUP[np.frombuffer(sequence.encode("ascii"),dtype=np.uint8)]
+
+# packs encoded subjects into one padded 2D array
+def pad_subjects(encodedSubjects):
+    maxLength=max(len(subject) for subject in encodedSubjects)
+    padded=np.full((len(encodedSubjects),maxLength),PAD_CODE,dtype=np.int32)
+    for row,subject in enumerate(encodedSubjects):
+        padded[row,:len(subject)]=subject
+    return padded
+########################################################################################
+# scores one encoded query against a padded block of subjects, returns best local scores
+def sw_block(queryProfile,subjectBlock,gapOpen,gapExtend):
+    numSubjects,subjectLength=subjectBlock.shape
+    queryLength=queryProfile.shape[0]
+    # cost of the first residue of a gap and of every following residue
+    firstGap=gapOpen+gapExtend
+    nextGap=gapExtend
+    positions=np.arange(queryLength,dtype=np.int32)*nextGap
+
+    # H of the previous subject column, with a zero boundary row in front
+    hPrev=np.zeros((numSubjects,queryLength+1),dtype=np.int32)
+    # gaps in the query (consume subject residues), carried between columns
+    e=np.full((numSubjects,queryLength),PAD_SCORE,dtype=np.int32)
+    f=np.empty((numSubjects,queryLength),dtype=np.int32)
+    best=np.zeros(numSubjects,dtype=np.int32)
+
+    for j in range(subjectLength):
+        # substitution scores of every query position against subject residue j
+        scores=queryProfile[:,subjectBlock[:,j]].T
+        np.maximum(hPrev[:,1:]-firstGap,e-nextGap,out=e)
+        h=np.maximum(hPrev[:,:-1]+scores,e)
+        np.maximum(h,0,out=h)
+        # gaps in the subject: F[i] = max_{k<i}(H[k] - firstGap - (i-1-k)*nextGap)
+        # opening from a cell that already ends in such a gap never wins, so the
+        # running max over H without F gives the exact value
+        runningMax=np.maximum.accumulate(h+positions,axis=1)
+        f[:,0]=PAD_SCORE
+        f[:,1:]=runningMax[:,:-1]-firstGap-positions[:-1]
+        np.maximum(h,f,out=h)
+        np.maximum(best,h.max(axis=1),out=best)
+        hPrev[:,1:]=h
+    return best
+
+########################################################################################
+# best local alignment score of query against each subject, in subject order
+def sw_scores(query,subjects,gapOpen=11,gapExtend=1):
+    scores=np.zeros(len(subjects),dtype=np.float64)
+    if len(subjects)==0 or len(query)==0:
+        return scores
+    queryProfile=BLOSUM62[encode(query)]
+    encodedSubjects=[encode(subject) for subject in subjects]
+    # sort by length so each batch carries as little padding as possible
+    order=np.argsort([len(subject) for subject in encodedSubjects],kind="stable")
+    batchSize=max(1,BATCH_CELLS//len(query))
+    for start in range(0,len(order),batchSize):
+        batch=order[start:start+batchSize]
+        subjectBlock=pad_subjects([encodedSubjects[index] for index in batch])
+        scores[batch]=sw_block(queryProfile,subjectBlock,gapOpen,gapExtend)
+    return scores
+
+# score of each sequence aligned against itself, the sum of its positive BLOSUM62 diagonal
+# entries. Used to normalise raw scores into a 0-1 similarity
+def self_scores(sequences):
+    diagonal=np.clip(np.diagonal(BLOSUM62)[:PAD_CODE],0,None)
+    return np.array([diagonal[encode(sequence)].sum() for sequence in sequences],dtype=np.float64)
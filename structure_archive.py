@@ -0,0 +1,360 @@
+########################################################################################
+#   --> Columnar archive of the predicted structures (AlphaFold DB downloads and ColabFold
+#       predictions), parsed once instead of re-reading thousands of PDB files per screen
+#
+#   --> Every PDB file is parsed in a worker pool (fixed PDB columns sliced as numpy arrays)
+#       and appended to one set of flat arrays, in archiveDir:
+#           atoms     coords (float32 x 3), atom_name, element
+#           residues  res_name, res_seq, chain, plddt (the B-factor column, per residue),
+#                     res_atom_offsets (first atom of each residue, plus the total)
+#           proteins.parquet   accession, source file (with its size and mtime) and the atom /
+#                     residue range of each protein in the flat arrays
+#           archive.json       dtype and shape of every array
+#       arrays are raw binary opened with np.memmap, so a protein is a zero-copy slice
+#   --> A rebuild only parses files that are new or changed (size or mtime) since the last
+#       build, the others are copied from the previous archive
+#   --> Only the first model and ATOM records are kept. ColabFold writes 5 ranked models per
+#       query, the rank 1 model (relaxed if there is one) stands for the query
+#   --> Proteins are keyed by accession. ColabFold names its models after the whole fasta
+#       header made file safe, so the fasta the predictions were made from maps them back to
+#       the accession (first word of the header), as AlphaFold downloads and the query index
+#       are keyed
+#   --> Whole-dataset queries run on the flat arrays: mean pLDDT / fraction of confident
+#       residues of every protein are one reduceat, residues within X angstrom of a residue
+#       are a distance matrix against that residue's atoms, reduced per residue
+#
+#   --> Usage:
+#           python structure_archive.py build archiveDir alphafold_structures [predictionsDir ...]
+#                  [--fasta folding.fasta ...]
+#           python structure_archive.py plddt archiveDir [--out mean_plddt.tsv]
+########################################################################################
+# import libraries
+import os
+import sys
+from os import path as p
+import argparse
+import json
+import re
+import shutil
+import multiprocessing
+import numpy as np
+import pandas as pd
+from fasta_index import iter_fasta, header_accession
+########################################################################################
+ATOM_ARRAYS={"coords":("float32",(3,)),"atom_name":("S4",()),"element":("S2",())}
+RESIDUE_ARRAYS={"res_name":("S3",()),"res_seq":("int32",()),"chain":("S1",()),"plddt":("float32",())}
+# columns of a PDB ATOM record, 0-based start / stop
+PDB_FIELDS={"atom_name":(12,16),"res_name":(17,20),"chain":(21,22),"res_seq":(22,26),"insertion":(26,27),
+            "x":(30,38),"y":(38,46),"z":(46,54),"b_factor":(60,66),"element":(76,78)}
+RANKED_MODEL=re.compile(r"^(?P<jobname>.+?)_(?P<unrelaxed>un)?relaxed_rank_(?P<rank>\d+)_")
+########################################################################################
+# utilities
+def ifnotmkdir(dir):
+    if not p.isdir(dir):
+        os.makedirs(dir)
+    return dir
+
+def array_file(archiveDir,name):
+    return p.join(archiveDir,f"{name}.bin")
+
+# colabfold jobname -> accession for the records of the fasta files predictions were made from.
+# The jobname is the whole header with unsafe characters replaced (as in 04_colabfold_fold_from_fasta)
+def jobname_accessions(fastaFiles):
+    jobnames={}
+    for fastaFile in fastaFiles:
+        for header,_ in iter_fasta(fastaFile):
+            jobname="".join(c if c.isalnum() or c in ["_",".","-"] else "_" for c in header)
+            jobnames[jobname]=header_accession(header)
+    return jobnames
+
+# (accession, file) for every structure in the given dirs, first dir wins when an accession is
+# in more than one. {accession}.pdb from alphafold_fetch, rank 1 of ColabFold's ranked models,
+# keyed by the accession jobnames maps their jobname to (the jobname if it has none)
+def structure_files(structureDirs,jobnames=None):
+    jobnames=jobnames or {}
+    unmapped=set()
+    structures={}
+    for structureDir in structureDirs:
+        if not p.isdir(structureDir):
+            print(f"-->\t {structureDir} not found, skipped")
+            continue
+        dirStructures={}
+        for file in sorted(os.listdir(structureDir)):
+            if not file.endswith(".pdb"):
+                continue
+            match=RANKED_MODEL.match(file)
+            if match is None:
+                dirStructures[file[:-len(".pdb")]]=p.join(structureDir,file)
+                continue
+            if match["jobname"] not in jobnames:
+                unmapped.add(match["jobname"])
+            accession=jobnames.get(match["jobname"],match["jobname"])
+            # the relaxed model wins over the unrelaxed one
+            if int(match["rank"])==1 and (match["unrelaxed"] is None or accession not in dirStructures):
+                dirStructures[accession]=p.join(structureDir,file)
+        for accession,pdbFile in dirStructures.items():
+            structures.setdefault(accession,pdbFile)
+    if unmapped:
+        print(f"-->\t {len(unmapped)} ColabFold jobs not in the given fasta files, kept under their jobname")
+    return list(structures.items())
+########################################################################################
+## parsing
+# the ATOM records of the first model as fixed width rows, one byte per column
+def atom_records(pdbFile):
+    lines=[]
+    with open(pdbFile,"rb") as f:
+        for line in f:
+            if line.startswith(b"ENDMDL"):
+                break
+            # records too short to hold coordinates are skipped
+            if line.startswith(b"ATOM  ") and len(line.rstrip())>=54:
+                lines.append(line.rstrip(b"\r\n").ljust(80)[:80])
+    return np.frombuffer(b"".join(lines),dtype="S1").reshape(-1,80)
+
+def pdb_field(records,name):
+    start,stop=PDB_FIELDS[name]
+    return np.ascontiguousarray(records[:,start:stop]).view(f"S{stop-start}").ravel()
+
+def to_float(column,default=b"0"):
+    column=np.char.strip(column)
+    column[column==b""]=default
+    return column.astype(np.float32)
+
+# atom and residue arrays of one PDB file
+def parse_pdb(pdbFile):
+    records=atom_records(pdbFile)
+    coords=np.stack([to_float(pdb_field(records,axis)) for axis in ["x","y","z"]],axis=1)
+    chain=pdb_field(records,"chain")
+    resSeq=to_float(pdb_field(records,"res_seq")).astype(np.int32)
+    insertion=pdb_field(records,"insertion")
+    # a residue starts wherever chain, number or insertion code changes
+    newResidue=np.ones(len(records),dtype=bool)
+    newResidue[1:]=(chain[1:]!=chain[:-1])|(resSeq[1:]!=resSeq[:-1])|(insertion[1:]!=insertion[:-1])
+    residueStarts=np.flatnonzero(newResidue)
+    return {"coords":coords,
+            "atom_name":np.char.strip(pdb_field(records,"atom_name")),
+            "element":np.char.strip(pdb_field(records,"element")),
+            "res_name":pdb_field(records,"res_name")[residueStarts],
+            "res_seq":resSeq[residueStarts],
+            "chain":chain[residueStarts],
+            # AlphaFold and ColabFold put the residue's pLDDT in every atom's B-factor
+            "plddt":to_float(pdb_field(records,"b_factor"))[residueStarts],
+            "residue_starts":residueStarts.astype(np.int64)}
+########################################################################################
+## build
+# source file -> (archive, protein) for the proteins of the previous archive whose file is
+# unchanged since it was built, so they are copied rather than parsed again
+def reusable_structures(archiveDir):
+    if not p.isfile(p.join(archiveDir,"archive.json")):
+        return {}
+    archive=StructureArchive(archiveDir)
+    # archives of an older layout don't record the file stats
+    if "size" not in archive.proteins:
+        return {}
+    reusable={}
+    for protein in archive.proteins.itertuples(index=False):
+        if p.isfile(protein.file):
+            stat=os.stat(protein.file)
+            if stat.st_size==protein.size and stat.st_mtime_ns==protein.mtime_ns:
+                reusable[protein.file]=(archive,protein.accession)
+    return reusable
+
+# one protein of an archive in the layout parse_pdb returns
+def archived_structure(archive,accession):
+    structure=archive.protein(accession)
+    parsed={name:np.asarray(structure[name]) for name in list(ATOM_ARRAYS)+list(RESIDUE_ARRAYS)}
+    parsed["residue_starts"]=np.asarray(structure["residue_atom_offsets"][:-1],dtype=np.int64)
+    return parsed
+
+# parses every new or changed structure in a pool and appends all of them to the archive arrays,
+# in file order. fastaFiles are the fasta files the ColabFold predictions were made from, see
+# jobname_accessions
+def build_archive(structureDirs,archiveDir,numWorkers=None,fastaFiles=()):
+    structures=[(accession,p.abspath(pdbFile))
+                for accession,pdbFile in structure_files(structureDirs,jobname_accessions(fastaFiles))]
+    reusable=reusable_structures(archiveDir)
+    toParse=[pdbFile for _,pdbFile in structures if pdbFile not in reusable]
+    # built next to the old archive and swapped in once complete
+    tmpDir=archiveDir.rstrip("/")+".tmp"
+    shutil.rmtree(tmpDir,ignore_errors=True)
+    ifnotmkdir(tmpDir)
+    arrays={**ATOM_ARRAYS,**RESIDUE_ARRAYS,"res_atom_offsets":("int64",())}
+    handles={name:open(array_file(tmpDir,name),"wb") for name in arrays}
+    proteins=[]
+    numAtoms=0
+    numResidues=0
+    try:
+        with multiprocessing.Pool(processes=numWorkers or os.cpu_count()) as pool:
+            parsedFiles=pool.imap(parse_pdb,toParse,chunksize=16)
+            for accession,pdbFile in structures:
+                stat=os.stat(pdbFile)
+                if pdbFile in reusable:
+                    parsed=archived_structure(*reusable[pdbFile])
+                else:
+                    parsed=next(parsedFiles)
+                for name in list(ATOM_ARRAYS)+list(RESIDUE_ARRAYS):
+                    handles[name].write(parsed[name].astype(arrays[name][0],copy=False).tobytes())
+                handles["res_atom_offsets"].write((parsed["residue_starts"]+numAtoms).tobytes())
+                atomCount=len(parsed["coords"])
+                residueCount=len(parsed["res_seq"])
+                proteins.append({"accession":accession,"file":pdbFile,"size":stat.st_size,"mtime_ns":stat.st_mtime_ns,
+                                 "atom_start":numAtoms,"atom_stop":numAtoms+atomCount,
+                                 "res_start":numResidues,"res_stop":numResidues+residueCount})
+                numAtoms+=atomCount
+                numResidues+=residueCount
+        # closing offset, so residue i's atoms are res_atom_offsets[i]:res_atom_offsets[i+1]
+        handles["res_atom_offsets"].write(np.array([numAtoms],dtype=np.int64).tobytes())
+    finally:
+        for handle in handles.values():
+            handle.close()
+    proteinDf=pd.DataFrame(proteins,columns=["accession","file","size","mtime_ns","atom_start","atom_stop",
+                                            "res_start","res_stop"])
+    proteinDf.to_parquet(p.join(tmpDir,"proteins.parquet"),index=False)
+    shapes={**{name:[numAtoms,*shape] for name,(_,shape) in ATOM_ARRAYS.items()},
+            **{name:[numResidues,*shape] for name,(_,shape) in RESIDUE_ARRAYS.items()},
+            "res_atom_offsets":[numResidues+1]}
+    header={"numProteins":len(proteinDf),"numResidues":numResidues,"numAtoms":numAtoms,
+            "arrays":{name:{"dtype":dtype,"shape":shapes[name]} for name,(dtype,_) in arrays.items()},
+            "sources":[p.abspath(structureDir) for structureDir in structureDirs]}
+    with open(p.join(tmpDir,"archive.json"),"w") as f:
+        json.dump(header,f,indent=1)
+    # the previous archive's maps are released before its files go
+    reusable.clear()
+    shutil.rmtree(archiveDir,ignore_errors=True)
+    os.replace(tmpDir,archiveDir)
+    print(f"-->\t {len(proteinDf)} structures ({len(toParse)} parsed, {len(proteinDf)-len(toParse)} unchanged), "
+          f"{numResidues} residues, {numAtoms} atoms archived in {archiveDir}")
+    return header
+########################################################################################
+## queries
+class StructureArchive:
+    # opens the archive, arrays are memory-mapped, only the protein table is read
+    def __init__(self,archiveDir):
+        with open(p.join(archiveDir,"archive.json"),"r") as f:
+            self.header=json.load(f)
+        self.arrays={}
+        for name,spec in self.header["arrays"].items():
+            # np.memmap can't map an empty file
+            if spec["shape"][0]==0:
+                self.arrays[name]=np.zeros(spec["shape"],dtype=spec["dtype"])
+            else:
+                self.arrays[name]=np.memmap(array_file(archiveDir,name),dtype=spec["dtype"],mode="r",
+                                            shape=tuple(spec["shape"]))
+        self.proteins=pd.read_parquet(p.join(archiveDir,"proteins.parquet"))
+        self.byAccession=pd.Index(self.proteins["accession"])
+        self.atomStarts=self.proteins["atom_start"].to_numpy()
+        self.atomStops=self.proteins["atom_stop"].to_numpy()
+        self.resStarts=self.proteins["res_start"].to_numpy()
+        self.resStops=self.proteins["res_stop"].to_numpy()
+
+    def __len__(self):
+        return len(self.proteins)
+
+    def __contains__(self,accession):
+        return accession in self.byAccession
+
+    @property
+    def accessions(self):
+        return self.proteins["accession"].tolist()
+
+    def position(self,accession):
+        return self.byAccession.get_loc(accession)
+
+    # zero-copy views of one protein's arrays. residue_atom_offsets are local to its atoms
+    def protein(self,accession):
+        i=self.position(accession)
+        atoms=slice(self.atomStarts[i],self.atomStops[i])
+        residues=slice(self.resStarts[i],self.resStops[i])
+        structure={name:self.arrays[name][atoms] for name in ATOM_ARRAYS}
+        structure.update({name:self.arrays[name][residues] for name in RESIDUE_ARRAYS})
+        structure["residue_atom_offsets"]=self.arrays["res_atom_offsets"][self.resStarts[i]:self.resStops[i]+1]-self.atomStarts[i]
+        return structure
+
+    def coords(self,accession):
+        i=self.position(accession)
+        return self.arrays["coords"][self.atomStarts[i]:self.atomStops[i]]
+
+    def plddt(self,accession):
+        i=self.position(accession)
+        return self.arrays["plddt"][self.resStarts[i]:self.resStops[i]]
+
+    ########################################################################################
+    # per protein means of a per residue array, nan for proteins without residues
+    def per_protein_mean(self,values):
+        counts=self.resStops-self.resStarts
+        means=np.full(len(self.proteins),np.nan)
+        hasResidues=counts>0
+        if hasResidues.any():
+            sums=np.add.reduceat(np.asarray(values,dtype=np.float64),self.resStarts[hasResidues])
+            means[hasResidues]=sums/counts[hasResidues]
+        return pd.Series(means,index=self.byAccession)
+
+    def mean_plddt(self):
+        return self.per_protein_mean(self.arrays["plddt"]).rename("mean_plddt")
+
+    # fraction of each protein's residues with pLDDT >= cutoff (70 is AlphaFold's "confident")
+    def plddt_fraction(self,cutoff=70):
+        return self.per_protein_mean(self.arrays["plddt"]>=cutoff).rename(f"fraction_plddt_{cutoff:g}")
+
+    # residues of a protein with any atom within distance (angstrom) of any atom of residue resSeq,
+    # that residue excluded. Returns res_seq, res_name, chain, plddt and the closest distance
+    def residues_within(self,accession,resSeq,distance,chain=None):
+        structure=self.protein(accession)
+        isTarget=structure["res_seq"]==resSeq
+        if chain is not None:
+            isTarget&=structure["chain"]==chain.encode()
+        offsets=structure["residue_atom_offsets"]
+        targetAtoms=np.concatenate([np.arange(offsets[r],offsets[r+1]) for r in np.flatnonzero(isTarget)]
+                                   or [np.zeros(0,dtype=np.int64)])
+        if len(targetAtoms)==0:
+            raise KeyError(f"{accession} has no residue {resSeq}")
+        coords=np.asarray(structure["coords"])
+        # closest target atom to every atom, then closest atom of every residue
+        atomDistance=np.sqrt(((coords[:,None,:]-coords[None,targetAtoms,:])**2).sum(axis=2)).min(axis=1)
+        residueDistance=np.minimum.reduceat(atomDistance,offsets[:-1])
+        keep=np.flatnonzero((residueDistance<=distance)&~isTarget)
+        return pd.DataFrame({"res_seq":structure["res_seq"][keep],
+                             "res_name":structure["res_name"][keep].astype(str),
+                             "chain":structure["chain"][keep].astype(str),
+                             "plddt":structure["plddt"][keep],
+                             "distance":residueDistance[keep]})
+
+    # residues_within for a residue of many proteins, targets maps accession -> residue number
+    def residues_within_all(self,targets,distance):
+        results=[]
+        for accession,resSeq in dict(targets).items():
+            if accession not in self:
+                continue
+            try:
+                resultDf=self.residues_within(accession,resSeq,distance)
+            except KeyError:
+                continue
+            resultDf.insert(0,"accession",accession)
+            results.append(resultDf)
+        if not results:
+            return pd.DataFrame(columns=["accession","res_seq","res_name","chain","plddt","distance"])
+        return pd.concat(results,ignore_index=True)
+
+def main():
+    parser=argparse.ArgumentParser(description="archive predicted structures for fast screening")
+    subparsers=parser.add_subparsers(dest="command",required=True)
+    buildParser=subparsers.add_parser("build",help="parse every pdb file of the dirs into one archive")
+    buildParser.add_argument("archiveDir")
+    buildParser.add_argument("structureDirs",nargs="+")
+    buildParser.add_argument("--workers",type=int,default=None)
+    buildParser.add_argument("--fasta",nargs="*",default=[],help="fasta files the ColabFold predictions were made from")
+    plddtParser=subparsers.add_parser("plddt",help="mean pLDDT and confident fraction of every protein")
+    plddtParser.add_argument("archiveDir")
+    plddtParser.add_argument("--cutoff",type=float,default=70)
+    plddtParser.add_argument("--out",default=None,help="tsv file, default stdout")
+    args=parser.parse_args()
+    if args.command=="build":
+        build_archive(args.structureDirs,args.archiveDir,args.workers,args.fasta)
+        return
+    archive=StructureArchive(args.archiveDir)
+    plddtDf=pd.concat([archive.mean_plddt(),archive.plddt_fraction(args.cutoff)],axis=1)
+    plddtDf.to_csv(args.out if args.out else sys.stdout,sep="\t")
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()
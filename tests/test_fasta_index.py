@@ -0,0 +1,34 @@
+########################################################################################
+#   --> FastaIndex blocks sent to blastp on stdin must be valid FASTA whatever the order
+#       of their records in the file
+########################################################################################
+# import libraries
+import sys
+from os import path as p
+sys.path.insert(0,p.dirname(p.dirname(p.abspath(__file__))))
+from fasta_index import FastaIndex, iter_fasta
+########################################################################################
+def write_fasta(tmp_path,text):
+    fastaFile=str(tmp_path/"sequences.fasta")
+    with open(fastaFile,"w") as f:
+        f.write(text)
+    return fastaFile
+
+# the last record has no trailing newline and the block puts it before another record
+def test_block_bytes_reordered_without_final_newline(tmp_path):
+    fastaFile=write_fasta(tmp_path,">a desc\nAAAAAAAAAA\n>b\nCC\n>c\nDDDDD")
+    with FastaIndex(fastaFile) as index:
+        blockFile=str(tmp_path/"block.fasta")
+        with open(blockFile,"wb") as f:
+            f.write(bytes(index.block_bytes(["a","c","b"])))
+    assert list(iter_fasta(blockFile))==[("a desc","AAAAAAAAAA"),("c","DDDDD"),("b","CC")]
+
+def test_block_bytes_by_residues_matches_records(tmp_path):
+    fastaFile=write_fasta(tmp_path,">s1\nAC\n>s2\nACGTACGT\n>s3\nACGT\n>s4\nA")
+    with FastaIndex(fastaFile) as index:
+        records=dict(iter_fasta(fastaFile))
+        for block in index.blocks_by_residues(9):
+            blockFile=str(tmp_path/"block.fasta")
+            with open(blockFile,"wb") as f:
+                f.write(bytes(index.block_bytes(block)))
+            assert dict(iter_fasta(blockFile))=={accession:records[accession] for accession in block}
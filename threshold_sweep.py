@@ -0,0 +1,146 @@
+########################################################################################
+#   --> Clusters at every similarity threshold in one pass over the pairwise similarities
+#       of 03_Calculate_similarity, instead of one CD-HIT run per threshold
+#
+#   --> Raw alignment scores are normalised by the self score of the shorter partner
+#       (score / min(selfScore_i, selfScore_j), see smith_waterman.self_scores), a 0-1
+#       similarity. It is not a sequence identity and runs well below one (pairs at 50%
+#       identity score around 0.38, at 80% around 0.76), so the thresholds are normalised
+#       score thresholds, not the identity tolerances given to CD-HIT
+#   --> Edges at or above the lowest threshold are sorted once, strongest first, and merged
+#       with a union-find. Each time the sweep drops below a threshold the current clusters
+#       are the clusters at that threshold (single linkage: members are joined by a chain
+#       of pairs at or above it)
+#   --> The representative of a cluster is its longest member, as CD-HIT picks, and the
+#       output is an ID-keyed table with one representative_score_{percent} column per
+#       threshold, laid out like 02_CD-hit_cluster's cluster_membership.parquet but named
+#       apart from its representative_{percent} identity columns
+########################################################################################
+# import libraries
+from os import path as p
+import numpy as np
+import pandas as pd
+from fasta_index import iter_fasta, header_accession
+from smith_waterman import self_scores
+import similarity_store
+########################################################################################
+# score / min(selfScore_i, selfScore_j). A sequence with a zero self score (empty, or only X)
+# has no similarity to anything: its pairs get 0 rather than inf / nan
+def normalise(scores,normaliserI,normaliserJ):
+    normaliser=np.minimum(normaliserI,normaliserJ)
+    similarity=np.zeros(np.broadcast(scores,normaliser).shape)
+    np.divide(scores,normaliser,out=similarity,where=normaliser>0)
+    return similarity
+
+# pairs (i,j) of the condensed matrix with a normalised similarity >= minSimilarity, read
+# one row of the memmap at a time so the full matrix is never in memory
+def matrix_edges(matrix,normalisers,minSimilarity):
+    numSeqs=len(normalisers)
+    rows,cols,sims=[],[],[]
+    for i in range(numSeqs-1):
+        start=int(similarity_store.condensed_index(numSeqs,i,i+1))
+        scores=np.asarray(matrix[start:start+numSeqs-i-1],dtype=np.float64)
+        similarity=normalise(scores,normalisers[i],normalisers[i+1:])
+        # nan (no alignment found) never passes
+        keep=np.flatnonzero(similarity>=minSimilarity)
+        rows.append(np.full(len(keep),i,dtype=np.int64))
+        cols.append(keep+i+1)
+        sims.append(similarity[keep])
+    if not rows:
+        return np.empty(0,dtype=np.int64),np.empty(0,dtype=np.int64),np.empty(0)
+    return np.concatenate(rows),np.concatenate(cols),np.concatenate(sims)
+
+# the same from the sparse edge list written with a sketch prefilter, whose ID_i / ID_j must
+# be the headers at positions i / j of the fasta
+def edge_list_edges(edgeFile,headers,normalisers,minSimilarity):
+    edgeDf=pd.read_csv(edgeFile,usecols=["i","j","ID_i","ID_j","score"],dtype={"ID_i":str,"ID_j":str})
+    rows=edgeDf["i"].to_numpy(dtype=np.int64)
+    cols=edgeDf["j"].to_numpy(dtype=np.int64)
+    headerArray=np.array(headers,dtype=object)
+    if len(edgeDf) and (max(rows.max(),cols.max())>=len(headers) or min(rows.min(),cols.min())<0
+                        or (headerArray[rows]!=edgeDf["ID_i"].to_numpy()).any()
+                        or (headerArray[cols]!=edgeDf["ID_j"].to_numpy()).any()):
+        raise ValueError(f"{edgeFile}: pair IDs don't match the fasta it is clustered with")
+    similarity=normalise(edgeDf["score"].to_numpy(dtype=np.float64),normalisers[rows],normalisers[cols])
+    keep=similarity>=minSimilarity
+    return rows[keep],cols[keep],similarity[keep]
+
+########################################################################################
+# union-find over the edges in decreasing similarity, returns threshold -> cluster root of
+# every sequence, taken when the sweep passes below that threshold
+def sweep_labels(numSeqs,rows,cols,sims,thresholds):
+    order=np.argsort(-sims,kind="stable")
+    sortedRows=rows[order].tolist()
+    sortedCols=cols[order].tolist()
+    sortedSims=sims[order].tolist()
+    parent=list(range(numSeqs))
+
+    def find(x):
+        while parent[x]!=x:
+            # path halving keeps the trees flat
+            parent[x]=parent[parent[x]]
+            x=parent[x]
+        return x
+
+    labels={}
+    edge=0
+    numEdges=len(sortedSims)
+    for threshold in sorted(thresholds,reverse=True):
+        while edge<numEdges and sortedSims[edge]>=threshold:
+            rootI=find(sortedRows[edge])
+            rootJ=find(sortedCols[edge])
+            if rootI!=rootJ:
+                parent[max(rootI,rootJ)]=min(rootI,rootJ)
+            edge+=1
+        labels[threshold]=np.array([find(x) for x in range(numSeqs)],dtype=np.int64)
+    return labels
+
+# longest member of each cluster (first in file order on ties), for every sequence
+def representatives(labels,lengths):
+    numSeqs=len(labels)
+    order=np.lexsort((np.arange(numSeqs),-np.asarray(lengths),labels))
+    sortedLabels=labels[order]
+    first=np.ones(numSeqs,dtype=bool)
+    first[1:]=sortedLabels[1:]!=sortedLabels[:-1]
+    repByLabel=np.empty(numSeqs,dtype=np.int64)
+    repByLabel[sortedLabels[first]]=order[first]
+    return repByLabel[labels]
+
+########################################################################################
+# loads the similarity output of fastaFile (a similarity_matrix_{name} matrix or a
+# similarity_edges_{name}.csv edge list) and clusters it at every threshold. The similarity
+# output holds whole headers, the table is keyed by the first word (the ID cd-hit reports) so
+# it joins with cluster_membership.parquet
+def sweep_thresholds(fastaFile,similarityFile,thresholds=(0.5,0.6,0.7,0.8,0.9)):
+    headers,sequences=zip(*iter_fasta(fastaFile))
+    ids=[header_accession(header) for header in headers]
+    normalisers=self_scores(sequences)
+    lengths=np.array([len(sequence) for sequence in sequences])
+    minSimilarity=min(thresholds)
+    if similarityFile.endswith(".csv"):
+        rows,cols,sims=edge_list_edges(similarityFile,headers,normalisers,minSimilarity)
+    else:
+        header,matrix=similarity_store.load_matrix(p.splitext(similarityFile)[0] if similarityFile.endswith(".npy")
+                                                   else similarityFile)
+        if list(header["ids"])!=list(headers):
+            raise ValueError(f"{similarityFile} was not computed from {fastaFile}")
+        rows,cols,sims=matrix_edges(matrix,normalisers,minSimilarity)
+    print(f"{len(sims)} pairs at or above {minSimilarity}")
+
+    membershipDf=pd.DataFrame(index=pd.Index(ids,name="ID"))
+    idArray=np.array(ids,dtype=object)
+    for threshold,labels in sorted(sweep_labels(len(ids),rows,cols,sims,thresholds).items(),reverse=True):
+        column=f"representative_score_{int(round(threshold*100))}"
+        membershipDf[column]=idArray[representatives(labels,lengths)]
+        print(f"{column}: {len(np.unique(labels))} clusters")
+    return membershipDf
+
+def main():
+    clusterDir="/home/esp/dataset_generation/flavin_dataset/021_post_blast_CD-Hit_results"
+    fastaFile=p.join(clusterDir,"output_data_50.fasta")
+    membershipDf=sweep_thresholds(fastaFile,p.join(clusterDir,"similarity_matrix_50percent"))
+    membershipDf.to_parquet(p.join(clusterDir,"threshold_membership.parquet"))
+########################################################################################
+# run main (if statement prevents running if this script is imported)
+if __name__ == '__main__':
+    main()